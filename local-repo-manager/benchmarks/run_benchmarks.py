@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the hot paths of the local repository manager.
+
+Synthetic repository databases, .SRCINFO files and packages directories are generated
+in a temporary directory, and each of the measured functions is timed against them;
+the results (operations per second and peak memory) are written to JSON file,
+so that separate runs can be compared with --compare option.
+
+The `update` action is run in full, with stand-in executables (from standins directory)
+taking place of makepkg, pacman and repo-add, so that it needs neither root nor network access;
+stand-in systemd-nspawn runs the manager's own `build` action on the host instead of the container,
+with the packages cloned from local git repositories. With the builds spread across hosts, stand-in ssh
+runs the manager of the "remote" host (stand-in as well) on localhost. The time spent in simulated builds
+is reported separately from the orchestration overhead of the update itself.
+
+Usage: benchmarks/run_benchmarks.py [--output results.json] [--compare baseline.json]
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from contextlib import redirect_stdout
+import json
+import os
+import os.path
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MANAGER_DIR = os.path.dirname(BENCHMARKS_DIR)
+STANDINS_DIR = os.path.join(BENCHMARKS_DIR, "standins")
+
+# Stand-in executables use the manager's modules as well
+sys.path.insert(0, MANAGER_DIR)
+os.environ["PYTHONPATH"] = MANAGER_DIR + os.pathsep + os.environ.get("PYTHONPATH", "")
+
+import local_repo_manager
+from local_repo_manager import ingest, util
+from local_repo_manager.build import get_packages
+from local_repo_manager.index import FilesIndex, get_index_file
+from local_repo_manager.query import find_dependents, find_owners, search_files
+from local_repo_manager.repo import get_repo, pacman_ver_compare, parse_evr
+from local_repo_manager.repodb import get_files_db, write_db
+from local_repo_manager.srcinfo import get_packages_from_srcinfo, parse_srcinfo
+
+BENCHMARKS = ("vercmp", "vercmp-process", "get-repo", "query", "srcinfo", "get-packages", "update")
+
+# Configuration used for the update benchmark; everything that needs root or network
+# (mirrors, build layer, pacman cache) is disabled, and the remote hosts (if any) use the same configuration
+UPDATE_CONFIG = """[Paths]
+repository_dir: {directory}/repo
+repository_file: ${{repository_dir}}/bench.db.tar.gz
+packages_dir: {directory}/packages
+log_dir: {directory}/logs
+pacman_cache_dir:
+
+[Build]
+nspawn_params:
+repository_writer: {writer}
+stream_artifacts: {stream}
+build_hosts: {hosts}
+remote_manager: {standins}/local-repo-manager
+remote_config: {directory}/local-repo.conf
+ssh_params:
+"""
+
+# Variants of the update benchmark; repository writer, artifact streaming and build hosts
+# (with the builds spread across this host and localhost, reached through stand-in ssh)
+UPDATE_VARIANTS = (
+	("native", "yes", "local"),
+	("native", "no", "local"),
+	("repo-add", "yes", "local"),
+	("repo-add", "no", "local"),
+	("native", "yes", "local, localhost")
+)
+
+# GENERATING SYNTHETIC DATA
+# =========================
+
+def get_version(rng):
+	version = "{0}.{1}.{2}".format(rng.randint(0, 30), rng.randint(0, 99), rng.randint(0, 999))
+	if rng.random() < 0.1:
+		version += rng.choice(("alpha", "beta", "rc", "pre")) + str(rng.randint(1, 9))
+	if rng.random() < 0.1:
+		version += ".r{0}.g{1:07x}".format(rng.randint(1, 5000), rng.getrandbits(28))
+	if rng.random() < 0.05:
+		version = "{0}:{1}".format(rng.randint(1, 3), version)
+	return "{0}-{1}".format(version, rng.randint(1, 5))
+
+def get_desc(name, version, rng):
+	fields = (
+		("FILENAME", [f"{name}-{version}-x86_64.pkg.tar.zst"]),
+		("NAME", [name]),
+		("BASE", [name]),
+		("VERSION", [version]),
+		("DESC", [f"Synthetic package {name}"]),
+		("CSIZE", [str(rng.randint(1 << 10, 1 << 26))]),
+		("ISIZE", [str(rng.randint(1 << 12, 1 << 28))]),
+		("SHA256SUM", ["{0:064x}".format(rng.getrandbits(256))]),
+		("ARCH", ["x86_64"]),
+		("BUILDDATE", [str(rng.randint(1500000000, 1700000000))]),
+		("DEPENDS", [f"dependency{rng.randint(0, 500)}>=1.0" for _ in range(rng.randint(0, 6))])
+	)
+	return "".join("%{0}%\n{1}\n\n".format(field, "\n".join(values)) for field, values in fields if values).encode("utf8")
+
+def get_files(name, rng):
+	files = ["usr/", "usr/bin/", f"usr/bin/{name}", "usr/lib/", f"usr/lib/{name}/", f"usr/share/licenses/{name}/LICENSE"]
+	files.extend(f"usr/lib/{name}/module{x}.so" for x in range(rng.randint(0, 20)))
+	if rng.random() < 0.05:
+		files.extend(f"usr/lib/modules/6.1.0/extra/{name}-driver{x}.ko.zst" for x in range(rng.randint(1, 5)))
+	return ("%FILES%\n" + "".join(x + "\n" for x in sorted(files))).encode("utf8")
+
+def write_repository(repository_file, size, seed=0, with_files=False):
+
+	"""
+	Writes the synthetic repository database with given number of entries;
+	one in twenty packages has an older version of itself in the database as well,
+	so that the versions need to be sorted when reading the repository.
+	With with_files set, the files database (with synthetic lists of files) is written as well.
+	"""
+
+	rng = random.Random(seed)
+	entries = {}
+	files_entries = {}
+	mtime = int(time.time())
+	while len(entries) < size:
+		name = f"package{len(entries)}"
+		for _ in range(2 if rng.random() < 0.05 else 1):
+			version = get_version(rng)
+			desc = get_desc(name, version, rng)
+			entries[f"{name}-{version}"] = (mtime, {"desc": desc})
+			if with_files:
+				files_entries[f"{name}-{version}"] = (mtime, {"desc": desc, "files": get_files(name, rng)})
+	write_db(repository_file, dict(list(entries.items())[:size]))
+	if with_files:
+		write_db(get_files_db(repository_file), dict(list(files_entries.items())[:size]))
+
+def get_srcinfo(name, rng, split=1):
+	lines = [
+		f"pkgbase = {name}",
+		f"\tpkgdesc = Synthetic package {name}",
+		"\tpkgver = {0}.{1}.{2}".format(rng.randint(0, 30), rng.randint(0, 99), rng.randint(0, 999)),
+		f"\tpkgrel = {rng.randint(1, 5)}",
+		"\tarch = x86_64",
+		"\tlicense = GPL"
+	]
+	if rng.random() < 0.1:
+		lines.append(f"\tepoch = {rng.randint(1, 3)}")
+	lines.extend(f"\tmakedepends = dependency{rng.randint(0, 500)}" for _ in range(rng.randint(0, 8)))
+	lines.extend(f"\tdepends = dependency{rng.randint(0, 500)}>=1.0" for _ in range(rng.randint(0, 8)))
+	lines.extend(f"\tsource = https://example.invalid/{name}/source{x}.tar.gz" for x in range(rng.randint(1, 4)))
+	lines.extend("\tsha256sums = {0:064x}".format(rng.getrandbits(256)) for _ in range(rng.randint(1, 4)))
+	for index in range(split):
+		lines.extend(("", f"pkgname = {name}" if index == 0 else f"pkgname = {name}-split{index}"))
+		if index:
+			lines.append(f"\tdepends = {name}")
+	return "\n".join(lines) + "\n"
+
+def write_packages_dir(packages_dir, count, seed=0, upstream_dir=None):
+
+	"""
+	Fills the packages directory with given number of synthetic packages, each with
+	preparation script cloning its upstream repository, and pre-generated .SRCINFO,
+	read by stand-in makepkg in place of PKGBUILD. Without upstream_dir, the repositories
+	don't exist, and .SRCINFO is kept within the packages directory itself; otherwise,
+	local git repositories (holding .SRCINFO, and placeholder PKGBUILD) are created there, for the builds to clone.
+	"""
+
+	rng = random.Random(seed)
+	os.makedirs(packages_dir, exist_ok=True)
+	for index in range(count):
+		name = f"package{index}"
+		package_dir = os.path.join(packages_dir, name)
+		os.makedirs(package_dir, exist_ok=True)
+		srcinfo = get_srcinfo(name, rng, split=2 if rng.random() < 0.1 else 1)
+		if upstream_dir is None:
+			with open(os.path.join(package_dir, "prepare.sh"), mode="wt", encoding="utf8") as fp:
+				fp.write(f"#!/bin/bash\nset -e\ngit clone https://example.invalid/{name}.git .\n")
+			with open(os.path.join(package_dir, ".SRCINFO"), mode="wt", encoding="utf8") as fp:
+				fp.write(srcinfo)
+			continue
+
+		repository = os.path.join(upstream_dir, name)
+		os.makedirs(repository, exist_ok=True)
+		with open(os.path.join(repository, ".SRCINFO"), mode="wt", encoding="utf8") as fp:
+			fp.write(srcinfo)
+		with open(os.path.join(repository, "PKGBUILD"), mode="wt", encoding="utf8") as fp:
+			fp.write("# Synthetic package, built by stand-in makepkg from its .SRCINFO:\n")
+			fp.write("".join(f"# {line}\n" for line in srcinfo.splitlines()))
+		for command in (["init", "-q"], ["add", ".SRCINFO", "PKGBUILD"], ["commit", "-q", "-m", "Synthetic package"]):
+			subprocess.run(
+				["git", "-c", "user.name=Benchmark", "-c", "user.email=benchmark@localhost"] + command,
+				cwd=repository, check=True, capture_output=True
+			)
+		with open(os.path.join(package_dir, "prepare.sh"), mode="wt", encoding="utf8") as fp:
+			fp.write(f"#!/bin/bash\nset -e\ngit clone -q file://{repository} .\n")
+
+# MEASUREMENT
+# ===========
+
+def measure(name, params, ops, function, setup=None, repeat=5):
+
+	"""
+	Runs the function given number of times (with setup before each run, excluded from timing)
+	and records the best and median run times. Peak memory is measured in a separate run,
+	as tracing the allocations slows the function down considerably.
+	"""
+
+	times = []
+	for _ in range(repeat):
+		if setup:
+			setup()
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+
+	if setup:
+		setup()
+	tracemalloc.start()
+	try:
+		function()
+		_, peak_memory = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+
+	result = {
+		"name": name,
+		"params": params,
+		"ops": ops,
+		"best_seconds": min(times),
+		"median_seconds": statistics.median(times),
+		"ops_per_sec": ops / min(times) if min(times) else None,
+		"peak_memory_bytes": peak_memory
+	}
+	print("{0:<16} {1:<56} {2:>14.1f} ops/s {3:>10.1f} KiB".format(
+		name, json.dumps(params), result["ops_per_sec"] or 0, peak_memory / 1024
+	), file=sys.stderr)
+	return result
+
+def bench_vercmp(args, work_dir):
+	rng = random.Random(args.seed)
+	pairs = [(get_version(rng), get_version(rng)) for _ in range(args.vercmp_pairs)]
+
+	def compare_cold():
+		pacman_ver_compare.cache_clear()
+		parse_evr.cache_clear()
+		for one, two in pairs:
+			pacman_ver_compare(one, two)
+
+	def compare_warm():
+		for one, two in pairs:
+			pacman_ver_compare(one, two)
+
+	yield measure("vercmp", {"pairs": len(pairs), "cache": "cold"}, len(pairs), compare_cold, repeat=args.repeat)
+	yield measure("vercmp", {"pairs": len(pairs), "cache": "warm"}, len(pairs), compare_warm, setup=compare_warm, repeat=args.repeat)
+
+def bench_vercmp_process(args, work_dir):
+	rng = random.Random(args.seed)
+	pairs = [(get_version(rng), get_version(rng)) for _ in range(50)]
+	command = os.path.join(STANDINS_DIR, "vercmp")
+
+	def compare():
+		for one, two in pairs:
+			subprocess.run([command, one, two], check=True, capture_output=True)
+
+	yield measure("vercmp-process", {"pairs": len(pairs)}, len(pairs), compare, repeat=min(args.repeat, 3))
+
+def bench_get_repo(args, work_dir):
+	for size in args.sizes:
+		repository_file = os.path.join(work_dir, f"repo{size}", "bench.db.tar.xz")
+		os.makedirs(os.path.dirname(repository_file), exist_ok=True)
+		write_repository(repository_file, size, seed=args.seed)
+
+		def remove_index():
+			if os.path.exists(get_index_file(repository_file)):
+				os.unlink(get_index_file(repository_file))
+
+		def read():
+			get_repo(repository_file)
+
+		yield measure("get-repo", {"entries": size, "index": "cold"}, size, read, setup=remove_index, repeat=args.repeat)
+		yield measure("get-repo", {"entries": size, "index": "warm"}, size, read, setup=read, repeat=args.repeat)
+		shutil.rmtree(os.path.dirname(repository_file))
+
+def bench_query(args, work_dir):
+	for size in args.sizes:
+		repository_file = os.path.join(work_dir, f"files{size}", "bench.db.tar.xz")
+		files_db = get_files_db(repository_file)
+		os.makedirs(os.path.dirname(repository_file), exist_ok=True)
+		write_repository(repository_file, size, seed=args.seed, with_files=True)
+		rng = random.Random(args.seed)
+		names = [f"package{rng.randrange(size)}" for _ in range(100)]
+
+		def remove_index():
+			if os.path.exists(get_index_file(files_db)):
+				os.unlink(get_index_file(files_db))
+
+		def refresh():
+			with FilesIndex(files_db):
+				pass
+
+		def owns():
+			with FilesIndex(files_db) as index:
+				for name in names:
+					find_owners(index, f"{name}/module0.so")
+
+		def search():
+			with FilesIndex(files_db) as index:
+				search_files(index, "*.ko*")
+
+		def rdepends():
+			with FilesIndex(files_db) as index:
+				for name in names:
+					find_dependents(index, name.replace("package", "dependency"))
+
+		yield measure("query", {"entries": size, "lookup": "index-cold"}, size, refresh, setup=remove_index, repeat=min(args.repeat, 3))
+		yield measure("query", {"entries": size, "lookup": "owns"}, len(names), owns, setup=refresh, repeat=args.repeat)
+		yield measure("query", {"entries": size, "lookup": "search"}, 1, search, setup=refresh, repeat=args.repeat)
+		yield measure("query", {"entries": size, "lookup": "rdepends"}, len(names), rdepends, setup=refresh, repeat=args.repeat)
+		shutil.rmtree(os.path.dirname(repository_file))
+
+def bench_srcinfo(args, work_dir):
+	for count in args.packages:
+		rng = random.Random(args.seed)
+		texts = [get_srcinfo(f"package{x}", rng, split=2 if rng.random() < 0.1 else 1) for x in range(count)]
+
+		def parse():
+			for text in texts:
+				get_packages_from_srcinfo(parse_srcinfo(text))
+
+		yield measure("srcinfo", {"files": count}, count, parse, repeat=args.repeat)
+
+def bench_get_packages(args, work_dir):
+	for count in args.packages:
+		packages_dir = os.path.join(work_dir, f"packages{count}")
+		write_packages_dir(packages_dir, count, seed=args.seed)
+		yield measure("get-packages", {"packages": count}, count, lambda: get_packages(packages_dir), repeat=args.repeat)
+		shutil.rmtree(packages_dir)
+
+def bench_update(args, work_dir):
+
+	"""
+	Runs the full `update` action in-process, with stand-in executables found first on the PATH,
+	and the absolute paths used by the manager redirected to them. Bind mounting the root directory
+	for the container is skipped (stand-in nspawn doesn't use it), as are the checks for the files
+	being on the root partition.
+	"""
+
+	def redirect(command, *args, **kwargs):
+		standin = os.path.join(STANDINS_DIR, os.path.basename(command[0]))
+		if os.path.isfile(standin):
+			command = [standin] + list(command[1:])
+		return subprocess.run(command, *args, **kwargs)
+
+	original = (ingest.run_measured, util.bind_mount, util.bind_unmount, local_repo_manager.on_root_mount, dict(os.environ), sys.argv)
+	ingest.run_measured = redirect
+	util.bind_mount = util.bind_unmount = lambda *args: None
+	local_repo_manager.on_root_mount = lambda path: True
+	os.environ["PATH"] = STANDINS_DIR + os.pathsep + os.environ.get("PATH", "")
+	os.environ["LRM_BENCH_BUILD_SECONDS"] = str(args.build_seconds)
+
+	try:
+		for count in args.update_packages:
+			for writer, stream, hosts in UPDATE_VARIANTS:
+				directory = os.path.join(work_dir, "update{0}-{1}-{2}-{3}".format(count, writer, stream, hosts.count(",") + 1))
+				for subdirectory in ("repo", "logs"):
+					os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+				write_packages_dir(
+					os.path.join(directory, "packages"), count, seed=args.seed, upstream_dir=os.path.join(directory, "upstream")
+				)
+				config_file = os.path.join(directory, "local-repo.conf")
+				with open(config_file, mode="wt", encoding="utf8") as fp:
+					fp.write(UPDATE_CONFIG.format(directory=directory, writer=writer, stream=stream, hosts=hosts, standins=STANDINS_DIR))
+
+				timings_file = os.path.join(directory, "timings.jsonl")
+				os.environ["LRM_BENCH_TIMINGS"] = timings_file
+				runs = []
+
+				def reset():
+					shutil.rmtree(os.path.join(directory, "repo"))
+					os.makedirs(os.path.join(directory, "repo"))
+					if os.path.exists(timings_file):
+						os.unlink(timings_file)
+
+				# Containers (one per build host) run concurrently, so the builds (recorded by stand-in makepkg)
+				# are summed up, while the time of the containers themselves is that of the longest one
+				def update():
+					sys.argv = [os.path.join(MANAGER_DIR, "cli.py"), "--config", config_file, "update"]
+					with open(os.devnull, mode="wt") as devnull, redirect_stdout(devnull):
+						start = time.perf_counter()
+						local_repo_manager.main()
+						total = time.perf_counter() - start
+					with open(timings_file, mode="rt", encoding="utf8") as fp:
+						timings = [json.loads(line) for line in fp]
+					runs.append({
+						"build": sum(x["build"] for x in timings if "build" in x),
+						"container": max(x["container"] for x in timings if "container" in x),
+						"total": total
+					})
+
+				params = {"packages": count, "writer": writer, "stream": stream}
+				if hosts != "local":
+					params["hosts"] = hosts
+				result = measure("update", params, count, update, setup=reset, repeat=args.update_repeat)
+				runs = runs[:args.update_repeat]
+				result["build_seconds"] = statistics.median(x["build"] for x in runs)
+				result["container_seconds"] = statistics.median(x["container"] for x in runs)
+				result["orchestration_seconds"] = statistics.median(x["total"] - x["build"] for x in runs)
+				result["children_max_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+				yield result
+				shutil.rmtree(directory)
+	finally:
+		ingest.run_measured, util.bind_mount, util.bind_unmount, local_repo_manager.on_root_mount, environ, sys.argv = original
+		os.environ.clear()
+		os.environ.update(environ)
+
+def compare_results(results, baseline_file):
+	with open(baseline_file, mode="rt", encoding="utf8") as fp:
+		baseline = dict(
+			((x["name"], json.dumps(x["params"], sort_keys=True)), x) for x in json.load(fp)["results"]
+		)
+
+	print("\nComparison with {0}:".format(baseline_file), file=sys.stderr)
+	for result in results:
+		previous = baseline.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+		if not previous or not previous["ops_per_sec"] or not result["ops_per_sec"]:
+			continue
+		print("{0:<16} {1:<56} {2:>+8.1f}% ops/s {3:>+8.1f}% memory".format(
+			result["name"], json.dumps(result["params"]),
+			100 * (result["ops_per_sec"] / previous["ops_per_sec"] - 1),
+			100 * (result["peak_memory_bytes"] / previous["peak_memory_bytes"] - 1) if previous["peak_memory_bytes"] else 0
+		), file=sys.stderr)
+
+def to_int_list(value):
+	return [int(x) for x in value.split(",") if x]
+
+def main():
+	parser = ArgumentParser(description="Benchmarks of the local repository manager", formatter_class=ArgumentDefaultsHelpFormatter)
+	parser.add_argument("--output", default="benchmark-results.json", help="File to write the results to")
+	parser.add_argument("--compare", default=None, help="Results of previous run to compare against")
+	parser.add_argument("--only", default=",".join(BENCHMARKS), help="Comma-separated list of benchmarks to run")
+	parser.add_argument("--sizes", default="100,1000,10000,50000", type=to_int_list, help="Numbers of entries in synthetic repositories")
+	parser.add_argument("--packages", default="100,1000", type=to_int_list, help="Numbers of synthetic packages and .SRCINFO files")
+	parser.add_argument("--update-packages", default="10,50", type=to_int_list, help="Numbers of packages built by update benchmark")
+	parser.add_argument("--build-seconds", default=0.0, type=float, help="Simulated build time of each package in update benchmark")
+	parser.add_argument("--vercmp-pairs", default=10000, type=int, help="Number of version pairs compared")
+	parser.add_argument("--repeat", default=5, type=int, help="Number of timed runs of each benchmark")
+	parser.add_argument("--update-repeat", default=2, type=int, help="Number of timed runs of update benchmark")
+	parser.add_argument("--seed", default=0, type=int, help="Seed for generating synthetic data")
+	args = parser.parse_args()
+
+	selected = [x for x in args.only.split(",") if x]
+	unknown = set(selected) - set(BENCHMARKS)
+	if unknown:
+		parser.error("Unknown benchmarks: {0}".format(", ".join(sorted(unknown))))
+
+	results = []
+	with TemporaryDirectory(prefix="lrm-bench-") as work_dir:
+		for name in selected:
+			results.extend(globals()["bench_" + name.replace("-", "_")](args, work_dir))
+
+	with open(args.output, mode="wt", encoding="utf8") as fp:
+		json.dump({
+			"meta": {
+				"timestamp": int(time.time()),
+				"python": platform.python_version(),
+				"platform": platform.platform(),
+				"cpu_count": os.cpu_count(),
+				"seed": args.seed
+			},
+			"results": results
+		}, fp, indent="\t")
+	print("\nResults written to {0}".format(args.output), file=sys.stderr)
+
+	if args.compare:
+		compare_results(results, args.compare)
+
+if __name__ == "__main__":
+	main()
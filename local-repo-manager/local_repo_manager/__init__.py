@@ -1,16 +1,41 @@
 #!/usr/bin/env python3
 
+from collections import deque
+from datetime import datetime
+import json
 import os.path
-from shutil import copy
-from subprocess import run, STDOUT
+import re
+import statistics
+from subprocess import STDOUT
 import sys
-import traceback
+import time
 
-from .build import get_packages, get_build_artifacts, run_within_container, build_package
+from .build import LOCAL_USER_UID, get_packages
+from .cleanup import collect_garbage, get_installed_packages
 from .config import parse_arguments, parse_config, on_root_mount
-from .log import LogToFile, LogToStdout
+from .daemon import ManagerDaemon, format_job, send_command
+from .fingerprint import FINGERPRINTS_FILE, FingerprintStore
+from .history import BuildHistory, get_regressions, max_known
+from .index import FilesIndex
+from .jobserver import Jobserver, get_job_slots
+from .log import TAIL_LINES, get_log_index, read_log, select_logs
+from .makepkg import MakepkgConfig
+from .mirror import get_mirror_env
+from .outdated import check_packages
+from .placement import BuildPlacement, format_size
+from .query import find_dependents, find_owners, list_files, search_files
 from .repo import get_repo
-from .util import TempDirectory, custom_exception_handler
+from .repodb import get_files_db
+from .schedule import build_packages
+from .sources import SourceCache
+from .srcinfo import SrcinfoCache, get_packages_from_srcinfo
+from .state import TREES_DIR, BuildTrees, get_resumable
+from .timing import TIMINGS, TIMINGS_FILE, run_measured
+from .update import run_execute, run_update
+from .util import TempDirectory, custom_exception_handler, format_duration
+
+# Exit status of the outdated action on errors (see main)
+OUTDATED_ERROR_STATUS = 255
 
 def main():
 
@@ -24,9 +49,26 @@ def main():
 
 	# ARGUMENT PARSING AND VALIDATION
 	# ===============================
-	# These two lines obtain the arguments from the command line (validation done by ArgumentParser),
-	# then the configuration file is parsed (validation of its options done by the method).
+	# This line obtains the arguments from the command line (validation done by ArgumentParser),
+	# the configuration file is parsed by the action itself (validation of its options done by the method).
 	args = parse_arguments(sys.argv[1:])
+
+	# Any error of the outdated action exits with status 255 rather than 1, as it runs as ExecCondition
+	# of the service, which skips the update on statuses 1-254; failing check must fail the unit instead
+	# of being mistaken for "nothing pending" (status 2).
+	if args.action == "outdated":
+		try:
+			run_action(args)
+		except SystemExit:
+			raise
+		except BaseException:
+			sys.excepthook(*sys.exc_info())
+			sys.exit(OUTDATED_ERROR_STATUS)
+	else:
+		run_action(args)
+
+def run_action(args):
+
 	config = parse_config(args.config_file)
 
 	# This bit is needed due to the fact that nspawn container's overlay FS does not span multiple
@@ -58,9 +100,11 @@ def main():
 	# Iterates over all the entries in the packages direcotry, and lists them,
 	# along with git repositories they originate from. For ones that don't have
 	# valid preparation script or don't have the repo, it'll provide warning line.
+	# If the package has been prepared before, its last known versions are listed as well.
 	elif args.action == "list":
 
 		packages = get_packages(config["packages_dir"])
+		srcinfo_cache = SrcinfoCache(config["srcinfo_cache_dir"]) if config["srcinfo_cache_dir"] else None
 		if not len(packages):
 			print("No packages currently handled by the manager")
 		else:
@@ -68,6 +112,10 @@ def main():
 			print("Following packages are handled by the manager:\n")
 			for name, repo in packages.items():
 				print("  {0}: ".format(name).ljust(max_key_length + 4), repo if repo else "[NO REPOSITORY IDENTIFIED]")
+				srcinfo = srcinfo_cache.get_latest(name) if srcinfo_cache else None
+				if srcinfo:
+					for package, version in get_packages_from_srcinfo(srcinfo).items():
+						print(" " * (max_key_length + 5), f"{package} {version}")
 			print("")
 
 	# LISTING PACKAGES IN LOCAL REPO
@@ -85,6 +133,190 @@ def main():
 				print("  {0}: ".format(name).ljust(max_key_length + 4), versions[0])
 			print("")
 
+	# QUERYING CONTENTS OF LOCAL REPO
+	# Files and dependencies of the packages are looked up in the index of the repository's files database,
+	# which is refreshed whenever the repository changes, so the queries don't need to read the database itself.
+	# Exits with status 1 if nothing was found, like `pacman -F` does.
+	elif args.action == "query":
+
+		with FilesIndex(get_files_db(config["repository_file"])) as index:
+			if args.owns:
+				results = find_owners(index, args.owns)
+			elif args.search:
+				results = search_files(index, args.search)
+			elif args.files:
+				results = list_files(index, args.files)
+			else:
+				results = find_dependents(index, args.rdepends)
+
+		if args.json:
+			print(json.dumps(results, indent="\t"))
+		elif args.owns:
+			for result in results:
+				print("{0} is owned by {1} {2}".format(result["path"], result["name"], result["version"]))
+		elif args.rdepends:
+			for result in results:
+				print("{0} {1} ({2}: {3})".format(result["name"], result["version"], result["kind"], result["depend"]))
+		else:
+			for result in results:
+				print("{0} {1}".format(result["name"], result["path"]))
+
+		if not results:
+			sys.exit(1)
+
+	# CHECKING FOR PENDING UPDATES
+	# Quick check on the host of which packages would be rebuilt by the update, based on upstream
+	# repositories and the fingerprints of the last builds, without preparing any of the packages.
+	# The exit status tells whether there are any pending updates (0) or not (2), so that
+	# the scheduled update can be skipped altogether when there's nothing to do; errors exit with 255.
+	elif args.action == "outdated":
+
+		start = time.monotonic()
+		results = check_packages(
+			config["packages_dir"], get_packages(config["packages_dir"]),
+			get_repo(config["repository_file"]),
+			FingerprintStore(os.path.join(config["repository_dir"], FINGERPRINTS_FILE)),
+			srcinfo_cache=SrcinfoCache(config["srcinfo_cache_dir"]) if config["srcinfo_cache_dir"] else None,
+			mirror_dir=config["mirror_dir"] or None, jobs=args.jobs
+		)
+
+		if not args.quiet:
+			max_key_length = max([len(x["item"]) for x in results] + [7])
+			max_version_length = max([len(x[key] or "-") for x in results for key in ("current", "available")] + [9])
+			print("  {0}  {1}  {2}  {3}".format(
+				"PACKAGE".ljust(max_key_length), "CURRENT".ljust(max_version_length), "AVAILABLE".ljust(max_version_length), "STATUS"
+			))
+			for result in results:
+				print("{0} {1}  {2}  {3}  {4}".format(
+					"*" if result["pending"] else " ", result["item"].ljust(max_key_length),
+					(result["current"] or "-").ljust(max_version_length), (result["available"] or "-").ljust(max_version_length),
+					result["status"]
+				))
+			print("\n{0} of {1} package(s) pending an update (checked in {2:.1f}s)".format(
+				sum(x["pending"] for x in results), len(results), time.monotonic() - start
+			))
+
+		if not any(x["pending"] for x in results):
+			sys.exit(2)
+
+	# REMOVING OLD VERSIONS OF PACKAGES
+	# Package files of all but the few newest versions of each package are removed from the repository
+	# directory, except for the ones installed on the host; with dry run, only the report is shown.
+	elif args.action == "gc":
+
+		keep_versions = args.keep if args.keep is not None else config["gc_keep_versions"]
+		if keep_versions < 1:
+			raise RuntimeError("At least one version of each package has to be kept")
+		removed, reclaimed = collect_garbage(
+			config["repository_dir"], config["repository_file"], keep_versions,
+			get_installed_packages(), dry_run=args.dry_run
+		)
+		for filename in removed:
+			print("{0} {1}".format("Would remove" if args.dry_run else "Removed", os.path.basename(filename)))
+		print("\n{0} file(s), {1:.1f} MiB {2}".format(
+			len(removed), reclaimed / 1048576, "would be reclaimed" if args.dry_run else "reclaimed"
+		))
+
+	# SHOWING BUILD LOGS
+	# Logs of each run are split per package and compressed, so the index is consulted first,
+	# and only the logs of selected package (or the main build log) in selected runs are read.
+	# Last lines of each log are kept in the index, so tailing doesn't need to decompress anything.
+	elif args.action == "logs":
+
+		index = get_log_index(config["log_dir"])
+		logs = select_logs(index, package=args.package, run=args.run, all_runs=args.all_runs)
+		if not logs:
+			print("No build logs found")
+
+		pattern = re.compile(args.grep) if args.grep else None
+		for run, entry in logs:
+			path = os.path.join(config["log_dir"], run, entry["file"])
+			if pattern:
+				for line in read_log(path):
+					if pattern.search(line):
+						print(f"{run}/{entry['file']}: {line}", end="")
+			elif args.tail is not None and (args.tail <= TAIL_LINES or entry["lines"] <= TAIL_LINES):
+				print(f"==> {run}/{entry['file']} <==")
+				for line in entry["tail"][-args.tail:] if args.tail else ():
+					print(line)
+			else:
+				print(f"==> {run}/{entry['file']} ({entry['lines']} lines, {entry['first']} - {entry['last']}) <==")
+				lines = deque(read_log(path), maxlen=args.tail) if args.tail else read_log(path)
+				for line in lines:
+					print(line, end="")
+
+	# SHOWING BUILD STATISTICS
+	# Based on the timings recorded in the build history, shows the durations of recent runs,
+	# the phases taking the most time on average, and the phases of the latest run
+	# which took considerably longer than they usually do.
+	elif args.action == "stats":
+
+		if not config["history_file"] or not os.path.isfile(config["history_file"]):
+			raise RuntimeError("No build history has been recorded yet")
+
+		with BuildHistory(config["history_file"]) as history:
+			runs = history.get_runs(args.runs)
+			phases = history.get_phases([x[0] for x in runs], package=args.package) if runs else {}
+		if not runs:
+			raise RuntimeError("No runs recorded in the build history")
+
+		print("Recent runs:\n")
+		for run, started, finished, status in runs:
+			print("  {0:%Y-%m-%d %H:%M}  {1:>10}  {2}".format(datetime.fromtimestamp(started), format_duration(finished - started), status))
+
+		print("\nSlowest phases (average over recent runs):\n")
+		averages = sorted(
+			((package, phase, statistics.mean(x[0] for x in values.values()), statistics.mean(x[1] for x in values.values()), max_known(x[2] for x in values.values()))
+			for (package, phase), values in phases.items()),
+			key=lambda x: x[2], reverse=True
+		)
+		for package, phase, wall, cpu, max_rss in averages[:10]:
+			print("  {0:<40} {1:>10} wall {2:>10} CPU {3:>12} peak".format(
+				f"{package}: {phase}" if package else phase, format_duration(wall), format_duration(cpu),
+				"{0:.0f} MiB".format(max_rss / 1048576) if max_rss is not None else "-"
+			))
+
+		regressions = get_regressions(phases, runs[-1][0], threshold=args.threshold)
+		print("\nRegressions in the latest run:\n")
+		if not regressions:
+			print("  None")
+		for package, phase, median, wall in regressions:
+			print("  {0:<40} {1:>10} (usually {2})".format(f"{package}: {phase}" if package else phase, format_duration(wall), format_duration(median)))
+		print("")
+
+	# RUNNING AS DAEMON
+	# Instead of checking all the packages on schedule, the daemon watches the packages directory
+	# and queues the packages whose scripts or patches have changed; jobs can also be queued,
+	# inspected and cancelled through the control socket (with the actions below).
+	elif args.action == "daemon":
+
+		ManagerDaemon(config).run()
+
+	elif args.action == "enqueue":
+
+		job = send_command(
+			config["control_socket"], "enqueue", packages=sorted(set(args.packages)) or None,
+			force=args.force, reason="command line"
+		)
+		print(f"Queued as job {job['id']}:\n")
+		print(format_job(job))
+
+	elif args.action == "jobs":
+
+		status = send_command(config["control_socket"], "status")
+		jobs = send_command(config["control_socket"], "jobs")
+		print("Daemon (PID {0}) running since {1:%Y-%m-%d %H:%M}, {2} package(s) in the local repository\n".format(
+			status["pid"], datetime.fromtimestamp(status["started"]), len(status["repository"])
+		))
+		if not jobs:
+			print("No jobs queued yet")
+		for job in jobs:
+			print(format_job(job))
+
+	elif args.action == "cancel":
+
+		print(format_job(send_command(config["control_socket"], "cancel", id=args.job_id)))
+
 	# SCHEDULING UPDATE OF ALL THE PACKAGES
 	# Main and most complex part of the manager, this code sets up the nspawn container
 	# along with temporary directory to bind as target for build artifacts, then runs
@@ -93,58 +325,33 @@ def main():
 	# If there was a failure, none of the packages are added and the user is prompted
 	# to check the logs and resolve the issue.
 	# If it was successful, then the new packages (if there are any, we don't rebuild
-	# if the package is not newer than what's in local repository) are copied to repository
+	# if the package is not newer than what's in local repository) are moved to repository
 	# directory and added to the repo DB.
+	# With artifact streaming enabled, each package is moved and added as soon as it's built instead,
+	# so the packages built before any failure still make it into the repository.
 	elif args.action == "update":
 
-		print("Setting up container to build new packages in...")
-		with TempDirectory() as pkgdest:
-
-			# We run python3 via env as nspawn expects actual binary,
-			# and the manager is a Python script; we pass through config
-			# location and provide package destination directory.
-			container_args = [
-				"/usr/bin/env", "python3", os.path.abspath(sys.argv[0]),
-				"--config", args.config_file, "build", "--pkgdest", pkgdest
-			]
-
-			# Should any issues occur during the build process, we make sure to print
-			# all the exception details into whatever the log target is (terminal or file),
-			# and raise known RuntimeError - this is to prevent spamming systemd journals
-			# when update is executed from the timer.
-			try:
-
-				with (LogToFile(config["log_dir"]) if args.logging else LogToStdout()) as (fp, log_dest):
-					print(f"(build process will be logged to {log_dest})\n")
-					try:
-						run_within_container(container_args, pkgdest, extra_params=config["nspawn_params"], log_output=fp)
-					except Exception as e:
-						traceback.print_exception(*sys.exc_info(), file=fp)
-						raise e
-
-			except Exception as e:
-				exc = RuntimeError("Build process has failed due to unexpected errors\nCheck the build log to investigate the cause of the issue")
-				exc.with_traceback(sys.exc_info()[2])
-				raise exc
-
-			print("\nBuild complete, temporary container terminated")
-
-			# It is possible that we have no new build artifacts even if the build process
-			# was successful, as we only build if the package is newer than what's in local repo.
-			build_artifacts = get_build_artifacts(pkgdest)
-			if not len(build_artifacts):
-				print("No new packages have been built")
-			else:
-				print("Copying artifacts to local repository directory...")
-				copied_artifacts = [copy(x, config["repository_dir"]) for x in build_artifacts]
-				print("Adding artifacts to local repository...\n")
-				run(
-					["/usr/bin/repo-add", "--new", config["repository_file"]] + copied_artifacts,
-					check=True, stdout=sys.stdout, stderr=sys.stderr
-				)
+		run_update(
+			config, packages=args.packages, force=args.force, logging=args.logging,
+			fresh=args.fresh
+		)
+
+	# BUILDING FOR ANOTHER HOST
+	# With the builds spread across several hosts, the update running on one of them asks the others
+	# (over SSH) for their capacity, then ships the packages placed on them to be built with `execute` action;
+	# they're built here the same way the update builds them, but the artifacts are left for the other host
+	# to collect, rather than added to the repository.
+	elif args.action == "capacity":
+
+		slots, cpus, memory = get_job_slots(config["memory_per_job"], max_jobs=config["build_jobs"])
+		print(json.dumps({"slots": slots, "cpus": cpus, "memory": memory}))
 
-				print("\nNew packages added to the repository")
-				print("Run pacman -Syyu to install them")
+	elif args.action == "execute":
+
+		run_execute(
+			config, args.pkgdest, args.packages_dir, args.packages,
+			force=args.force
+		)
 
 	# BUILD PACKAGES
 	# This action conducts the actual build process for all the packages.
@@ -152,28 +359,97 @@ def main():
 	# and shouldn't be run directly on the host system.
 	elif args.action == "build":
 
-		# We override the sudoers file within the container to allow the non-root user to
-		# use sudo for root operations without having to provide password (primarily for
-		# installing dependencies for makepkg)
-		print("Configuring sudo permissions...")
-		with open("/etc/sudoers", mode="wt", encoding="utf8") as fp:
-			print("ALL ALL=(ALL) NOPASSWD: ALL", file=fp)
+		# The container is only set up when the build runs within it (rather than with local executor)
+		if not args.no_setup:
+
+			# We override the sudoers file within the container to allow the non-root user to
+			# use sudo for root operations without having to provide password (primarily for
+			# installing dependencies for makepkg)
+			print("Configuring sudo permissions...")
+			with open("/etc/sudoers", mode="wt", encoding="utf8") as fp:
+				print("ALL ALL=(ALL) NOPASSWD: ALL", file=fp)
+
+			# We're running the nspawn container without systemd init,
+			# so whatever the network interface is, it will need to be initialised and configured
+			# manually, via dhclient command.
+			print("Configuring internal network connection...")
+			with TIMINGS.phase("dhclient"):
+				run_measured(["/usr/bin/dhclient", "host0"], check=True, stdout=sys.stdout, stderr=STDOUT)
 
-		# We're running the nspawn container without systemd init,
-		# so whatever the network interface is, it will need to be initialised and configured
-		# manually, via dhclient command.
-		print("Configuring internal network connection...")
-		run(["/usr/bin/dhclient", "host0"], check=True, stdout=sys.stdout, stderr=STDOUT)
+		# Packages shipped from another host are built from where they've been shipped to
+		if args.packages_dir:
+			config["packages_dir"] = args.packages_dir
 
 		print("Retrieving package info from local repository...")
-		repo = get_repo(config["repository_file"])
+		with TIMINGS.phase("get-repo"):
+			repo = get_repo(config["repository_file"])
+
+		# We skip over the packages that don't have valid source, and the ones not selected (if any were)
+		packages = get_packages(config["packages_dir"])
+		packages_to_build = tuple(sorted(
+			key for (key, item) in packages.items() if item and (args.packages is None or key in args.packages)
+		))
 
-		# We skip over the packages that don't have valid source
-		packages_to_build = tuple(key for (key, item) in get_packages(config["packages_dir"]).items() if item)
-		print("Will build following packages:")
+		# All the git operations (be it in preparation scripts or checking for upstream changes)
+		# are redirected to local mirrors, wherever they're available
+		if config["mirror_dir"]:
+			os.environ.update(get_mirror_env(config["mirror_dir"], set(x for x in packages.values() if x)))
+		print("Will check following packages:")
 		for item in packages_to_build:
 			print(f"* {item}")
 
-		for item in packages_to_build:
-			print(f"\nBUILD FOR {item}\n===========================")
-			build_package(repo, os.path.join(config["packages_dir"], item), args.pkgdest)
+		# Fingerprints of packages checked or built in this run are saved next to the artifacts,
+		# even if the build fails; they only get merged into the store by the update action
+		fingerprints = FingerprintStore(os.path.join(config["repository_dir"], FINGERPRINTS_FILE))
+		with TempDirectory() as makepkg_dir:
+
+			# Any overrides to makepkg configuration (like package format) are written
+			# into separate config file, to avoid changing the host one
+			makepkg_config = MakepkgConfig(makepkg_dir)
+			if config["package_format"]:
+				makepkg_config.set_compression(
+					config["package_format"],
+					level=config["compression_level"] or None,
+					threads=config["compression_threads"] or None
+				)
+			if config["ccache_dir"]:
+				makepkg_config.set_ccache(config["ccache_dir"], max_size=config["ccache_size"] or None)
+
+			# Memory for the tmpfs of the largest builds which can run at the same time is set aside first,
+			# then all the makes started by the builds share single jobserver, sized so that the CPUs
+			# are kept busy without running out of the rest of memory (taking container's limits into account)
+			placement = BuildPlacement(config["build_placement"], min_free=config["tmpfs_min_free"], uid=LOCAL_USER_UID)
+			reserved = placement.reserve([fingerprints.get_build_size(x) for x in packages_to_build], concurrent=config["parallel_builds"])
+			slots, cpus, memory = get_job_slots(config["memory_per_job"], max_jobs=config["build_jobs"], reserved=reserved)
+			print("Sharing {0} job slot(s) between the builds ({1} CPU(s), {2} available memory, {3} reserved for tmpfs)".format(
+				slots, cpus, "{0:.1f} GiB".format(memory / (1 << 30)) if memory is not None else "unknown", format_size(reserved)
+			))
+			with Jobserver(makepkg_dir, slots, concurrent=config["parallel_builds"], uid=LOCAL_USER_UID) as makeflags:
+				makepkg_config.set_makeflags(makeflags)
+
+				# Sources downloaded by the builds are kept in the persistent cache, which is trimmed
+				# to its size limit once they're done (whether they've succeeded or not)
+				source_cache = SourceCache(
+					config["source_cache_dir"], max_size=config["source_cache_size"], uid=LOCAL_USER_UID
+				) if config["source_cache_dir"] else None
+
+				# Packages are built in order of their dependencies on each other,
+				# with the independent ones built concurrently (up to configured limit)
+				try:
+					build_packages(
+						repo, config["packages_dir"], packages_to_build, args.pkgdest, fingerprints,
+						build_env=makepkg_config.write(uid=LOCAL_USER_UID),
+						srcinfo_cache=SrcinfoCache(config["srcinfo_cache_dir"]) if config["srcinfo_cache_dir"] else None,
+						parallel_builds=config["parallel_builds"], force=args.force,
+						resumable=get_resumable(args.pkgdest),
+						trees=BuildTrees(
+							os.path.join(config["state_dir"], TREES_DIR), keep=config["keep_build_trees"]
+						) if config["state_dir"] else None,
+						placement=placement,
+						source_cache=source_cache
+					)
+				finally:
+					if source_cache is not None:
+						source_cache.close()
+					fingerprints.save_pending(os.path.join(args.pkgdest, FINGERPRINTS_FILE))
+					TIMINGS.save(os.path.join(args.pkgdest, TIMINGS_FILE))
@@ -0,0 +1,47 @@
+from contextlib import contextmanager
+import subprocess
+import tarfile
+
+# Decompressors for the formats Python's tarfile module cannot read on its own
+# (used for both the packages and the repository databases)
+DECOMPRESSORS = {
+	".zst": ["zstd", "-d", "-c", "-q"],
+	".lz4": ["lz4", "-d", "-c", "-q"],
+	".lzo": ["lzop", "-d", "-c", "-q"],
+	".lrz": ["lrzip", "-d", "-q", "-o", "-"],
+	".lz": ["lzip", "-d", "-c", "-q"],
+	".Z": ["uncompress", "-c"]
+}
+
+@contextmanager
+def open_archive(filename):
+
+	"""
+	Opens the tar archive (like package or repository database) for sequential reading, piping it
+	through external decompressor for the formats not handled by tarfile module. Raises FileNotFoundError
+	if the archive doesn't exist, and RuntimeError if the decompressor fails.
+	"""
+
+	command = next((command for extension, command in DECOMPRESSORS.items() if filename.endswith(extension)), None)
+	if command is None:
+		with tarfile.open(filename, mode="r|*") as tf:
+			yield tf
+		return
+
+	with open(filename, mode="rb") as fp:
+		process = subprocess.Popen(command, stdin=fp, stdout=subprocess.PIPE)
+	try:
+		with tarfile.open(fileobj=process.stdout, mode="r|") as tf:
+			yield tf
+		# Padding after the end of the archive is read as well, so that the decompressor
+		# doesn't fail writing it into the closed pipe
+		while process.stdout.read(1 << 16):
+			pass
+	except BaseException:
+		process.kill()
+		raise
+	finally:
+		process.stdout.close()
+		status = process.wait()
+	if status != 0:
+		raise RuntimeError(f"Could not decompress {filename}")
@@ -1,18 +1,30 @@
+import filecmp
 import os
 import os.path
 import pwd
 import re
+from shutil import rmtree
+import stat
 import subprocess
 import sys
+from threading import Lock
+import time
 
+from .makepkg import get_ccache_stats
 from .repo import is_newer
+from .srcinfo import get_dependencies_from_srcinfo, get_srcinfo_key, parse_srcinfo
+from .timing import TIMINGS, run_measured
 from .util import TempDirectory
 
-MATCH_SRCINFO = re.compile(r'^\s*(epoch|pkgver|pkgrel|pkgname) = (.+)$')
-REPO_ADDRESS_GIT = re.compile(r'^(?:ssh|https?)://')
+MATCH_PACKAGE_FILE = re.compile(r'\.pkg\.tar(?:\.(?:gz|bz2|xz|zst|lzo|lrz|lz4|lz|Z))?$')
+REPO_ADDRESS_GIT = re.compile(r'^(?:ssh|https?|git|file)://')
 LOCAL_USER_UID = 1000
 RUN_AS_USER = ["/usr/bin/sudo", "-E", "-u", pwd.getpwuid(LOCAL_USER_UID).pw_name]
 
+# Only one pacman transaction can happen at a time, so with packages being built
+# concurrently, installing dependencies and build artifacts needs to be serialised
+PACMAN_LOCK = Lock()
+
 def get_packages(packages_dir):
 
 	results = {}
@@ -35,48 +47,28 @@ def get_repository(package_dir):
 				args = line.split(" ")[2:]
 				for item in args:
 					if REPO_ADDRESS_GIT.match(item):
-						return item
+						return item.strip()
 
 	return None
 
 def get_build_artifacts(directory):
 
 	"""
-	Helper method that returns the list of all .tar.xz files in given directory,
-	as full absolute paths.
+	Helper method that returns the list of all package files in given directory
+	(with any of the extensions makepkg can produce), as full absolute paths.
 	It's used several places to provide arguments to commands that run on all the packages.
 	"""
 
-	artifacts = filter(lambda x: x.endswith(".tar.xz"), os.listdir(directory))
+	artifacts = filter(MATCH_PACKAGE_FILE.search, os.listdir(directory))
 	full_paths = map(lambda x: os.path.join(directory, x), artifacts)
 	return list(full_paths)
 
-def get_packages_from_srcinfo(srcinfo):
-
-	version = {}
-	names = []
-
-	for line in srcinfo.splitlines():
-		match = MATCH_SRCINFO.match(line)
-		if match:
-			if match.group(1) == "pkgname":
-				names.append(match.group(2))
-			else:
-				version[match.group(1)] = match.group(2)
-
-	final_version = version["pkgver"]
-	if "pkgrel" in version:
-		final_version += "-" + version["pkgrel"]
-	if "epoch" in version:
-		final_version = version["epoch"] + ":" + final_version
-
-	return dict((name, final_version) for name in names)
-
-def run_within_container(command, *bind_dirs, extra_params=None, log_output=None):
+def run_within_container(command, *bind_dirs, read_only_dirs=(), overlays=(), extra_params=None, log_output=None):
 
 	"""
 	This function is used to run the given command inside of temporary nspawn container.
 	Given the command, list of writable directories to bind between host and container,
+	list of directories to bind as read-only, overlays (as sequences of lower, upper and target directories),
 	and any extra parameters (like network configuration, coming from the config),
 	it executes the `systemd-nspawn` command with the host system as read-only root.
 
@@ -90,53 +82,266 @@ def run_within_container(command, *bind_dirs, extra_params=None, log_output=None
 
 		args = ["systemd-nspawn", "--quiet", f"--directory={container_base}", "--volatile=overlay", "--as-pid2"]
 		args.extend("--bind={0}".format(os.path.abspath(directory)) for directory in bind_dirs)
+		args.extend("--bind-ro={0}".format(os.path.abspath(directory)) for directory in read_only_dirs)
+		args.extend("--overlay={0}".format(":".join(overlay)) for overlay in overlays)
 		if extra_params:
 			args.extend(extra_params.split(" "))
 		args.extend(command)
 
-		subprocess.run(args, check=True, stdout=log_output, stderr=subprocess.STDOUT)
+		run_measured(args, check=True, stdout=log_output, stderr=subprocess.STDOUT)
+
+def get_build_env(package_dir, destination_dir, build_env=None):
+	temp_env = dict(os.environ, **(build_env or {}))
+	temp_env["prepare_dir"] = package_dir  # This env is used by prepare.sh scripts for reference to directory with all the patches
+	temp_env["PKGDEST"] = destination_dir  # This env is used by makepkg to determine where to write the bundled build artifacts
+	return temp_env
 
-def build_package(repo, package_dir, destination_dir):
+def prepare_package(package_dir, build_dir, destination_dir, build_env=None, srcinfo_cache=None, log_output=None):
 
 	"""
-	This function performs the bulk of the work in the process of building a package.
-	Given the location of scripts to set up package build and the destination to which the bundled artifact should be written,
-	it creates temporary build directories, runs the prepare scripts, then checks the package version. If the one in the build dir
-	is newer than what we already have in the local repository, building proceeds,.
+	First half of the package build process; given the location of scripts to set up package build,
+	it runs the prepare scripts within provided build directory, and returns the package's parsed .SRCINFO.
+	If the cache is provided, .SRCINFO is only generated (which requires sourcing the PKGBUILD)
+	if the PKGBUILD has changed since it was last seen.
+	The output of the scripts goes to log_output (standard output by default).
+	"""
+
+	output = log_output or sys.stdout
+	temp_env = get_build_env(package_dir, destination_dir, build_env)
+
+	# We ensure both the build and artifact destination directories
+	# can be written to by local user (since we can't run makepkg with root)
+	os.chown(destination_dir, LOCAL_USER_UID, LOCAL_USER_UID)
+	os.chown(build_dir, LOCAL_USER_UID, LOCAL_USER_UID)
+
+	item = os.path.basename(package_dir)
+	print("Preparing the package for build...", file=output)
+	with TIMINGS.phase("prepare", item):
+		run_measured(
+			RUN_AS_USER + ["/bin/bash", os.path.join(package_dir, "prepare.sh")],
+			cwd=build_dir, env=temp_env, check=True, stdout=output, stderr=subprocess.STDOUT
+		)
+
+	with TIMINGS.phase("srcinfo", item):
+		key = get_srcinfo_key(build_dir)
+		srcinfo = srcinfo_cache.get(key) if srcinfo_cache else None
+		if srcinfo is None:
+			srcinfo = parse_srcinfo(run_measured(
+				RUN_AS_USER + ["/usr/bin/makepkg", "--printsrcinfo"],
+				cwd=build_dir, env=temp_env, check=True, capture_output=True
+			).stdout.decode("utf8"))
+			if srcinfo_cache:
+				srcinfo_cache.put(key, srcinfo)
+
+	if srcinfo_cache:
+		srcinfo_cache.set_latest(item, key)
+	return srcinfo
+
+def get_prepared_files(srcdir):
 
-	The package is also installed locally (in the container), in case any other packages have it as make dependency.
+	"""
+	Returns the paths (relative to given directory) of all the files and symbolic links within it.
 	"""
 
-	temp_env = dict(os.environ)
-	temp_env["prepare_dir"] = package_dir  # This env is used by prepare.sh scripts for reference to directory with all the patches
-	temp_env["PKGDEST"] = destination_dir  # This env is used by makepkg to determine where to write the bundled build artifacts
+	paths = []
+	for root, dirs, files in os.walk(srcdir):
+		for name in files + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
+			paths.append(os.path.relpath(os.path.join(root, name), srcdir))
+	return sorted(paths)
+
+def read_manifest(filename):
+	with open(filename, mode="rt", encoding="utf8", errors="surrogateescape") as fp:
+		return [x for x in fp.read().split("\0") if x]
+
+def write_manifest(filename, paths):
+	with open(f"{filename}.tmp", mode="wt", encoding="utf8", errors="surrogateescape") as fp:
+		fp.write("".join(f"{x}\0" for x in paths))
+	os.replace(f"{filename}.tmp", filename)
+
+def is_same_file(one, two):
+	try:
+		one_stat, two_stat = os.lstat(one), os.lstat(two)
+	except FileNotFoundError:
+		return False
+	if stat.S_ISLNK(one_stat.st_mode) or stat.S_ISLNK(two_stat.st_mode):
+		return stat.S_ISLNK(one_stat.st_mode) and stat.S_ISLNK(two_stat.st_mode) and os.readlink(one) == os.readlink(two)
+	return (
+		stat.S_ISREG(one_stat.st_mode) and stat.S_ISREG(two_stat.st_mode)
+		and stat.S_IMODE(one_stat.st_mode) == stat.S_IMODE(two_stat.st_mode) and filecmp.cmp(one, two, shallow=False)
+	)
+
+def sync_prepared(fresh_dir, kept_dir, previous, current):
 
-	with TempDirectory() as build_dir:
+	"""
+	Brings the sources kept from the previous build (possibly built in part since) up to date with the ones
+	freshly extracted and prepared, given the files prepared previously and now. Files which differ are moved over
+	from the fresh sources, with their modification time set to now, so that whatever's built from them
+	is built again; the files prepared previously which aren't there anymore (like the ones added by removed
+	patches) are removed. Unchanged files and the ones produced by the build are left as they are.
+	Both directories have to be on the same file system. Returns the number of files changed.
+	"""
 
-		# We ensure both the build and artifact destination directories
-		# can be written to by local user (since we can't run makepkg with root)
-		os.chown(destination_dir, LOCAL_USER_UID, LOCAL_USER_UID)
-		os.chown(build_dir, LOCAL_USER_UID, LOCAL_USER_UID)
+	changed = 0
+	for path in sorted(set(previous) - set(current), reverse=True):
+		target = os.path.join(kept_dir, path)
+		if os.path.islink(target) or os.path.isfile(target):
+			os.unlink(target)
+			changed += 1
+
+	for path in current:
+		source, target = os.path.join(fresh_dir, path), os.path.join(kept_dir, path)
+		if is_same_file(source, target):
+			continue
+		if os.path.isdir(target) and not os.path.islink(target):
+			rmtree(target)
+
+		# Missing directories are created the way they were extracted (with the same owner and mode)
+		missing = []
+		parent = os.path.dirname(path)
+		while parent and not os.path.isdir(os.path.join(kept_dir, parent)):
+			missing.append(parent)
+			parent = os.path.dirname(parent)
+		for directory in reversed(missing):
+			status = os.stat(os.path.join(fresh_dir, directory))
+			os.mkdir(os.path.join(kept_dir, directory), mode=stat.S_IMODE(status.st_mode))
+			os.chown(os.path.join(kept_dir, directory), status.st_uid, status.st_gid)
+
+		os.replace(source, target)
+		os.utime(target, follow_symlinks=False)
+		changed += 1
+	return changed
+
+def is_package_newer(repo, package_versions):
+	return any(is_newer(version, repo[name][0] if name in repo else "0.0.0-0") for name, version in package_versions.items())
+
+def build_package(
+	srcinfo, package_dir, build_dir, destination_dir, build_env=None, noextract=False, reprepare=False, manifest=None,
+	work_dir=None, source_cache=None, log_output=None
+):
 
-		print("Preparing the package for build...")
-		subprocess.run(
-			RUN_AS_USER + ["/bin/bash", os.path.join(package_dir, "prepare.sh")],
-			cwd=build_dir, env=temp_env, check=True, stdout=sys.stdout, stderr=subprocess.STDOUT
+	"""
+	Second half of the package build process, run on the build directory previously set up by prepare_package.
+	Missing dependencies are installed first, then the package is built, and finally installed locally (in the container),
+	in case any other packages have it as make dependency.
+	Both installation steps go through the pacman lock, so that the packages can be built concurrently.
+	With noextract set, the sources already extracted into the build directory (by its previous build)
+	are built again as they are, without being extracted and prepared. If manifest is provided (the file
+	listing the files of the prepared sources, kept along with the build directory), the sources are
+	extracted and prepared before the build, on their own, so that the list can be recorded; with reprepare
+	set as well, sources already extracted are prepared again (see sync_prepared). If work_dir is provided
+	(like tmpfs), the sources are extracted and built there, rather than in the build directory.
+	If source_cache (SourceCache) is provided, sources are downloaded into it, and the ones
+	already there are verified before the build.
+	The output of the build goes to log_output (standard output by default).
+	Returns the list of built artifacts.
+	"""
+
+	output = log_output or sys.stdout
+	item = os.path.basename(package_dir)
+	temp_env = get_build_env(package_dir, destination_dir, build_env)
+	dependencies, _ = get_dependencies_from_srcinfo(srcinfo)
+
+	# Sources are always extracted where the package is placed (regardless of makepkg configuration);
+	# within the build directory itself, they're kept along with it
+	temp_env["BUILDDIR"] = work_dir or build_dir
+
+	# Sources (and source packages) are kept in the persistent cache; nothing is downloaded without extracting
+	if source_cache is not None:
+		temp_env.update(source_cache.get_env())
+		if not noextract or reprepare:
+			with TIMINGS.phase("sources", item):
+				source_cache.check(srcinfo, log_output=output)
+
+	with TIMINGS.phase("dependencies", item):
+		missing = run_measured(
+			["/usr/bin/pacman", "-T"] + sorted(dependencies),
+			capture_output=True
+		).stdout.decode("utf8").split()
+		if missing:
+			print("Installing missing dependencies within the container...", file=output)
+			with PACMAN_LOCK:
+				run_measured(
+					["/usr/bin/pacman", "-S", "--needed", "--asdeps", "--noconfirm"] + missing,
+					check=True, stdout=output, stderr=subprocess.STDOUT
+				)
+
+	# With compiler cache enabled, the statistics are collected separately for each package; paths
+	# are hashed relative to the directory the sources are built in (temporary, kept tree or tmpfs alike)
+	if "CCACHE_DIR" in temp_env:
+		temp_env["CCACHE_STATSLOG"] = os.path.join(build_dir, ".ccache-stats.log")
+		temp_env["CCACHE_BASEDIR"] = temp_env["BUILDDIR"]
+
+	# With the list of the prepared files kept along with the build directory, sources are extracted and prepared
+	# on their own first, so that the files produced by the build can be told apart from them later. Kept sources
+	# can't be prepared again in place (patches applied by the previous build are already there), so that's done
+	# next to them (on the same file system), and only what has changed is brought over
+	srcdir = os.path.join(temp_env["BUILDDIR"], "src") if temp_env["BUILDDIR"] == build_dir else os.path.join(
+		temp_env["BUILDDIR"], srcinfo["pkgbase"], "src"
+	)
+	if manifest is not None and (reprepare or not noextract):
+		with TIMINGS.phase("extract", item):
+			previous = read_manifest(manifest) if reprepare else None
+			if os.path.isfile(manifest):
+				os.unlink(manifest)
+			if reprepare:
+				print("Preparing the sources again, as the package has changed since they were extracted...", file=output)
+				with TempDirectory(parent=os.path.dirname(build_dir)) as fresh_dir:
+					os.chown(fresh_dir, LOCAL_USER_UID, LOCAL_USER_UID)
+					run_measured(
+						RUN_AS_USER + ["/usr/bin/makepkg", "--nodeps", "--noconfirm", "--nobuild"],
+						cwd=build_dir, env=dict(temp_env, BUILDDIR=fresh_dir), check=True, stdout=output, stderr=subprocess.STDOUT
+					)
+					fresh_srcdir = os.path.join(fresh_dir, srcinfo["pkgbase"], "src")
+					prepared = get_prepared_files(fresh_srcdir)
+					changed = sync_prepared(fresh_srcdir, srcdir, previous, prepared)
+				print(f"{changed} prepared file(s) have changed", file=output)
+			else:
+				run_measured(
+					RUN_AS_USER + ["/usr/bin/makepkg", "--nodeps", "--noconfirm", "--nobuild"],
+					cwd=build_dir, env=temp_env, check=True, stdout=output, stderr=subprocess.STDOUT
+				)
+				prepared = get_prepared_files(srcdir)
+			write_manifest(manifest, prepared)
+		noextract = True
+
+	print("Building the package...", file=output)
+	with TIMINGS.phase("makepkg", item):
+		run_measured(
+			RUN_AS_USER + ["/usr/bin/makepkg", "--nodeps", "--noconfirm"] + (["--noextract"] if noextract else []),
+			cwd=build_dir, env=temp_env, check=True, stdout=output, stderr=subprocess.STDOUT
 		)
 
-		print("Checking package version (will not build if older or same as current)...")
-		srcinfo = subprocess.run(
-			RUN_AS_USER + ["/usr/bin/makepkg", "--printsrcinfo"],
-			cwd=build_dir, check=True, capture_output=True
-		).stdout.decode("utf8")
-
-		package_versions = get_packages_from_srcinfo(srcinfo)
-		if not any(is_newer(version, repo[name][0] if name in repo else "0.0.0-0") for name, version in package_versions.items()):
-			print("None of the build artifacts are newer than contents of the local repository, skipping...")
-			return
-
-		print("Building the package and installing it within the container...")
-		subprocess.run(
-			RUN_AS_USER + ["/usr/bin/makepkg", "-sci", "--noconfirm"],
-			cwd=build_dir, env=temp_env, check=True, stdout=sys.stdout, stderr=subprocess.STDOUT
+	if "CCACHE_STATSLOG" in temp_env:
+		hits, misses = get_ccache_stats(temp_env["CCACHE_STATSLOG"])
+		total = hits + misses
+		print("Compiler cache: {0} hits, {1} misses ({2:.1f}% hit rate)".format(hits, misses, 100 * hits / total if total else 0), file=output)
+
+	artifacts = run_measured(
+		RUN_AS_USER + ["/usr/bin/makepkg", "--packagelist"],
+		cwd=build_dir, env=temp_env, check=True, capture_output=True
+	).stdout.decode("utf8").split()
+
+	print("Installing the package within the container...", file=output)
+	artifacts = [x for x in artifacts if os.path.isfile(x)]
+	install_packages(artifacts, item, log_output=output)
+
+	return artifacts
+
+def install_packages(artifacts, item="", log_output=None):
+
+	"""
+	Installs given package files within the container, through the pacman lock. Installation is timed
+	(as the phase of given package), as it's dominated by decompression of the packages,
+	for comparison of how different package formats perform.
+	"""
+
+	output = log_output or sys.stdout
+	with PACMAN_LOCK, TIMINGS.phase("install", item):
+		start = time.monotonic()
+		run_measured(
+			["/usr/bin/pacman", "-U", "--noconfirm"] + artifacts,
+			check=True, stdout=output, stderr=subprocess.STDOUT
 		)
+		print("Decompressed and installed {0} package(s) ({1:.1f} MiB) in {2:.2f}s".format(
+			len(artifacts), sum(map(os.path.getsize, artifacts)) / 1048576, time.monotonic() - start
+		), file=output)
@@ -0,0 +1,72 @@
+from collections import defaultdict
+import os
+import os.path
+import subprocess
+
+from .build import MATCH_PACKAGE_FILE, get_build_artifacts
+from .repo import get_repo, pacman_newest_first
+from .repodb import refresh_indexes, remove_entries
+
+def parse_package_filename(filename):
+
+	"""
+	Splits the name of the package file (like linux56-d1s-5.6.15-1-x86_64.pkg.tar.zst)
+	into the package name and its full version; returns None if it doesn't look like package file.
+	"""
+
+	parts = MATCH_PACKAGE_FILE.sub("", os.path.basename(filename)).rsplit("-", 3)
+	if len(parts) != 4 or not all(parts):
+		return None
+	name, pkgver, pkgrel, _ = parts
+	return (name, f"{pkgver}-{pkgrel}")
+
+def get_installed_packages():
+
+	"""
+	Returns the map of packages installed on the host to their versions.
+	Raises an error if they can't be determined, as the installed versions must never be removed.
+	"""
+
+	result = subprocess.run(["/usr/bin/pacman", "-Q"], capture_output=True)
+	if result.returncode != 0:
+		raise RuntimeError("Could not determine the packages installed on the host")
+	return dict(line.split(" ", 1) for line in result.stdout.decode("utf8").splitlines() if " " in line)
+
+def collect_garbage(repository_dir, repository_file, keep_versions, installed, dry_run=False):
+
+	"""
+	Removes the package files (along with their signatures) of all but the `keep_versions` newest versions
+	of each package from the repository directory. The versions installed on the host and the newest
+	version in the repository database are always kept. Database entries of removed versions are dropped.
+	With dry_run set, nothing is removed. Returns the list of removed files and the number of bytes reclaimed.
+	"""
+
+	versions = defaultdict(dict)
+	for path in get_build_artifacts(repository_dir):
+		parsed = parse_package_filename(path)
+		if parsed:
+			versions[parsed[0]].setdefault(parsed[1], []).append(path)
+
+	repo = get_repo(repository_file)
+	removed = []
+	removed_entries = set()
+	reclaimed = 0
+	for name, files in sorted(versions.items()):
+		keep = set(sorted(files, key=pacman_newest_first)[:keep_versions])
+		keep.update(x for x in (installed.get(name), repo.get(name, (None,))[0]) if x)
+
+		for version in sorted(files.keys() - keep, key=pacman_newest_first):
+			if version in repo.get(name, ()):
+				removed_entries.add(f"{name}-{version}")
+			for path in files[version]:
+				for filename in (path, f"{path}.sig"):
+					if os.path.isfile(filename):
+						removed.append(filename)
+						reclaimed += os.path.getsize(filename)
+						if not dry_run:
+							os.unlink(filename)
+
+	if removed_entries and not dry_run:
+		remove_entries(repository_file, removed_entries)
+		refresh_indexes(repository_file)
+	return (removed, reclaimed)
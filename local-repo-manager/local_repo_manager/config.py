@@ -2,6 +2,61 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from configparser import ConfigParser, ExtendedInterpolation
 import os
 import os.path
+import re
+
+from .executor import EXECUTORS, LOCAL_HOST
+from .log import LOG_COMPRESSORS
+from .makepkg import PACKAGE_FORMATS
+from .placement import BUILD_PLACEMENTS
+from .state import KEEP_BUILD_TREES
+
+MATCH_SIZE = re.compile(r'^(\d+)([KMGT]?)$')
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+MATCH_PERCENTAGE = re.compile(r'^\d+%$')
+MATCH_BUILD_HOST = re.compile(r'^([^\s=,]+)(?:=([1-9]\d*))?$')
+
+# Resource limits of the build container, mapped to the properties of its scope unit
+CONTAINER_LIMITS = {
+	"container_memory_max": "MemoryMax",
+	"container_memory_high": "MemoryHigh",
+	"container_cpu_quota": "CPUQuota"
+}
+
+def parse_size(value):
+
+	"""
+	Converts the size given in configuration (like 500M or 2G) to the number of bytes;
+	returns None if the value is not a valid size.
+	"""
+
+	match = MATCH_SIZE.match(value.strip().upper())
+	if not match:
+		return None
+	return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def parse_package_list(value):
+
+	"""
+	Converts comma-separated list of packages (by their directory names) given on the command line into a set.
+	"""
+
+	return set(x.strip() for x in value.split(",") if x.strip())
+
+def parse_build_hosts(value):
+
+	"""
+	Converts comma-separated list of build hosts (like "local, builder.lan=16") into the list of hosts,
+	each with the number of job slots it offers (or None, if it should be asked for them);
+	returns None if the list is not valid.
+	"""
+
+	hosts = []
+	for entry in value.split(","):
+		match = MATCH_BUILD_HOST.match(entry.strip())
+		if not match:
+			return None
+		hosts.append((match.group(1), int(match.group(2)) if match.group(2) else None))
+	return hosts
 
 def on_root_mount(path):
 
@@ -57,6 +112,203 @@ def parse_arguments(args):
 	subparsers.add_parser("list", help="Lists all of the packages built by this manager")
 	subparsers.add_parser("list-existing", help="Lists all the packages currently present in the local repo")
 
+	# The query action looks up the contents and metadata of the packages in the local repo,
+	# using the index of its files database
+	action_query = subparsers.add_parser("query", help="Queries the files and dependencies of the packages in the local repo")
+	query_lookups = action_query.add_mutually_exclusive_group(required=True)
+	query_lookups.add_argument(
+		"--owns",
+		default=None,
+		help="Lists the packages shipping given path, or any path ending with it (like foo.ko)",
+		dest="owns"
+	)
+	query_lookups.add_argument(
+		"--search",
+		default=None,
+		help="Lists the files matching given glob pattern; patterns without slash are matched against file names",
+		dest="search"
+	)
+	query_lookups.add_argument(
+		"--files",
+		default=None,
+		help="Lists the files shipped by given package",
+		dest="files"
+	)
+	query_lookups.add_argument(
+		"--rdepends",
+		default=None,
+		help="Lists the packages depending on given package (or on anything it provides)",
+		dest="rdepends"
+	)
+	action_query.add_argument(
+		"--json",
+		action="store_true",
+		required=False,
+		help="If provided, the results are printed out as JSON",
+		dest="json"
+	)
+
+	# The logs action shows the build logs of previous runs, using the log index wherever possible
+	action_logs = subparsers.add_parser("logs", help="Shows the build logs of previous runs")
+	action_logs.add_argument(
+		"--package",
+		required=False,
+		default=None,
+		help="Package to show the logs of; without it, the main build log is shown",
+		dest="package"
+	)
+	action_logs.add_argument(
+		"--run",
+		required=False,
+		default=None,
+		help="Run to show the logs of (by its name); defaults to the most recent run",
+		dest="run"
+	)
+	action_logs.add_argument(
+		"--all-runs",
+		action="store_true",
+		required=False,
+		help="If provided, shows the logs of all the recorded runs",
+		dest="all_runs"
+	)
+	action_logs.add_argument(
+		"--tail",
+		required=False,
+		default=None,
+		type=int,
+		help="Shows only given number of last lines of each log",
+		dest="tail"
+	)
+	action_logs.add_argument(
+		"--grep",
+		required=False,
+		default=None,
+		help="Shows only the lines matching given regular expression",
+		dest="grep"
+	)
+
+	# The outdated action checks which packages would be rebuilt, without starting the container
+	action_outdated = subparsers.add_parser(
+		"outdated",
+		help="Lists the packages pending an update; exits with status 2 if there are none, 255 on errors"
+	)
+	action_outdated.add_argument(
+		"--jobs",
+		required=False,
+		default=16,
+		type=int,
+		help="Number of packages checked concurrently",
+		dest="jobs"
+	)
+	action_outdated.add_argument(
+		"--quiet",
+		action="store_true",
+		required=False,
+		help="If provided, only the exit status reports whether there are pending updates",
+		dest="quiet"
+	)
+
+	# The gc action removes old versions of packages from the repository directory
+	action_gc = subparsers.add_parser("gc", help="Removes old versions of packages from the local repo")
+	action_gc.add_argument(
+		"--keep",
+		required=False,
+		default=None,
+		type=int,
+		help="Number of newest versions of each package to keep (overrides gc_keep_versions from the config)",
+		dest="keep"
+	)
+	action_gc.add_argument(
+		"--dry-run",
+		action="store_true",
+		required=False,
+		help="If provided, only reports what would be removed",
+		dest="dry_run"
+	)
+
+	# The stats action summarises the timings recorded in the build history
+	action_stats = subparsers.add_parser("stats", help="Shows the timing trends and regressions of previous runs")
+	action_stats.add_argument(
+		"--runs",
+		required=False,
+		default=10,
+		type=int,
+		help="Number of most recent runs to take into account",
+		dest="runs"
+	)
+	action_stats.add_argument(
+		"--package",
+		required=False,
+		default=None,
+		help="Only shows the phases of given package",
+		dest="package"
+	)
+	action_stats.add_argument(
+		"--threshold",
+		required=False,
+		default=1.5,
+		type=float,
+		help="How many times slower than usual the phase has to be to count as regression",
+		dest="threshold"
+	)
+
+	# The daemon action keeps running, watching the packages for changes and processing the queued jobs;
+	# the other actions below talk to it through the control socket
+	subparsers.add_parser("daemon", help="Runs the manager as daemon, processing the queued update jobs")
+	action_enqueue = subparsers.add_parser("enqueue", help="Queues the update job in the running daemon")
+	action_enqueue.add_argument(
+		"packages",
+		nargs="*",
+		help="Packages to check; without any, all of them are checked"
+	)
+	action_enqueue.add_argument(
+		"--force",
+		action="store_true",
+		dest="force",
+		required=False,
+		help="If provided, prepares the packages even if they haven't changed since their last build"
+	)
+	subparsers.add_parser("jobs", help="Lists the jobs queued, running and recently finished in the running daemon")
+	action_cancel = subparsers.add_parser("cancel", help="Cancels the job queued in the running daemon")
+	action_cancel.add_argument(
+		"job_id",
+		type=int,
+		help="ID of the job to cancel"
+	)
+
+	# These actions are used by the update running on another host, which spreads the builds across
+	# several hosts; the capacity of this host is determined first, then it builds the packages shipped to it
+	subparsers.add_parser("capacity", help="Prints the number of job slots this host offers to the builds, as JSON")
+	action_execute = subparsers.add_parser("execute", help="Builds the packages shipped from another host, for it to collect")
+	action_execute.add_argument(
+		"--pkgdest",
+		required=True,
+		type=os.path.abspath,
+		help="Location to which the built packages will be moved",
+		dest="pkgdest"
+	)
+	action_execute.add_argument(
+		"--packages-dir",
+		required=True,
+		type=os.path.abspath,
+		help="Location of the packages shipped from another host",
+		dest="packages_dir"
+	)
+	action_execute.add_argument(
+		"--packages",
+		required=True,
+		type=parse_package_list,
+		help="Comma-separated list of packages to check",
+		dest="packages"
+	)
+	action_execute.add_argument(
+		"--force",
+		action="store_true",
+		dest="force",
+		required=False,
+		help="If provided, prepares all the packages even if they haven't changed since their last build"
+	)
+
 	# The update action schedules the build action within the nspawn container,
 	# and adds any new packages to local repo afterwards
 	action_update = subparsers.add_parser("update", help="Schedules update of all the packages")
@@ -67,6 +319,28 @@ def parse_arguments(args):
 		required=False,
 		help="If provided, outputs the logs of the build process to terminal instead of log file"
 	)
+	action_update.add_argument(
+		"--force",
+		action="store_true",
+		dest="force",
+		required=False,
+		help="If provided, prepares all the packages even if they haven't changed since their last build"
+	)
+	action_update.add_argument(
+		"--fresh",
+		action="store_true",
+		dest="fresh",
+		required=False,
+		help="If provided, discards whatever the previous failed update has left behind, instead of resuming it"
+	)
+	action_update.add_argument(
+		"--packages",
+		required=False,
+		default=None,
+		type=parse_package_list,
+		help="Comma-separated list of packages to check; without it, all of them are checked",
+		dest="packages"
+	)
 
 	# The build action performs the actual building, and it's intended to be used within
 	# the nspawn container by the `update` command. The --pkgdest argument should point
@@ -79,6 +353,36 @@ def parse_arguments(args):
 		help="Location to which the built packages will be moved",
 		dest="pkgdest"
 	)
+	action_build.add_argument(
+		"--force",
+		action="store_true",
+		dest="force",
+		required=False,
+		help="If provided, prepares all the packages even if they haven't changed since their last build"
+	)
+	action_build.add_argument(
+		"--packages",
+		required=False,
+		default=None,
+		type=parse_package_list,
+		help="Comma-separated list of packages to check; without it, all of them are checked",
+		dest="packages"
+	)
+	action_build.add_argument(
+		"--packages-dir",
+		required=False,
+		default=None,
+		type=os.path.abspath,
+		help="Alternative location of the packages (like the ones shipped from another host)",
+		dest="packages_dir"
+	)
+	action_build.add_argument(
+		"--no-setup",
+		action="store_true",
+		dest="no_setup",
+		required=False,
+		help="If provided, skips setting up sudo permissions and network, for builds run outside of the container"
+	)
 
 	return parser.parse_args(args)
 
@@ -114,7 +418,202 @@ def parse_config(config_file):
 	if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.X_OK):
 		raise RuntimeError("Packages directory at {0} could not be accessed".format(temp))
 
+	# Verify that the git mirrors directory (if mirroring is enabled) either exists and is writable,
+	# or can be created
+	temp = config.get("Paths", "mirror_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.X_OK):
+			raise RuntimeError("Mirror directory at {0} could not be accessed".format(temp))
+
+	# Verify that the .SRCINFO cache directory (if enabled) either exists or can be created
+	temp = config.get("Paths", "srcinfo_cache_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.X_OK):
+			raise RuntimeError(".SRCINFO cache directory at {0} could not be accessed".format(temp))
+
+	# Verify that the source cache directory (if enabled) either exists and is writable, or can be created
+	temp = config.get("Paths", "source_cache_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.W_OK | os.X_OK):
+			raise RuntimeError("Source cache directory at {0} could not be accessed".format(temp))
+	temp = config.get("Build", "source_cache_size", fallback="0")
+	if parse_size(temp) is None:
+		raise RuntimeError("Option source_cache_size has to be a size (like 500M or 2G), got {0}".format(temp))
+
+	# Verify that the state directory (if enabled) either exists or can be created
+	temp = config.get("Paths", "state_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.W_OK | os.X_OK):
+			raise RuntimeError("State directory at {0} could not be accessed".format(temp))
+	temp = config.get("Build", "keep_build_trees", fallback="failed")
+	if temp not in KEEP_BUILD_TREES:
+		raise RuntimeError("Option keep_build_trees has to be one of: {0}".format(", ".join(KEEP_BUILD_TREES)))
+
+	# Verify that the persistent pacman package cache (if used) is a directory
+	temp = config.get("Paths", "pacman_cache_dir", fallback="/var/cache/pacman/pkg")
+	if temp and not os.path.isdir(temp):
+		raise RuntimeError("Pacman cache directory at {0} could not be accessed".format(temp))
+
+	# Verify that the build dependencies layer directory (if enabled) either exists or can be created
+	temp = config.get("Paths", "build_layer_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.X_OK):
+			raise RuntimeError("Build layer directory at {0} could not be accessed".format(temp))
+
+	# Verify that the compiler cache directory (if enabled) either exists and is writable, or can be created
+	temp = config.get("Build", "ccache_dir", fallback="")
+	if temp:
+		try:
+			os.makedirs(temp, exist_ok=True)
+		except OSError:
+			pass
+		if not os.path.isdir(temp) or not os.access(temp, os.R_OK | os.W_OK | os.X_OK):
+			raise RuntimeError("Compiler cache directory at {0} could not be accessed".format(temp))
+
+	# Verify that the number of concurrent builds is a positive number
+	temp = config.get("Build", "parallel_builds", fallback="1")
+	if not temp.isdigit() or int(temp) < 1:
+		raise RuntimeError("Number of parallel builds has to be a positive integer, got {0}".format(temp))
+
+	# Verify the package format and compression settings, if provided
+	temp = config.get("Build", "package_format", fallback="")
+	if temp and temp not in PACKAGE_FORMATS:
+		raise RuntimeError("Package format has to be one of: {0}".format(", ".join(PACKAGE_FORMATS)))
+	for option in ("compression_level", "compression_threads"):
+		temp = config.get("Build", option, fallback="")
+		if temp and not temp.isdigit():
+			raise RuntimeError("Option {0} has to be a non-negative integer, got {1}".format(option, temp))
+
+	# Verify the job slot settings shared by all the builds
+	temp = config.get("Build", "build_jobs", fallback="0")
+	if not temp.isdigit():
+		raise RuntimeError("Option build_jobs has to be a non-negative integer, got {0}".format(temp))
+	temp = config.get("Build", "memory_per_job", fallback="2G")
+	if parse_size(temp) is None:
+		raise RuntimeError("Option memory_per_job has to be a size (like 500M or 2G), got {0}".format(temp))
+
+	# Verify the placement of the builds, and the memory to keep free when building on tmpfs
+	temp = config.get("Build", "build_placement", fallback="auto")
+	if temp not in BUILD_PLACEMENTS:
+		raise RuntimeError("Option build_placement has to be one of: {0}".format(", ".join(BUILD_PLACEMENTS)))
+	temp = config.get("Build", "tmpfs_min_free", fallback="8G")
+	if parse_size(temp) is None:
+		raise RuntimeError("Option tmpfs_min_free has to be a size (like 500M or 2G), got {0}".format(temp))
+
+	# Verify the resource limits of the build container (sizes, or percentages of the host's resources)
+	for option in ("container_memory_max", "container_memory_high"):
+		temp = config.get("Build", option, fallback="")
+		if temp and parse_size(temp) is None and not MATCH_PERCENTAGE.match(temp):
+			raise RuntimeError("Option {0} has to be a size (like 16G) or a percentage, got {1}".format(option, temp))
+	temp = config.get("Build", "container_cpu_quota", fallback="")
+	if temp and not MATCH_PERCENTAGE.match(temp):
+		raise RuntimeError("Option container_cpu_quota has to be a percentage (like 800%), got {0}".format(temp))
+
+	# Verify the executor building the packages on this host, and the list of hosts the builds are spread across
+	temp = config.get("Build", "executor", fallback="nspawn")
+	if temp not in EXECUTORS:
+		raise RuntimeError("Option executor has to be one of: {0}".format(", ".join(EXECUTORS)))
+	build_hosts = parse_build_hosts(config.get("Build", "build_hosts", fallback=LOCAL_HOST))
+	if not build_hosts:
+		raise RuntimeError("Option build_hosts has to be comma-separated list of hosts (like local, builder.lan=16)")
+	if len(set(host for host, _ in build_hosts)) < len(build_hosts):
+		raise RuntimeError("Option build_hosts lists the same host more than once")
+
+	# Verify the tool used to add packages to the repository database
+	temp = config.get("Build", "repository_writer", fallback="native")
+	if temp not in ("native", "repo-add"):
+		raise RuntimeError("Repository writer has to be either native or repo-add, got {0}".format(temp))
+
+	# Verify that the build history database and Prometheus textfile (if enabled) can be written
+	for option in ("history_file", "prometheus_textfile"):
+		temp = config.get("Paths", option, fallback="")
+		if temp and not os.path.isdir(os.path.dirname(temp) or "."):
+			raise RuntimeError("Directory for {0} at {1} does not exist".format(option, temp))
+
+	# Verify the compression and retention settings of the build logs
+	temp = config.get("Logs", "log_compression", fallback="zst")
+	if temp not in LOG_COMPRESSORS:
+		raise RuntimeError("Log compression has to be one of: {0}".format(", ".join(LOG_COMPRESSORS)))
+	temp = config.get("Logs", "log_keep_runs", fallback="0")
+	if not temp.isdigit():
+		raise RuntimeError("Option log_keep_runs has to be a non-negative integer, got {0}".format(temp))
+	temp = config.get("Logs", "log_max_size", fallback="0")
+	if parse_size(temp) is None:
+		raise RuntimeError("Option log_max_size has to be a size (like 500M or 2G), got {0}".format(temp))
+
+	# Verify the retention settings for old versions of packages
+	temp = config.get("Build", "gc_keep_versions", fallback="2")
+	if not temp.isdigit() or int(temp) < 1:
+		raise RuntimeError("Option gc_keep_versions has to be a positive integer, got {0}".format(temp))
+	try:
+		gc_after_update = config.getboolean("Build", "gc_after_update", fallback=False)
+	except ValueError:
+		raise RuntimeError("Option gc_after_update has to be either yes or no")
+
+	# Verify the artifact streaming switch
+	try:
+		stream_artifacts = config.getboolean("Build", "stream_artifacts", fallback=True)
+	except ValueError:
+		raise RuntimeError("Option stream_artifacts has to be either yes or no")
+
 	config_dict = { "config_file": config_file }
 	for section in config.sections():
 		config_dict.update(config[section])
+	config_dict["parallel_builds"] = int(config_dict.get("parallel_builds", "1"))
+	config_dict.setdefault("mirror_dir", "")
+	config_dict.setdefault("srcinfo_cache_dir", "")
+	config_dict.setdefault("source_cache_dir", "")
+	config_dict["source_cache_size"] = parse_size(config_dict.get("source_cache_size", "0"))
+	config_dict.setdefault("state_dir", "")
+	config_dict.setdefault("keep_build_trees", "failed")
+	config_dict.setdefault("pacman_cache_dir", "/var/cache/pacman/pkg")
+	config_dict.setdefault("build_layer_dir", "")
+	config_dict.setdefault("control_socket", "/run/local-repo-manager/control.sock")
+	config_dict.setdefault("history_file", "")
+	config_dict.setdefault("prometheus_textfile", "")
+	for temp in ("package_format", "compression_level", "compression_threads", "ccache_dir", "ccache_size"):
+		config_dict.setdefault(temp, "")
+	config_dict.setdefault("repository_writer", "native")
+	config_dict["build_jobs"] = int(config_dict.get("build_jobs", "0"))
+	config_dict["memory_per_job"] = parse_size(config_dict.get("memory_per_job", "2G"))
+	config_dict.setdefault("build_placement", "auto")
+	config_dict["tmpfs_min_free"] = parse_size(config_dict.get("tmpfs_min_free", "8G"))
+
+	# Resource limits are applied to the container through its nspawn parameters
+	config_dict["nspawn_params"] = " ".join(filter(None, [config_dict.get("nspawn_params", "")] + [
+		f"--property={value}={config_dict[key].strip()}" for key, value in CONTAINER_LIMITS.items() if config_dict.get(key)
+	]))
+	for temp in CONTAINER_LIMITS:
+		config_dict.setdefault(temp, "")
+	config_dict["stream_artifacts"] = stream_artifacts
+	config_dict.setdefault("executor", "nspawn")
+	config_dict["build_hosts"] = build_hosts
+	config_dict.setdefault("remote_manager", "/usr/bin/local-repo-manager")
+	config_dict.setdefault("remote_config", "/etc/local-repo.conf")
+	config_dict.setdefault("ssh_params", "-o BatchMode=yes")
+	config_dict["gc_keep_versions"] = int(config_dict.get("gc_keep_versions", "2"))
+	config_dict["gc_after_update"] = gc_after_update
+	config_dict.setdefault("log_compression", "zst")
+	config_dict["log_keep_runs"] = int(config_dict.get("log_keep_runs", "0"))
+	config_dict["log_max_size"] = parse_size(config_dict.get("log_max_size", "0"))
 	return config_dict
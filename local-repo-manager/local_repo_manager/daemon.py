@@ -0,0 +1,429 @@
+from datetime import datetime
+import json
+import os
+import os.path
+import signal
+import socket
+import socketserver
+from threading import Condition, Event, Lock, Thread
+import time
+import traceback
+
+from .build import get_packages
+from .fingerprint import FINGERPRINTS_FILE, FingerprintStore, hash_directory
+from .outdated import check_packages
+from .repo import get_repo
+from .srcinfo import SrcinfoCache
+from .update import run_update
+from .util import (
+	IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO,
+	Inotify
+)
+
+# Changes to the packages directory are only acted upon once they've settled for this long,
+# so that editing several files (or pulling new patches) results in a single job
+DEBOUNCE_SECONDS = 5
+
+# Number of finished (or cancelled) jobs kept around, so that their outcome can be inspected
+FINISHED_JOBS = 50
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+
+def format_job(job):
+
+	"""
+	Formats the job (as returned by the daemon) into single line, for the command line actions.
+	"""
+
+	packages = ", ".join(job["packages"]) if job["packages"] is not None else "all packages"
+	line = "{0:>4}  {1:<10} {2:%Y-%m-%d %H:%M}  {3}{4}".format(
+		job["id"], job["state"], datetime.fromtimestamp(job["queued"]), packages, " (forced)" if job["force"] else ""
+	)
+	if job["reason"]:
+		line += f" [{job['reason']}]"
+	if job["error"]:
+		line += f"\n      {job['error']}"
+	return line
+
+def send_command(socket_path, command, **params):
+
+	"""
+	Sends a single command to the daemon listening on given control socket, and returns the result.
+	Errors reported by the daemon are raised as RuntimeError, same as the ones raised locally would be.
+	"""
+
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(socket_path)
+			sock.sendall(json.dumps(dict(params, command=command)).encode("utf8") + b"\n")
+			with sock.makefile("rb") as fp:
+				response = fp.readline()
+	except OSError:
+		raise RuntimeError(f"Could not connect to the daemon at {socket_path}, is it running?")
+	if not response:
+		raise RuntimeError("Daemon closed the connection without responding")
+
+	response = json.loads(response)
+	if not response["ok"]:
+		raise RuntimeError(response["error"])
+	return response["result"]
+
+class JobQueue:
+
+	"""
+	Queue of the update jobs processed by the daemon, one at a time. Each job checks either
+	the given packages, or all of them (full check). Jobs waiting in the queue are deduplicated:
+	queued full check absorbs any new jobs (and supersedes the partial ones queued before it),
+	and packages of new partial job are merged into the one already queued.
+	Jobs are kept as plain maps, so that they can be sent over the control socket as they are.
+	"""
+
+	__slots__ = ("condition", "jobs", "next_id", "stopped")
+
+	def __init__(self):
+		self.condition = Condition()
+		self.jobs = []
+		self.next_id = 1
+		self.stopped = False
+
+	def enqueue(self, packages=None, force=False, reason=""):
+		with self.condition:
+			queued = [x for x in self.jobs if x["state"] == "queued"]
+
+			full = next((x for x in queued if x["packages"] is None and x["force"] >= force), None)
+			if full:
+				return dict(full)
+
+			if packages is None:
+				job = self.add(None, force, reason)
+				for other in queued:
+					if other["force"] <= force:
+						self.update(other, state="cancelled", error=f"Superseded by job {job['id']}")
+				return dict(job)
+
+			for other in queued:
+				if other["packages"] is not None and other["force"] == force:
+					other["packages"] = sorted(set(other["packages"]) | set(packages))
+					if reason and reason not in other["reason"].split(", "):
+						other["reason"] = ", ".join(filter(None, (other["reason"], reason)))
+					return dict(other)
+
+			return dict(self.add(sorted(packages), force, reason))
+
+	def add(self, packages, force, reason):
+		job = {
+			"id": self.next_id, "packages": packages, "force": force, "reason": reason,
+			"state": "queued", "queued": time.time(), "started": None, "finished": None,
+			"added": [], "error": None
+		}
+		self.next_id += 1
+		self.jobs.append(job)
+		self.condition.notify_all()
+		return job
+
+	def update(self, job, **values):
+
+		"""
+		Updates given job, and drops the oldest of the finished ones, once there's too many of them.
+		"""
+
+		job.update(values)
+		if values.get("state") in ("done", "failed", "cancelled"):
+			job["finished"] = time.time()
+			finished = [x for x in self.jobs if x["finished"] is not None]
+			for old in finished[:max(0, len(finished) - FINISHED_JOBS)]:
+				self.jobs.remove(old)
+
+	def cancel(self, job_id):
+
+		"""
+		Cancels the job waiting in the queue; jobs already running can't be cancelled,
+		as interrupting the build would leave the container's state behind.
+		"""
+
+		with self.condition:
+			job = next((x for x in self.jobs if x["id"] == job_id), None)
+			if job is None:
+				raise RuntimeError(f"No job with ID {job_id}")
+			if job["state"] != "queued":
+				raise RuntimeError(f"Job {job_id} is {job['state']}, only queued jobs can be cancelled")
+			self.update(job, state="cancelled", error="Cancelled on request")
+			return dict(job)
+
+	def get_next(self):
+
+		"""
+		Waits for the next queued job, marks it as running and returns it; returns None once the queue is stopped.
+		"""
+
+		with self.condition:
+			while not self.stopped:
+				job = next((x for x in self.jobs if x["state"] == "queued"), None)
+				if job:
+					self.update(job, state="running", started=time.time())
+					return dict(job)
+				self.condition.wait()
+			return None
+
+	def finish(self, job_id, added=(), error=None):
+		with self.condition:
+			job = next(x for x in self.jobs if x["id"] == job_id)
+			self.update(job, state="failed" if error else "done", added=list(added), error=error)
+
+	def get_jobs(self):
+		with self.condition:
+			return [dict(x) for x in self.jobs]
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify_all()
+
+class PackageWatcher:
+
+	"""
+	Watches the packages directory (and all the directories within) with inotify, and once the changes
+	settle, queues the packages whose scripts or patches differ from the ones of their last build.
+	Changes that don't affect the hash (like touching the files) don't result in any jobs.
+	"""
+
+	__slots__ = ("inotify", "packages_dir", "queue", "repository_dir", "stopped", "thread")
+
+	def __init__(self, packages_dir, repository_dir, queue):
+		self.packages_dir = packages_dir
+		self.repository_dir = repository_dir
+		self.queue = queue
+		self.stopped = Event()
+
+	def __enter__(self):
+		self.inotify = Inotify()
+		self.watch(self.packages_dir)
+		self.thread = Thread(target=self.run, name="package-watcher", daemon=True)
+		self.thread.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stopped.set()
+		self.thread.join()
+		self.inotify.close()
+		del self.inotify, self.thread
+
+	def watch(self, directory):
+		for root, dirs, _ in os.walk(directory):
+			try:
+				self.inotify.add_watch(root, WATCH_MASK)
+			except OSError:
+				# Directory removed before it could be watched, nothing left to watch there
+				dirs.clear()
+
+	def run(self):
+		changed = set()
+		deadline = None
+		while not self.stopped.is_set():
+			timeout = 1 if deadline is None else min(1, max(0, deadline - time.monotonic()))
+			for path, mask, name in self.inotify.read_events(timeout):
+				path = os.path.join(path, name) if name else path
+				item = os.path.relpath(path, self.packages_dir).split(os.sep)[0]
+				if item in (".", "..") or item.startswith("."):
+					continue
+				if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+					self.watch(path)
+				changed.add(item)
+				deadline = time.monotonic() + DEBOUNCE_SECONDS
+
+			if deadline is not None and time.monotonic() >= deadline:
+				try:
+					self.queue_changed(changed)
+				except Exception:
+					traceback.print_exc()
+				changed = set()
+				deadline = None
+
+	def queue_changed(self, items):
+
+		"""
+		Queues the packages (out of the given ones) whose scripts differ from the ones of their last build.
+		Fingerprints are read again every time, as they're updated by every job.
+		"""
+
+		fingerprints = FingerprintStore(os.path.join(self.repository_dir, FINGERPRINTS_FILE))
+		packages = get_packages(self.packages_dir)
+		pending = []
+		for item in sorted(items):
+			if not packages.get(item):
+				continue
+			try:
+				scripts = hash_directory(os.path.join(self.packages_dir, item))
+			except OSError:
+				# Files changed while hashing; the change will be picked up with the next event
+				continue
+			if fingerprints.fingerprints.get(item, {}).get("scripts") != scripts:
+				pending.append(item)
+
+		if pending:
+			job = self.queue.enqueue(pending, reason="scripts changed")
+			print("Queued job {0} for changed package(s): {1}".format(job["id"], ", ".join(pending)), flush=True)
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+	"""
+	Handles the connection to the control socket; every line received is a JSON-encoded command,
+	and every one of them is answered with single JSON-encoded line.
+	"""
+
+	def handle(self):
+		for line in self.rfile:
+			try:
+				response = {"ok": True, "result": self.server.manager.handle_command(json.loads(line))}
+			except (RuntimeError, ValueError, KeyError, TypeError) as e:
+				response = {"ok": False, "error": str(e)}
+			self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+	daemon_threads = True
+
+	def __init__(self, socket_path, manager):
+		self.manager = manager
+		super().__init__(socket_path, ControlHandler)
+
+class ManagerDaemon:
+
+	"""
+	Long-running mode of the manager, processing the update jobs one at a time. Jobs are queued
+	by the package watcher, or through the control socket (full check being queued by the timer).
+	Configuration is parsed once, and the contents of the local repository are only read again
+	once the repository database changes; that only spares the host-side work (status command and
+	the check of pending packages), as each job's build still runs in a fresh container, which
+	parses the configuration and reads the repository on its own.
+	"""
+
+	__slots__ = ("config", "queue", "repo", "repo_key", "repo_lock", "started")
+
+	def __init__(self, config):
+		self.config = config
+		self.queue = JobQueue()
+		self.repo_lock = Lock()
+		self.repo = None
+		self.repo_key = None
+		self.started = time.time()
+
+	def get_repo(self):
+
+		"""
+		Returns the contents of the local repository, reading them again if the database has changed
+		since; commands are handled concurrently, so the check and the refresh are done under the lock.
+		"""
+
+		with self.repo_lock:
+			try:
+				stat = os.stat(self.config["repository_file"])
+				key = (stat.st_mtime_ns, stat.st_size)
+			except FileNotFoundError:
+				key = None
+			if self.repo is None or key != self.repo_key:
+				self.repo = get_repo(self.config["repository_file"])
+				self.repo_key = key
+			return self.repo
+
+	def handle_command(self, request):
+		command = request["command"]
+
+		if command == "enqueue":
+			packages = request.get("packages")
+			if packages is not None:
+				if not isinstance(packages, list) or not packages:
+					raise ValueError("Packages have to be a non-empty list")
+				unknown = set(packages) - get_packages(self.config["packages_dir"]).keys()
+				if unknown:
+					raise RuntimeError("Unknown package(s): {0}".format(", ".join(sorted(unknown))))
+			return self.queue.enqueue(packages, force=bool(request.get("force")), reason=request.get("reason", ""))
+
+		elif command == "cancel":
+			return self.queue.cancel(int(request["id"]))
+
+		elif command == "jobs":
+			return self.queue.get_jobs()
+
+		elif command == "status":
+			jobs = self.queue.get_jobs()
+			return {
+				"pid": os.getpid(),
+				"started": self.started,
+				"running": next((x for x in jobs if x["state"] == "running"), None),
+				"queued": sum(x["state"] == "queued" for x in jobs),
+				"repository": dict((name, versions[0]) for name, versions in self.get_repo().items())
+			}
+
+		raise RuntimeError(f"Unknown command: {command}")
+
+	def get_pending(self):
+
+		"""
+		Returns the packages which would be rebuilt by the full check (the same way outdated action does),
+		so that the container isn't set up at all when there's nothing to do.
+		"""
+
+		results = check_packages(
+			self.config["packages_dir"], get_packages(self.config["packages_dir"]), self.get_repo(),
+			FingerprintStore(os.path.join(self.config["repository_dir"], FINGERPRINTS_FILE)),
+			srcinfo_cache=SrcinfoCache(self.config["srcinfo_cache_dir"]) if self.config["srcinfo_cache_dir"] else None,
+			mirror_dir=self.config["mirror_dir"] or None
+		)
+		return set(x["item"] for x in results if x["pending"])
+
+	def run_job(self, job):
+		print("Starting job {0}...".format(job["id"]), flush=True)
+		packages = set(job["packages"]) if job["packages"] is not None else None
+		if packages is None and not job["force"]:
+			packages = self.get_pending()
+			if not packages:
+				print("No packages pending an update", flush=True)
+				return []
+		return run_update(self.config, packages=packages, force=job["force"])
+
+	def run(self):
+		socket_path = self.config["control_socket"]
+		os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+		if os.path.exists(socket_path):
+			try:
+				send_command(socket_path, "status")
+			except RuntimeError:
+				os.unlink(socket_path)
+			else:
+				raise RuntimeError(f"Daemon is already running at {socket_path}")
+
+		# Stopping the daemon interrupts the running job, same as stopping the oneshot update would
+		def stop(signum, frame):
+			self.queue.stop()
+			raise SystemExit(0)
+		signal.signal(signal.SIGTERM, stop)
+
+		old_umask = os.umask(0o177)
+		try:
+			server = ControlServer(socket_path, self)
+		finally:
+			os.umask(old_umask)
+		server_thread = Thread(target=server.serve_forever, name="control-socket", daemon=True)
+		server_thread.start()
+		print(f"Listening for commands on {socket_path}", flush=True)
+
+		try:
+			with PackageWatcher(self.config["packages_dir"], self.config["repository_dir"], self.queue):
+				while True:
+					job = self.queue.get_next()
+					if job is None:
+						break
+					try:
+						added = self.run_job(job)
+					except Exception as e:
+						traceback.print_exc()
+						self.queue.finish(job["id"], error=str(e))
+						print("Job {0} has failed".format(job["id"]), flush=True)
+					else:
+						self.queue.finish(job["id"], added=[os.path.basename(x) for x in added])
+						print("Job {0} is done, {1} package(s) added".format(job["id"], len(added)), flush=True)
+		finally:
+			server.shutdown()
+			server.server_close()
+			os.unlink(socket_path)
@@ -0,0 +1,403 @@
+from abc import ABC, abstractmethod
+from collections import defaultdict
+import json
+import os
+import os.path
+import shlex
+from shutil import rmtree
+import statistics
+import subprocess
+import sys
+from tempfile import mkdtemp
+from threading import Event, Thread
+import time
+import traceback
+
+from .build import get_packages, run_within_container
+from .fingerprint import FINGERPRINTS_FILE, FingerprintStore
+from .history import BuildHistory
+from .ingest import MARKER_EXTENSION, write_marker
+from .jobserver import get_job_slots
+from .layer import BuildLayer
+from .state import TREES_DIR
+from .timing import TIMINGS, TIMINGS_FILE, run_measured
+from .util import TempDirectory
+
+# Backends building the packages on this host; within nspawn container, or as plain process
+# (for testing, or for hosts which are disposable themselves)
+EXECUTORS = ("nspawn", "local")
+
+# Name standing for this host in the list of build hosts
+LOCAL_HOST = "local"
+
+# Remote hosts keep the packages shipped to them, and the artifacts built from them,
+# in temporary directory created in here
+REMOTE_TEMP_DIR = "/var/tmp"
+
+# Number of recent runs the build times of the packages are taken from, when placing them on the hosts
+COST_RUNS = 10
+
+def get_build_command(config, pkgdest, packages=None, force=False, packages_dir=None, no_setup=False):
+
+	"""
+	Returns the command running the manager with `build` action, with given options.
+	We run python3 via env as nspawn expects actual binary, and the manager is a Python script;
+	we pass through config location and provide package destination directory.
+	"""
+
+	command = [
+		"/usr/bin/env", "python3", os.path.abspath(sys.argv[0]),
+		"--config", config["config_file"], "build", "--pkgdest", pkgdest
+	]
+	if force:
+		command.append("--force")
+	if packages is not None:
+		command.extend(["--packages", ",".join(sorted(packages))])
+	if packages_dir:
+		command.extend(["--packages-dir", packages_dir])
+	if no_setup:
+		command.append("--no-setup")
+	return command
+
+def get_remote_fingerprints_file(pkgdest, host):
+	return os.path.join(pkgdest, ".{0}-{1}".format(host.replace("/", "_"), FINGERPRINTS_FILE))
+
+class Executor(ABC):
+
+	"""
+	Base of the build executors. Each of them runs the `build` action for the packages given to it, leaving
+	the artifacts (along with their markers), fingerprints and timings in the package destination, the same way
+	the build action does within the container. The capacity of the host (the number of job slots it offers
+	to the builds) is either configured (as `slots`), or determined by asking the host.
+	Used as context manager, holds whatever resources the executor needs for the duration of the update.
+	"""
+
+	__slots__ = ("config", "name", "slots")
+
+	def __init__(self, config, name, slots=None):
+		self.config = config
+		self.name = name
+		self.slots = slots
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+	def get_capacity(self):
+		if self.slots is None:
+			self.slots = self.measure_capacity()
+		return self.slots
+
+	def measure_capacity(self):
+		return get_job_slots(self.config["memory_per_job"], max_jobs=self.config["build_jobs"])[0]
+
+	@abstractmethod
+	def run(self, pkgdest, packages=None, force=False, packages_dir=None, log_output=None):
+
+		"""
+		Builds given packages (all of them, if None), from given packages directory (the configured one by default).
+		The output goes to log_output (standard output by default). Raises an error if the build fails.
+		"""
+
+class NspawnExecutor(Executor):
+
+	"""
+	Runs the build within temporary nspawn container on this host, with the persistent caches bound into it,
+	and the layer of pre-installed build dependencies as its overlay (provisioned first, if it's out of date).
+	"""
+
+	__slots__ = ()
+
+	def run(self, pkgdest, packages=None, force=False, packages_dir=None, log_output=None):
+		config = self.config
+		output = log_output or sys.stdout
+		command = get_build_command(config, pkgdest, packages, force, packages_dir)
+
+		# Pacman cache, compiler cache, .SRCINFO cache and source cache are shared with the host, so that they persist between the runs
+		bind_dirs = [pkgdest] + [
+			config[x] for x in ("pacman_cache_dir", "ccache_dir", "srcinfo_cache_dir", "source_cache_dir") if config[x]
+		]
+		read_only_dirs = [x for x in (config["mirror_dir"], packages_dir) if x]
+
+		# Build dependencies of all the packages are kept pre-installed in persistent layer,
+		# which is only provisioned again if the dependencies or the host packages change;
+		# failure to provision isn't fatal, as the build installs dependencies by itself
+		overlays = []
+		if config["build_layer_dir"]:
+			layer = BuildLayer(config["build_layer_dir"])
+			dependencies = FingerprintStore(os.path.join(config["repository_dir"], FINGERPRINTS_FILE)).get_build_dependencies()
+			if not layer.is_current(dependencies):
+				print("Provisioning build dependencies layer...", file=output, flush=True)
+				try:
+					with TIMINGS.phase("layer"):
+						layer.provision(dependencies, *bind_dirs[1:], extra_params=config["nspawn_params"], log_output=output)
+				except Exception:
+					traceback.print_exc(file=output)
+					print("Could not provision build dependencies layer, building without it", file=output, flush=True)
+			if layer.is_current(dependencies):
+				overlays = layer.get_overlays()
+
+		# Time it takes to set up the container is the time between launching it,
+		# and the build action within it starting to collect its own timings
+		launched = time.time()
+		try:
+			with TIMINGS.phase("container"):
+				run_within_container(
+					command, *bind_dirs, *([os.path.join(config["state_dir"], TREES_DIR)] if config["state_dir"] else []),
+					read_only_dirs=read_only_dirs, overlays=overlays, extra_params=config["nspawn_params"], log_output=output
+				)
+		finally:
+			started = TIMINGS.merge(os.path.join(pkgdest, TIMINGS_FILE))
+			if started is not None:
+				TIMINGS.add("container-setup", "", max(0, started - launched), 0, None)
+
+class LocalExecutor(Executor):
+
+	"""
+	Runs the build action directly on this host, as plain process, without setting up the container;
+	meant for testing, and for build hosts which are disposable themselves (like virtual machines).
+	"""
+
+	__slots__ = ()
+
+	def run(self, pkgdest, packages=None, force=False, packages_dir=None, log_output=None):
+		try:
+			with TIMINGS.phase("container"):
+				run_measured(
+					get_build_command(self.config, pkgdest, packages, force, packages_dir, no_setup=True),
+					check=True, stdout=log_output or sys.stdout, stderr=subprocess.STDOUT
+				)
+		finally:
+			TIMINGS.merge(os.path.join(pkgdest, TIMINGS_FILE))
+
+class SshExecutor(Executor):
+
+	"""
+	Runs the build on another host over SSH. The scripts of the packages are shipped to the remote host,
+	where the manager (which has to be installed there as well) builds them with `execute` action,
+	according to its own configuration. The artifacts of each package are streamed back into the package
+	destination as soon as it's built, so that the update can pick them up just like the ones built locally,
+	followed by the fingerprints (kept in separate file, until they're combined with the others) and timings.
+	All the commands go through single SSH connection, held open for the duration of the update.
+	"""
+
+	__slots__ = ("control_dir", "interval")
+
+	def __init__(self, config, name, slots=None, interval=5):
+		super().__init__(config, name, slots)
+		self.interval = interval
+
+	def __enter__(self):
+		self.control_dir = mkdtemp(prefix="ssh")
+		return self
+
+	def __exit__(self, *args):
+		subprocess.run(self.get_ssh_command() + ["-O", "exit", self.name], capture_output=True)
+		rmtree(self.control_dir)
+		del self.control_dir
+
+	def get_ssh_command(self):
+		return ["ssh"] + shlex.split(self.config["ssh_params"]) + [
+			"-o", "ControlMaster=auto", "-o", "ControlPersist=yes",
+			"-o", "ControlPath={0}".format(os.path.join(self.control_dir, "master"))
+		]
+
+	def ssh(self, command, **kwargs):
+		return subprocess.run(self.get_ssh_command() + [self.name, shlex.join(command)], **kwargs)
+
+	def get_manager_command(self, action, *args):
+		return [self.config["remote_manager"], "--config", self.config["remote_config"], action] + list(args)
+
+	def measure_capacity(self):
+		result = self.ssh(self.get_manager_command("capacity"), capture_output=True)
+		if result.returncode != 0:
+			raise RuntimeError("Could not determine the capacity of {0} (exit status {1}){2}".format(
+				self.name, result.returncode, ": " + result.stderr.decode("utf8", errors="replace").strip() if result.stderr.strip() else ""
+			))
+		return json.loads(result.stdout)["slots"]
+
+	def run(self, pkgdest, packages=None, force=False, packages_dir=None, log_output=None):
+		output = log_output or sys.stdout
+		packages_dir = packages_dir or self.config["packages_dir"]
+		if packages is None:
+			packages = set(item for item, repository in get_packages(packages_dir).items() if repository)
+
+		remote_dir = self.ssh(
+			["mktemp", "-d", "-p", REMOTE_TEMP_DIR, "local-repo-remote.XXXXXXXX"], check=True, capture_output=True
+		).stdout.decode("utf8").strip()
+		remote_pkgdest = f"{remote_dir}/pkgdest"
+		remote_packages = f"{remote_dir}/packages"
+		try:
+			print(f"Shipping {len(packages)} package(s) to {self.name}...", file=output, flush=True)
+			self.ssh(["mkdir", remote_pkgdest, remote_packages], check=True)
+			with subprocess.Popen(["tar", "-C", packages_dir, "-c", "-f", "-", "--"] + sorted(packages), stdout=subprocess.PIPE) as archive:
+				shipped = self.ssh(["tar", "-C", remote_packages, "-x", "-f", "-"], stdin=archive.stdout)
+			if archive.returncode != 0 or shipped.returncode != 0:
+				raise RuntimeError(f"Could not ship the packages to {self.name}")
+
+			command = self.get_manager_command(
+				"execute", "--pkgdest", remote_pkgdest, "--packages-dir", remote_packages, "--packages", ",".join(sorted(packages))
+			)
+			if force:
+				command.append("--force")
+
+			# Artifacts are collected periodically while the build runs, and once more after it's done
+			fetched = set()
+			errors = []
+			stopped = Event()
+			thread = Thread(
+				target=self.stream, args=(remote_pkgdest, pkgdest, fetched, stopped, errors), name=f"stream-{self.name}", daemon=True
+			)
+			thread.start()
+			try:
+				result = self.ssh(command, stdout=output, stderr=subprocess.STDOUT)
+			finally:
+				stopped.set()
+				thread.join()
+			if errors:
+				raise errors[0]
+			self.fetch_artifacts(remote_pkgdest, pkgdest, fetched)
+
+			fingerprints = self.ssh(["cat", f"{remote_pkgdest}/{FINGERPRINTS_FILE}"], capture_output=True)
+			if fingerprints.returncode == 0:
+				with open(get_remote_fingerprints_file(pkgdest, self.name), mode="wb") as fp:
+					fp.write(fingerprints.stdout)
+			timings = self.ssh(["cat", f"{remote_pkgdest}/{TIMINGS_FILE}"], capture_output=True)
+			if timings.returncode == 0:
+				with TempDirectory(parent=pkgdest) as directory:
+					with open(os.path.join(directory, TIMINGS_FILE), mode="wb") as fp:
+						fp.write(timings.stdout)
+					TIMINGS.merge(os.path.join(directory, TIMINGS_FILE))
+
+			if result.returncode != 0:
+				raise RuntimeError(f"Remote build has exited with status {result.returncode}")
+		finally:
+			self.ssh(["rm", "-rf", remote_dir], capture_output=True)
+
+	def stream(self, remote_pkgdest, pkgdest, fetched, stopped, errors):
+		while not stopped.wait(self.interval):
+			try:
+				self.fetch_artifacts(remote_pkgdest, pkgdest, fetched)
+			except Exception as e:
+				errors.append(e)
+				return
+
+	def fetch_artifacts(self, remote_pkgdest, pkgdest, fetched):
+
+		"""
+		Copies the artifacts (and signatures) of the packages built on the remote host since the last time
+		into the package destination, writing their markers once they're all in place.
+		"""
+
+		listing = self.ssh([
+			"sh", "-c", 'cd "$1" && for marker in *.done; do [ -f "$marker" ] && printf "%s\\t%s\\n" "$marker" "$(cat "$marker")"; done; true',
+			"sh", remote_pkgdest
+		], check=True, capture_output=True).stdout.decode("utf8")
+
+		for line in listing.splitlines():
+			marker, artifacts = line.split("\t", 1)
+			item = marker[:-len(MARKER_EXTENSION)]
+			if item in fetched:
+				continue
+			artifacts = json.loads(artifacts)
+			with TempDirectory(parent=pkgdest) as staging:
+				with subprocess.Popen(self.get_ssh_command() + [self.name, shlex.join([
+					"sh", "-c", 'cd "$1" && shift && for artifact; do echo "$artifact"; [ -f "$artifact.sig" ] && echo "$artifact.sig"; done | tar -c -f - -T -',
+					"sh", remote_pkgdest
+				] + artifacts)], stdout=subprocess.PIPE) as archive:
+					extracted = subprocess.run(["tar", "-C", staging, "-x", "-f", "-"], stdin=archive.stdout)
+				if archive.returncode != 0 or extracted.returncode != 0:
+					raise RuntimeError(f"Could not fetch the artifacts of {item} from {self.name}")
+				for filename in os.listdir(staging):
+					os.replace(os.path.join(staging, filename), os.path.join(pkgdest, filename))
+			write_marker(pkgdest, item, [os.path.join(pkgdest, x) for x in artifacts])
+			fetched.add(item)
+
+def get_local_executor(config, name=LOCAL_HOST, slots=None):
+	return (NspawnExecutor if config["executor"] == "nspawn" else LocalExecutor)(config, name, slots)
+
+def get_executors(config):
+
+	"""
+	Returns the executors for all the configured build hosts; this host (if it's listed) comes first.
+	"""
+
+	executors = [
+		get_local_executor(config, slots=slots) if host == LOCAL_HOST else SshExecutor(config, host, slots)
+		for host, slots in config["build_hosts"]
+	]
+	return sorted(executors, key=lambda x: x.name != LOCAL_HOST)
+
+def get_package_groups(packages, fingerprints):
+
+	"""
+	Splits given packages into groups which have to be built on the same host, as some of them depend on the others
+	(according to the dependencies and versions recorded by their last builds, in the fingerprints);
+	packages which haven't been built yet are in groups of their own.
+	"""
+
+	producers = {}
+	for item in packages:
+		for name in fingerprints.get(item, {}).get("versions", {}):
+			producers[name] = item
+
+	parent = dict((item, item) for item in packages)
+	def find(item):
+		while parent[item] != item:
+			parent[item] = parent[parent[item]]
+			item = parent[item]
+		return item
+
+	for item in packages:
+		for dependency in fingerprints.get(item, {}).get("dependencies", ()):
+			if dependency in producers:
+				parent[find(item)] = find(producers[dependency])
+
+	groups = defaultdict(list)
+	for item in sorted(packages):
+		groups[find(item)].append(item)
+	return list(groups.values())
+
+def get_build_costs(history_file, packages):
+
+	"""
+	Returns the map of given packages to their typical build time (the median of their makepkg phase
+	in recent runs, from the build history); packages without recorded builds are assumed to take
+	the median time of the others.
+	"""
+
+	costs = {}
+	if history_file and os.path.isfile(history_file):
+		with BuildHistory(history_file) as history:
+			runs = [x[0] for x in history.get_runs(COST_RUNS)]
+			if runs:
+				for (package, phase), values in history.get_phases(runs).items():
+					if phase == "makepkg" and package in packages:
+						costs[package] = statistics.median(wall for wall, _, _ in values.values())
+	default = statistics.median(costs.values()) if costs else 1
+	return dict((item, costs.get(item, default)) for item in packages)
+
+def place_packages(executors, packages, fingerprints, costs, pinned=()):
+
+	"""
+	Splits the packages between the executors according to their capacity; groups of packages which have to be built
+	together are placed one by one, the longest first, on the host which would get through its share the soonest
+	(with its build time divided by its job slots). Packages in `pinned` (like the ones already built by the previous
+	attempt, whose artifacts are on this host) stay with the first executor.
+	Returns the map of the executors to the sets of packages each of them builds.
+	"""
+
+	loads = dict((executor, 0) for executor in executors)
+	placed = defaultdict(set)
+	groups = get_package_groups(packages, fingerprints)
+	for group in sorted(groups, key=lambda x: (-sum(costs[item] for item in x), x)):
+		cost = sum(costs[item] for item in group)
+		if set(pinned) & set(group):
+			executor = executors[0]
+		else:
+			executor = min(executors, key=lambda x: ((loads[x] + cost) / x.slots, executors.index(x)))
+		loads[executor] += cost
+		placed[executor].update(group)
+	return dict(placed)
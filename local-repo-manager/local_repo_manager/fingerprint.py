@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import os.path
+import subprocess
+from threading import Lock
+
+from .build import get_repository
+from .repo import is_newer
+
+FINGERPRINTS_FILE = "fingerprints.json"
+
+def get_upstream_commit(repository):
+
+	"""
+	Returns the commit the upstream repository's HEAD currently points to,
+	or None if it could not be determined (in which case the package should
+	never be considered unchanged).
+	"""
+
+	if not repository:
+		return None
+	result = subprocess.run(
+		["/usr/bin/git", "ls-remote", repository, "HEAD"],
+		capture_output=True, env=dict(os.environ, GIT_TERMINAL_PROMPT="0")
+	)
+	if result.returncode != 0 or not result.stdout:
+		return None
+	return result.stdout.decode("utf8").split()[0]
+
+def hash_directory(directory):
+
+	"""
+	Returns the hash of all the files (their relative paths and contents)
+	within given directory, used to detect changes to patches and scripts.
+	"""
+
+	digest = hashlib.sha256()
+	for root, dirs, files in os.walk(directory):
+		dirs.sort()
+		for filename in sorted(files):
+			path = os.path.join(root, filename)
+			digest.update(os.path.relpath(path, directory).encode("utf8") + b"\0")
+			with open(path, mode="rb") as fp:
+				for chunk in iter(lambda: fp.read(1 << 20), b""):
+					digest.update(chunk)
+			digest.update(b"\0")
+	return digest.hexdigest()
+
+def get_fingerprint(package_dir):
+	return {
+		"upstream": get_upstream_commit(get_repository(package_dir)),
+		"scripts": hash_directory(package_dir)
+	}
+
+class FingerprintStore:
+
+	"""
+	Record of the state of every package (upstream commit and hash of its scripts and patches)
+	at the time of its last build, along with the versions that build produced.
+	The store is read from the repository directory, but since it's not writable from within
+	the container, new fingerprints are collected separately, and saved next to the build artifacts;
+	the `update` action merges them into the store once the build is successful.
+	"""
+
+	__slots__ = ("fingerprints", "lock", "pending")
+
+	def __init__(self, filename):
+		try:
+			with open(filename, mode="rt", encoding="utf8") as fp:
+				self.fingerprints = json.load(fp)
+		except (FileNotFoundError, ValueError):
+			self.fingerprints = {}
+		self.pending = {}
+		self.lock = Lock()
+
+	def is_current(self, item, fingerprint, repo):
+
+		"""
+		Package is considered unchanged if neither of its fingerprints differ from the last build,
+		and the local repository still holds the versions produced by that build.
+		"""
+
+		if None in fingerprint.values():
+			return False
+		stored = self.fingerprints.get(item)
+		if not stored or any(stored.get(key) != value for key, value in fingerprint.items()):
+			return False
+		return all(
+			name in repo and not is_newer(version, repo[name][0])
+			for name, version in stored.get("versions", {}).items()
+		)
+
+	def record(self, item, fingerprint, versions, dependencies=(), build_size=None):
+		with self.lock:
+			self.pending[item] = dict(fingerprint, versions=versions, dependencies=sorted(dependencies))
+			if build_size is not None:
+				self.pending[item]["build_size"] = build_size
+
+	def get_build_size(self, item):
+
+		"""
+		Returns the disk space taken by the last build of given package, if it has been recorded.
+		"""
+
+		return self.fingerprints.get(item, {}).get("build_size")
+
+	def get_build_dependencies(self):
+
+		"""
+		Returns the union of dependencies of all the packages recorded in the store,
+		excluding the ones produced by the packages themselves (as they're built and installed
+		during the build process).
+		"""
+
+		dependencies = set()
+		produced = set()
+		for stored in self.fingerprints.values():
+			dependencies.update(stored.get("dependencies", ()))
+			produced.update(stored.get("versions", {}).keys())
+		return dependencies - produced
+
+	def save_pending(self, filename):
+		with open(filename, mode="wt", encoding="utf8") as fp:
+			json.dump(self.pending, fp, indent="\t", sort_keys=True)
+
+	@staticmethod
+	def merge(filename, pending_filename):
+
+		"""
+		Merges fingerprints collected during the build (if there are any) into the store.
+		The file is replaced atomically, so that interrupted update doesn't corrupt it.
+		"""
+
+		try:
+			with open(pending_filename, mode="rt", encoding="utf8") as fp:
+				pending = json.load(fp)
+		except FileNotFoundError:
+			return
+
+		store = FingerprintStore(filename)
+		store.fingerprints.update(pending)
+		with open(f"{filename}.tmp", mode="wt", encoding="utf8") as fp:
+			json.dump(store.fingerprints, fp, indent="\t", sort_keys=True)
+		os.replace(f"{filename}.tmp", filename)
+
+	@staticmethod
+	def combine(pending_filename, *other_filenames):
+
+		"""
+		Adds the fingerprints collected separately (like by other build hosts) into the pending ones,
+		removing the files they've been collected in.
+		"""
+
+		try:
+			with open(pending_filename, mode="rt", encoding="utf8") as fp:
+				pending = json.load(fp)
+		except (FileNotFoundError, ValueError):
+			pending = {}
+		for filename in other_filenames:
+			with open(filename, mode="rt", encoding="utf8") as fp:
+				pending.update(json.load(fp))
+		with open(f"{pending_filename}.tmp", mode="wt", encoding="utf8") as fp:
+			json.dump(pending, fp, indent="\t", sort_keys=True)
+		os.replace(f"{pending_filename}.tmp", pending_filename)
+		for filename in other_filenames:
+			os.unlink(filename)
@@ -0,0 +1,173 @@
+from collections import defaultdict
+import os
+import os.path
+import sqlite3
+import statistics
+import time
+
+from .timing import TIMINGS
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	started REAL,
+	finished REAL,
+	status TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+	run INTEGER REFERENCES runs(id) ON DELETE CASCADE,
+	package TEXT,
+	phase TEXT,
+	wall REAL,
+	cpu REAL,
+	max_rss INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_run ON phases(run);
+"""
+
+class BuildHistory:
+
+	"""
+	Local SQLite database of the timings of all the phases of every update run,
+	used to show the trends, slowest phases and regressions between the runs.
+	Used as context manager, yields itself with the connection open.
+	"""
+
+	__slots__ = ("connection", "history_file")
+
+	def __init__(self, history_file):
+		self.history_file = history_file
+
+	def __enter__(self):
+		self.connection = sqlite3.connect(self.history_file)
+		self.connection.executescript(HISTORY_SCHEMA)
+		self.connection.execute("PRAGMA foreign_keys = ON")
+		return self
+
+	def __exit__(self, *args):
+		self.connection.close()
+		del self.connection
+
+	def record_run(self, started, finished, status, phases):
+		with self.connection:
+			run = self.connection.execute(
+				"INSERT INTO runs (started, finished, status) VALUES (?, ?, ?)", (started, finished, status)
+			).lastrowid
+			self.connection.executemany(
+				"INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?)",
+				((run, x["package"], x["phase"], x["wall"], x["cpu"], x["max_rss"]) for x in phases)
+			)
+		return run
+
+	def get_runs(self, limit):
+		return list(reversed(self.connection.execute(
+			"SELECT id, started, finished, status FROM runs ORDER BY id DESC LIMIT ?", (limit,)
+		).fetchall()))
+
+	def get_phases(self, runs, package=None):
+
+		"""
+		Returns the map of (package, phase) to the map of run to wall time, CPU time and peak memory
+		of that phase in given runs (phases repeated within a run are summed up, with peak memory being the highest
+		of the known ones, or None if it's not known for any of them).
+		"""
+
+		phases = defaultdict(dict)
+		query = "SELECT run, package, phase, wall, cpu, max_rss FROM phases WHERE run IN ({0})".format(",".join("?" * len(runs)))
+		parameters = list(runs)
+		if package is not None:
+			query += " AND package = ?"
+			parameters.append(package)
+		for run, package, phase, wall, cpu, max_rss in self.connection.execute(query, parameters):
+			total_wall, total_cpu, peak = phases[(package, phase)].get(run, (0, 0, None))
+			phases[(package, phase)][run] = (total_wall + wall, total_cpu + cpu, max_known((peak, max_rss)))
+		return phases
+
+def max_known(values):
+	known = [x for x in values if x is not None]
+	return max(known) if known else None
+
+def get_regressions(phases, run, threshold=1.5, minimum=5):
+
+	"""
+	Returns the list of (package, phase, median of previous runs, time in given run) for phases
+	which took at least `threshold` times longer in given run than the median of the previous ones
+	(ignoring the phases shorter than `minimum` seconds, as their timings are mostly noise).
+	"""
+
+	regressions = []
+	for (package, phase), runs in sorted(phases.items()):
+		previous = [wall for other, (wall, _, _) in runs.items() if other < run]
+		if run not in runs or not previous:
+			continue
+		wall = runs[run][0]
+		median = statistics.median(previous)
+		if wall >= minimum and wall > median * threshold:
+			regressions.append((package, phase, median, wall))
+	return regressions
+
+def escape_label(value):
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus_textfile(filename, started, finished, status, phases):
+
+	"""
+	Writes the timings of the run in Prometheus text format, for node_exporter's textfile collector.
+	The file is written atomically, so that the collector never sees partial contents.
+	"""
+
+	metrics = (
+		("local_repo_phase_seconds", "Wall time of the phase of the last update", "wall"),
+		("local_repo_phase_cpu_seconds", "CPU time of the phase of the last update", "cpu"),
+		("local_repo_phase_max_rss_bytes", "Peak memory of the processes run within the phase of the last update", "max_rss")
+	)
+
+	totals = defaultdict(lambda: {"wall": 0, "cpu": 0, "max_rss": None})
+	for x in phases:
+		total = totals[(x["package"], x["phase"])]
+		total["wall"] += x["wall"]
+		total["cpu"] += x["cpu"]
+		total["max_rss"] = max_known((total["max_rss"], x["max_rss"]))
+
+	with open(f"{filename}.tmp", mode="wt", encoding="utf8") as fp:
+		for name, description, key in metrics:
+			fp.write(f"# HELP {name} {description}\n# TYPE {name} gauge\n")
+			for (package, phase), total in sorted(totals.items()):
+				if total[key] is None:
+					continue
+				fp.write(f'{name}{{package="{escape_label(package)}",phase="{escape_label(phase)}"}} {total[key]}\n')
+		fp.write("# HELP local_repo_last_run_timestamp_seconds Time the last update finished at\n# TYPE local_repo_last_run_timestamp_seconds gauge\n")
+		fp.write(f"local_repo_last_run_timestamp_seconds {finished}\n")
+		fp.write("# HELP local_repo_last_run_duration_seconds Duration of the last update\n# TYPE local_repo_last_run_duration_seconds gauge\n")
+		fp.write(f"local_repo_last_run_duration_seconds {finished - started}\n")
+		fp.write("# HELP local_repo_last_run_success Whether the last update has succeeded\n# TYPE local_repo_last_run_success gauge\n")
+		fp.write(f"local_repo_last_run_success {int(status == 'success')}\n")
+	os.replace(f"{filename}.tmp", filename)
+
+class RecordRun:
+
+	"""
+	Context manager wrapping the whole update; once it's done (successfully or not),
+	the timings of all its phases are recorded into the build history,
+	and written into Prometheus textfile, if either of those is configured.
+	"""
+
+	__slots__ = ("history_file", "started", "textfile")
+
+	def __init__(self, history_file=None, textfile=None):
+		self.history_file = history_file
+		self.textfile = textfile
+
+	def __enter__(self):
+		TIMINGS.reset()
+		self.started = TIMINGS.started
+		return self
+
+	def __exit__(self, *args):
+		finished = time.time()
+		status = "success" if args[0] is None else "failed"
+		if self.history_file:
+			with BuildHistory(self.history_file) as history:
+				history.record_run(self.started, finished, status, TIMINGS.phases)
+		if self.textfile:
+			write_prometheus_textfile(self.textfile, self.started, finished, status, TIMINGS.phases)
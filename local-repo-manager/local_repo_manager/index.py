@@ -0,0 +1,264 @@
+import hashlib
+import os
+import os.path
+import sqlite3
+
+from .archive import open_archive
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+	entry TEXT PRIMARY KEY,
+	entry_size INTEGER,
+	entry_mtime INTEGER,
+	name TEXT,
+	version TEXT,
+	filename TEXT,
+	csize INTEGER,
+	isize INTEGER,
+	sha256sum TEXT
+);
+CREATE TABLE IF NOT EXISTS depends (
+	entry TEXT REFERENCES packages(entry) ON DELETE CASCADE,
+	kind TEXT,
+	depend TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_name ON packages(name);
+CREATE INDEX IF NOT EXISTS depends_entry ON depends(entry);
+CREATE INDEX IF NOT EXISTS depends_depend ON depends(depend);
+"""
+
+# Additional tables of the files database's index; paths are also stored reversed
+# (and without trailing slash of the directories), so that suffix lookups can use the index
+FILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+	entry TEXT REFERENCES packages(entry) ON DELETE CASCADE,
+	path TEXT,
+	basename TEXT,
+	reversed TEXT
+);
+CREATE INDEX IF NOT EXISTS files_entry ON files(entry);
+CREATE INDEX IF NOT EXISTS files_reversed ON files(reversed);
+"""
+
+# Fields of desc file which list dependencies, and how they're labelled in the index
+DEPEND_FIELDS = {
+	"DEPENDS": "depends",
+	"MAKEDEPENDS": "makedepends",
+	"CHECKDEPENDS": "checkdepends",
+	"OPTDEPENDS": "optdepends",
+	"PROVIDES": "provides",
+	"CONFLICTS": "conflicts",
+	"REPLACES": "replaces"
+}
+
+def get_index_file(repository_file):
+	return f"{repository_file}.index"
+
+def hash_file(path, chunk_size=1 << 20):
+	digest = hashlib.sha256()
+	with open(path, mode="rb") as fp:
+		for chunk in iter(lambda: fp.read(chunk_size), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def parse_desc(lines):
+
+	"""
+	Parses the desc file of pacman's repository database (given as iterable of lines),
+	returning a map of all its fields (like "NAME" or "DEPENDS") to lists of values.
+	"""
+
+	fields = {}
+	current = None
+	for line in lines:
+		line = line.rstrip("\n")
+		if not line:
+			current = None
+		elif current is None and line.startswith("%") and line.endswith("%"):
+			current = fields.setdefault(line[1:-1], [])
+		elif current is not None:
+			current.append(line)
+	return fields
+
+class RepoIndex:
+
+	"""
+	Persistent SQLite index of the repository database, kept next to the repository file.
+	The index is considered current as long as the modification time, size and hash
+	of the repository file match the ones recorded at its last refresh; otherwise,
+	the database is streamed through, and only the entries that have changed since
+	are read and parsed again.
+	Used as context manager, yields the SQLite connection with up-to-date contents.
+	"""
+
+	__slots__ = ("connection", "index_file", "repository_file")
+
+	SCHEMA = INDEX_SCHEMA
+
+	# Files of each entry (besides its desc) whose contents are passed on to store_entry
+	MEMBERS = ()
+
+	def __init__(self, repository_file, index_file=None):
+		self.repository_file = repository_file
+		self.index_file = index_file or get_index_file(repository_file)
+
+	def __enter__(self):
+		try:
+			self.connection = sqlite3.connect(self.index_file)
+			self.connection.executescript(self.SCHEMA)
+		except sqlite3.Error:
+			# If the index can't be persisted (like on read-only repository directory),
+			# we still get the benefit of the structured queries, just without caching
+			self.connection = sqlite3.connect(":memory:")
+			self.connection.executescript(self.SCHEMA)
+		self.connection.execute("PRAGMA foreign_keys = ON")
+		self.refresh()
+		return self.connection
+
+	def __exit__(self, *args):
+		self.connection.close()
+		del self.connection
+
+	def get_meta(self):
+		return dict(self.connection.execute("SELECT key, value FROM meta"))
+
+	def set_meta(self, **values):
+		self.connection.executemany(
+			"INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+			((key, str(value)) for key, value in values.items())
+		)
+
+	def refresh(self):
+
+		"""
+		Brings the index in line with current state of the repository file.
+		Returns True if the repository had to be read, False if the index was current.
+		"""
+
+		try:
+			stat = os.stat(self.repository_file)
+		except FileNotFoundError:
+			with self.connection:
+				self.connection.execute("DELETE FROM packages")
+				self.connection.execute("DELETE FROM meta")
+			return True
+
+		meta = self.get_meta()
+		if meta.get("mtime") == str(stat.st_mtime_ns) and meta.get("size") == str(stat.st_size):
+			return False
+
+		# Modification time and size have changed, but the contents might not have;
+		# in which case we just take note of new file stats
+		digest = hash_file(self.repository_file)
+		if meta.get("sha256") == digest:
+			with self.connection:
+				self.set_meta(mtime=stat.st_mtime_ns, size=stat.st_size)
+			return False
+
+		with self.connection:
+			self.update_entries()
+			self.set_meta(mtime=stat.st_mtime_ns, size=stat.st_size, sha256=digest)
+		return True
+
+	def update_entries(self):
+
+		"""
+		Streams through the repository database, re-reading only desc files of entries
+		which are either new or have changed size or modification time,
+		then drops the entries which are no longer present in the database.
+		"""
+
+		known = dict(
+			(entry, (size, mtime))
+			for entry, size, mtime in self.connection.execute("SELECT entry, entry_size, entry_mtime FROM packages")
+		)
+		seen = set()
+
+		for entry, item, contents in self.read_entries():
+			seen.add(entry)
+			if known.get(entry) == (item.size, int(item.mtime)):
+				continue
+			desc = parse_desc(contents["desc"].decode("utf8").splitlines())
+			self.store_entry(entry, item, desc, contents)
+
+		self.connection.executemany(
+			"DELETE FROM packages WHERE entry = ?",
+			((entry,) for entry in known.keys() - seen)
+		)
+
+	def read_entries(self):
+
+		"""
+		Yields the entries of the repository database, along with the tar member of their desc file
+		and the contents of it and the files listed in MEMBERS. Files of each entry are expected
+		to be stored next to each other (as both repo-add and write_db do), but in any order.
+		"""
+
+		entry = item = None
+		contents = {}
+		with open_archive(self.repository_file) as tf:
+			for member in tf:
+				directory, filename = os.path.split(member.name)
+				if not member.isfile() or (filename != "desc" and filename not in self.MEMBERS):
+					continue
+				if directory != entry:
+					if item is not None:
+						yield (entry, item, contents)
+					entry, item, contents = directory, None, {}
+				if filename == "desc":
+					item = member
+				with tf.extractfile(member) as fp:
+					contents[filename] = fp.read()
+		if item is not None:
+			yield (entry, item, contents)
+
+	def store_entry(self, entry, item, desc, contents=None):
+
+		def single(key, convert=str):
+			return convert(desc[key][0]) if desc.get(key) else None
+
+		self.connection.execute("DELETE FROM packages WHERE entry = ?", (entry,))
+		self.connection.execute(
+			"INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(
+				entry, item.size, int(item.mtime),
+				single("NAME"), single("VERSION"), single("FILENAME"),
+				single("CSIZE", int), single("ISIZE", int), single("SHA256SUM")
+			)
+		)
+		self.connection.executemany(
+			"INSERT INTO depends (entry, kind, depend) VALUES (?, ?, ?)",
+			(
+				(entry, kind, depend)
+				for field, kind in DEPEND_FIELDS.items()
+				for depend in desc.get(field, ())
+			)
+		)
+
+class FilesIndex(RepoIndex):
+
+	"""
+	Persistent index of the files database (like repo.files.tar.xz), which on top of the contents
+	of the repository index holds the lists of files shipped by each package. It's kept up to date
+	the same way; only the entries which have changed are read again.
+	"""
+
+	__slots__ = ()
+
+	SCHEMA = INDEX_SCHEMA + FILES_SCHEMA
+	MEMBERS = ("files",)
+
+	def store_entry(self, entry, item, desc, contents=None):
+		super().store_entry(entry, item, desc)
+		files = parse_desc(contents.get("files", b"").decode("utf8").splitlines()).get("FILES", ())
+		self.connection.executemany(
+			"INSERT INTO files (entry, path, basename, reversed) VALUES (?, ?, ?, ?)",
+			(
+				(entry, path, os.path.basename(path.rstrip("/")), path.rstrip("/")[::-1])
+				for path in files
+			)
+		)
@@ -0,0 +1,154 @@
+import errno
+import fcntl
+import json
+import os
+import os.path
+from shutil import copy2
+import sys
+from threading import Event, Thread
+import time
+
+from .repodb import add_packages, refresh_indexes
+from .timing import TIMINGS, run_measured
+
+# ioctl request for cloning file contents (reflink) on filesystems supporting it (btrfs, XFS)
+FICLONE = 0x40049409
+
+MARKER_EXTENSION = ".done"
+
+def reflink(source, target):
+	with open(source, mode="rb") as src, open(target, mode="wb") as dst:
+		fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def move_artifact(source, directory):
+
+	"""
+	Moves the build artifact (and its signature, if there is one) into given directory,
+	in the cheapest way available: hardlink if both are on the same filesystem, reflink
+	if the filesystem supports it, and full copy only as the last resort.
+	Returns the new location of the artifact.
+	"""
+
+	for path in (source, source + ".sig"):
+		if not os.path.isfile(path):
+			continue
+
+		target = os.path.join(directory, os.path.basename(path))
+		if os.path.lexists(target):
+			os.unlink(target)
+		try:
+			os.link(path, target)
+		except OSError as e:
+			if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+			try:
+				reflink(path, target)
+				os.chmod(target, os.stat(path).st_mode & 0o777)
+			except OSError:
+				copy2(path, target)
+		os.unlink(path)
+
+	return os.path.join(directory, os.path.basename(source))
+
+def add_to_repository(config, artifacts):
+
+	"""
+	Registers artifacts (already within repository directory) in the repository database,
+	with the tool selected in the configuration, then refreshes the indexes of the databases.
+	"""
+
+	start = time.monotonic()
+	if config["repository_writer"] == "repo-add":
+		run_measured(
+			["/usr/bin/repo-add", "--new", config["repository_file"]] + artifacts,
+			check=True, stdout=sys.stdout, stderr=sys.stderr
+		)
+	else:
+		add_packages(config["repository_file"], artifacts)
+	refresh_indexes(config["repository_file"])
+	print(f"\nRepository updated in {time.monotonic() - start:.2f}s")
+
+def write_marker(directory, item, artifacts):
+
+	"""
+	Used within the container to signal that all the artifacts of given package
+	have been fully written to the destination directory, and can be picked up.
+	The marker is written atomically, so its presence means it's complete.
+	"""
+
+	marker = os.path.join(directory, item + MARKER_EXTENSION)
+	with open(marker + ".tmp", mode="wt", encoding="utf8") as fp:
+		json.dump([os.path.basename(x) for x in artifacts], fp)
+	os.replace(marker + ".tmp", marker)
+
+def read_marker(directory, item):
+
+	"""
+	Returns the artifacts (as full paths) listed by the marker of given package, or None if there's no marker.
+	"""
+
+	try:
+		with open(os.path.join(directory, item + MARKER_EXTENSION), mode="rt", encoding="utf8") as fp:
+			return [os.path.join(directory, x) for x in json.load(fp)]
+	except FileNotFoundError:
+		return None
+
+class ArtifactIngest:
+
+	"""
+	Context manager watching the package destination directory while the build runs,
+	and moving the artifacts of each package into the repository (and registering them)
+	as soon as the package has been built, without waiting for the rest of the build.
+	Packages are picked up by the markers written alongside their artifacts;
+	once the context exits, any remaining markers are processed as well.
+	"""
+
+	__slots__ = ("added", "config", "directory", "error", "interval", "stopped", "thread")
+
+	def __init__(self, directory, config, interval=5):
+		self.added = []
+		self.config = config
+		self.directory = directory
+		self.error = None
+		self.interval = interval
+		self.stopped = Event()
+
+	def __enter__(self):
+		self.thread = Thread(target=self.watch, name="artifact-ingest", daemon=True)
+		self.thread.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stopped.set()
+		self.thread.join()
+		del self.thread
+		if self.error is None:
+			self.ingest()
+		if self.error is not None and args[0] is None:
+			raise self.error
+
+	def watch(self):
+		while not self.stopped.wait(self.interval):
+			try:
+				self.ingest()
+			except Exception as e:
+				# Errors are reported once the build is done; further ingestion is abandoned,
+				# leaving the artifacts in place
+				self.error = e
+				return
+
+	def ingest(self):
+		for entry in sorted(os.listdir(self.directory)):
+			if not entry.endswith(MARKER_EXTENSION):
+				continue
+
+			item = entry[:-len(MARKER_EXTENSION)]
+			artifacts = read_marker(self.directory, item)
+			print(f"Adding artifacts of {item} to local repository...")
+			with TIMINGS.phase("artifacts", item):
+				moved = [move_artifact(x, self.config["repository_dir"]) for x in artifacts if os.path.isfile(x)]
+			if moved:
+				with TIMINGS.phase("repository", item):
+					add_to_repository(self.config, moved)
+				self.added.extend(moved)
+			os.unlink(os.path.join(self.directory, entry))
@@ -0,0 +1,158 @@
+import math
+import os
+import os.path
+import re
+import subprocess
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MATCH_MAKE_VERSION = re.compile(r'^GNU Make (\d+)\.(\d+)')
+
+def supports_fifo_jobserver():
+
+	"""
+	Checks whether the installed make can use the jobserver over a named pipe (added in make 4.4);
+	older versions refuse to build at all when pointed at one.
+	"""
+
+	try:
+		output = subprocess.run(["make", "--version"], capture_output=True).stdout.decode("utf8")
+	except OSError:
+		return False
+	match = MATCH_MAKE_VERSION.match(output)
+	return bool(match) and (int(match.group(1)), int(match.group(2))) >= (4, 4)
+
+def get_cgroup_path():
+
+	"""
+	Returns the path to the (unified hierarchy) cgroup of the current process, or None if it can't be determined.
+	Within the container, the cgroup namespace makes it relative to the container's own cgroup.
+	"""
+
+	try:
+		with open("/proc/self/cgroup", mode="rt", encoding="utf8") as fp:
+			for line in fp:
+				if line.startswith("0::"):
+					return os.path.normpath(os.path.join(CGROUP_ROOT, line[3:].strip().lstrip("/")))
+	except OSError:
+		pass
+	return None
+
+def read_cgroup_values(filename):
+
+	"""
+	Yields the contents of given cgroup file (split into values) for the current cgroup and all its ancestors,
+	as the limits of any of them apply to the current process.
+	"""
+
+	path = get_cgroup_path()
+	while path and path.startswith(CGROUP_ROOT):
+		try:
+			with open(os.path.join(path, filename), mode="rt", encoding="utf8") as fp:
+				yield (path, fp.read().split())
+		except OSError:
+			pass
+		if path == CGROUP_ROOT:
+			break
+		path = os.path.dirname(path)
+
+def get_available_cpus():
+
+	"""
+	Returns the number of CPUs the builds can keep busy; the CPUs the process is allowed to run on,
+	further limited by the CPU quota of its cgroup (like the one set on the container), if there's any.
+	"""
+
+	cpus = len(os.sched_getaffinity(0))
+	for _, values in read_cgroup_values("cpu.max"):
+		if len(values) == 2 and values[0] != "max":
+			cpus = min(cpus, max(1, math.ceil(int(values[0]) / int(values[1]))))
+	return cpus
+
+def get_available_memory():
+
+	"""
+	Returns the amount of memory (in bytes) available for the builds; the memory available on the system,
+	further limited by the memory limits of the cgroup (like the ones set on the container), if there are any.
+	"""
+
+	available = None
+	try:
+		with open("/proc/meminfo", mode="rt", encoding="utf8") as fp:
+			for line in fp:
+				if line.startswith("MemAvailable:"):
+					available = int(line.split()[1]) * 1024
+	except OSError:
+		pass
+
+	for filename in ("memory.max", "memory.high"):
+		for path, values in read_cgroup_values(filename):
+			if values and values[0] != "max":
+				try:
+					with open(os.path.join(path, "memory.current"), mode="rt", encoding="utf8") as fp:
+						current = int(fp.read())
+				except OSError:
+					current = 0
+				limit = max(0, int(values[0]) - current)
+				available = limit if available is None else min(available, limit)
+	return available
+
+def get_job_slots(memory_per_job, max_jobs=0, reserved=0):
+
+	"""
+	Returns the number of jobs all the builds can run at once; one per available CPU, as long as
+	each of them can have `memory_per_job` bytes of the available memory, apart from `reserved` bytes
+	(like the ones set aside for tmpfs), and no more than `max_jobs`, if that's provided.
+	Returns the number of slots along with the CPUs and memory it's based on.
+	"""
+
+	cpus = get_available_cpus()
+	memory = get_available_memory()
+	slots = cpus
+	if memory is not None and memory_per_job:
+		slots = min(slots, max(0, memory - reserved) // memory_per_job)
+	if max_jobs:
+		slots = min(slots, max_jobs)
+	return (max(1, slots), cpus, memory)
+
+class Jobserver:
+
+	"""
+	GNU make jobserver shared by all the builds, so that the packages built concurrently (and all
+	the recursive makes within them) never run more jobs in total than there are slots for.
+	The jobserver is a named pipe (as supported by make 4.4), rather than inherited file descriptors,
+	since those don't make it through sudo. Each of the top-level makes holds one slot implicitly,
+	so the pipe is filled with tokens for the rest of the slots.
+	Used as context manager, yields the MAKEFLAGS pointing the makes to the jobserver;
+	if make is too old to use it, the slots are split evenly between the concurrent builds instead.
+	"""
+
+	__slots__ = ("concurrent", "directory", "fd", "path", "slots", "uid")
+
+	def __init__(self, directory, slots, concurrent=1, uid=None):
+		self.directory = directory
+		self.slots = slots
+		self.concurrent = concurrent
+		self.uid = uid
+
+	def __enter__(self):
+		self.path = None
+		if not supports_fifo_jobserver():
+			return f"-j{max(1, self.slots // self.concurrent)}"
+
+		self.path = os.path.join(self.directory, "jobserver.fifo")
+		os.mkfifo(self.path, mode=0o600)
+		if self.uid is not None:
+			os.chown(self.path, self.uid, self.uid)
+
+		# Pipe is kept open (for both reading and writing) for the whole run, so that the tokens
+		# aren't lost in between the builds, when no make has it open
+		self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+		os.write(self.fd, b"+" * max(0, self.slots - self.concurrent))
+		return f"-j{self.slots} --jobserver-auth=fifo:{self.path}"
+
+	def __exit__(self, *args):
+		if self.path:
+			os.close(self.fd)
+			os.unlink(self.path)
+			del self.fd
+		del self.path
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import os.path
+from shutil import rmtree
+
+from .build import run_within_container
+
+# Directories of the host system that get persistent overlay in the container;
+# these are the only ones pacman writes to when installing packages
+LAYER_DIRECTORIES = ("/usr", "/etc", "/opt", "/var/lib/pacman")
+
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+
+# Script run within the provisioning container; it only installs the dependencies
+# not already satisfied by the host system or the layer
+PROVISION_SCRIPT = """set -e
+/usr/bin/dhclient host0
+missing="$(/usr/bin/pacman -T "$@" || true)"
+if [ -n "$missing" ]; then
+	/usr/bin/pacman -S --needed --asdeps --noconfirm $missing
+fi
+"""
+
+def get_host_packages_hash():
+
+	"""
+	Returns the hash of the set of packages installed on the host (and their versions),
+	as listed in the local pacman database. Any change to host packages invalidates the layer,
+	as its contents were installed on top of previous state of the host.
+	"""
+
+	digest = hashlib.sha256()
+	for entry in sorted(os.listdir(PACMAN_LOCAL_DB)):
+		digest.update(entry.encode("utf8") + b"\n")
+	return digest.hexdigest()
+
+class BuildLayer:
+
+	"""
+	Persistent layer with build dependencies of all the packages pre-installed,
+	overlaid on top of the host system's directories within the container.
+	The layer records the state of host packages and the set of dependencies it was provisioned with;
+	it only needs to be provisioned again when either of them changes. When host packages change,
+	the layer is discarded and provisioned from scratch.
+	"""
+
+	__slots__ = ("directory", "state")
+
+	def __init__(self, directory):
+		self.directory = directory
+		try:
+			with open(self.get_state_file(), mode="rt", encoding="utf8") as fp:
+				self.state = json.load(fp)
+		except (FileNotFoundError, ValueError):
+			self.state = {}
+
+	def get_state_file(self):
+		return os.path.join(self.directory, "state.json")
+
+	def get_upper_dir(self, directory):
+		return os.path.join(self.directory, "upper", directory.lstrip("/"))
+
+	def is_current(self, dependencies):
+		return (
+			self.state.get("host") == get_host_packages_hash()
+			and set(dependencies).issubset(self.state.get("dependencies", ()))
+		)
+
+	def get_overlays(self, writable=False):
+
+		"""
+		Returns the overlays for the container, with the layer over host directories.
+		When provisioning, the layer is the upper directory, so all the changes go into it;
+		otherwise, the layer is read-only, and the changes go into temporary directory instead
+		(the empty upper directory in nspawn's --overlay option).
+		"""
+
+		return [
+			(directory, self.get_upper_dir(directory), directory) if writable
+			else (directory, self.get_upper_dir(directory), "", directory)
+			for directory in LAYER_DIRECTORIES
+		]
+
+	def prepare(self, dependencies):
+
+		"""
+		Sets up the layer's directories for provisioning with given dependencies,
+		discarding the layer contents if host packages have changed since it was provisioned.
+		Returns the full set of dependencies the layer needs to have installed.
+		"""
+
+		host = get_host_packages_hash()
+		dependencies = set(dependencies)
+		if self.state.get("host") != host:
+			rmtree(os.path.join(self.directory, "upper"), ignore_errors=True)
+		else:
+			dependencies.update(self.state.get("dependencies", ()))
+
+		for directory in LAYER_DIRECTORIES:
+			os.makedirs(self.get_upper_dir(directory), exist_ok=True)
+		self.state = {"host": host, "dependencies": sorted(dependencies)}
+		return dependencies
+
+	def provision(self, dependencies, *bind_dirs, extra_params=None, log_output=None):
+
+		"""
+		Installs given dependencies into the layer, using the container with the layer
+		as writable overlay. The state of the layer is only saved if provisioning succeeds;
+		otherwise, the layer is considered invalid, and will be provisioned from scratch next time.
+		"""
+
+		dependencies = self.prepare(dependencies)
+		try:
+			run_within_container(
+				["/bin/bash", "-c", PROVISION_SCRIPT, "provision"] + sorted(dependencies), *bind_dirs,
+				overlays=self.get_overlays(writable=True), extra_params=extra_params, log_output=log_output
+			)
+		except Exception:
+			self.state = {}
+			raise
+		self.save()
+
+	def save(self):
+		with open(self.get_state_file() + ".tmp", mode="wt", encoding="utf8") as fp:
+			json.dump(self.state, fp, indent="\t")
+		os.replace(self.get_state_file() + ".tmp", self.get_state_file())
@@ -1,29 +1,315 @@
+from abc import ABC, abstractmethod
+from collections import deque
 from datetime import datetime
+from itertools import count
+import json
+import os
 import os.path
+from shutil import rmtree
+import subprocess
 import sys
+from threading import Lock, Thread
 
-class LogToFile:
+# Streaming compressors used for the log files (by the name used in configuration),
+# along with the extension of compressed files
+LOG_COMPRESSORS = {
+	"zst": (".zst", ["zstd", "-q", "-c"]),
+	"xz": (".xz", ["xz", "-c"]),
+	"none": ("", None)
+}
+LOG_DECOMPRESSORS = {
+	".zst": ["zstd", "-d", "-q", "-c"],
+	".xz": ["xz", "-d", "-c"]
+}
 
-	__slots__ = ("fp", "log_directory")
+LOG_INDEX_FILE = "index.json"
 
-	def __init__(self, log_directory):
-		self.log_directory = log_directory
+# Main build log is keyed in the index under the name no package directory can have, and written
+# next to the directory with the logs of the packages, so that no package can take either of its places
+MAIN_LOG = ""
+MAIN_LOG_FILE = "build"
+PACKAGE_LOGS_DIR = "packages"
+
+# Key of the main build log in the index of the runs recorded before it was moved to MAIN_LOG
+LEGACY_MAIN_LOG = "build"
+
+# Number of last lines of each log file kept in the index, so they can be shown without decompressing
+TAIL_LINES = 50
+
+# Lines written by each package's build are tagged with the package name, so that the output
+# of packages built concurrently within the container can be split back into separate logs
+PACKAGE_TAG = "\x1e"
+PACKAGE_TAG_END = "\x1f"
+
+# Output of concurrently built packages is relayed line by line, with each line written whole
+OUTPUT_LOCK = Lock()
+
+def get_log_index(log_directory):
+	try:
+		with open(os.path.join(log_directory, LOG_INDEX_FILE), mode="rt", encoding="utf8") as fp:
+			return json.load(fp)
+	except (FileNotFoundError, ValueError):
+		return {"runs": []}
+
+def save_log_index(log_directory, index):
+	filename = os.path.join(log_directory, LOG_INDEX_FILE)
+	with open(f"{filename}.tmp", mode="wt", encoding="utf8") as fp:
+		json.dump(index, fp, indent="\t")
+	os.replace(f"{filename}.tmp", filename)
+
+def read_log(path):
+
+	"""
+	Yields the lines (as strings) of the given, possibly compressed, log file,
+	decompressing it as a stream rather than as a whole.
+	"""
+
+	command = LOG_DECOMPRESSORS.get(os.path.splitext(path)[1])
+	if not command:
+		with open(path, mode="rt", encoding="utf8", errors="replace") as fp:
+			yield from fp
+		return
+
+	process = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+	try:
+		for line in process.stdout:
+			yield line.decode("utf8", errors="replace")
+	finally:
+		process.stdout.close()
+		process.wait()
+
+def select_logs(index, package=None, run=None, all_runs=False):
+
+	"""
+	Returns the list of (run name, index entry) for the logs of given package (or the main build log)
+	in the selected runs: the given one, all of them, or the most recent one.
+	"""
+
+	if all_runs:
+		runs = index["runs"]
+	elif run:
+		runs = [x for x in index["runs"] if x["run"] == run]
+		if not runs:
+			raise RuntimeError(f"No logs recorded for run {run}")
+	else:
+		runs = index["runs"][-1:]
+	keys = (package,) if package else (MAIN_LOG, LEGACY_MAIN_LOG)
+	results = []
+	for x in runs:
+		key = next((key for key in keys if key in x["files"]), None)
+		if key is not None:
+			results.append((x["run"], x["files"][key]))
+	return results
+
+def apply_retention(log_directory, index, keep_runs=0, max_size=0):
+
+	"""
+	Removes the oldest runs (both their logs and index entries) until there are at most `keep_runs`
+	runs and their logs take at most `max_size` bytes in total (either limit is ignored if zero).
+	The most recent run is always kept.
+	"""
+
+	runs = index["runs"]
+	total_size = sum(entry["size"] for run in runs for entry in run["files"].values())
+	while len(runs) > 1 and ((keep_runs and len(runs) > keep_runs) or (max_size and total_size > max_size)):
+		run = runs.pop(0)
+		total_size -= sum(entry["size"] for entry in run["files"].values())
+		rmtree(os.path.join(log_directory, run["run"]), ignore_errors=True)
+
+class LogStream:
+
+	"""
+	Single log file written through a streaming compressor (if any), with every line timestamped.
+	The number of lines, both sizes and the last lines are kept for the index.
+	"""
+
+	__slots__ = ("bytes", "file", "first", "last", "lines", "path", "process", "tail")
+
+	def __init__(self, path, compression):
+		extension, command = LOG_COMPRESSORS[compression]
+		self.path = path + extension
+		self.file = open(self.path, mode="wb")
+		self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.file) if command else None
+		self.bytes = self.lines = 0
+		self.first = self.last = None
+		self.tail = deque(maxlen=TAIL_LINES)
+
+	def write(self, line):
+		timestamp = datetime.now().strftime("%H:%M:%S")
+		self.first = self.first or timestamp
+		self.last = timestamp
+		data = timestamp.encode() + b" " + line
+		(self.process.stdin if self.process else self.file).write(data)
+		self.bytes += len(data)
+		self.lines += 1
+		self.tail.append(data.decode("utf8", errors="replace").rstrip("\n"))
+
+	def close(self):
+		if self.process:
+			self.process.stdin.close()
+			self.process.wait()
+		self.file.close()
+		return {
+			"file": os.path.basename(self.path),
+			"lines": self.lines,
+			"bytes": self.bytes,
+			"size": os.path.getsize(self.path),
+			"first": self.first,
+			"last": self.last,
+			"tail": list(self.tail)
+		}
+
+class LogPipe(ABC):
+
+	"""
+	Base for the log targets; provides the file object writing into the pipe, which can be
+	given to subprocesses (like nspawn container) as their output, and the thread reading
+	from the other end of the pipe, handing each line (along with the package it's tagged with,
+	if any) to the handle method.
+	"""
+
+	__slots__ = ("fp", "reader", "thread")
 
 	def __enter__(self):
-		current_time = datetime.now()
-		log_filename = "build-{0:%Y-%m-%dT%H-%M-%S}.log".format(current_time)
-		self.fp = open(os.path.join(self.log_directory, log_filename), mode="wb")
-		self.fp.write("BUILD LOG FOR {0:%d %B %Y at %H:%M}\n================================\n\n".format(current_time).encode())
-		self.fp.flush()
-		return (self.fp, log_filename)
+		read_fd, write_fd = os.pipe()
+		self.reader = os.fdopen(read_fd, mode="rb")
+		self.fp = os.fdopen(write_fd, mode="wt", encoding="utf8", buffering=1)
+		self.thread = Thread(target=self.relay, name="log-relay", daemon=True)
+		self.thread.start()
+		return self.fp
 
 	def __exit__(self, *args):
 		self.fp.close()
-		del self.fp
-		del self.log_directory
+		self.thread.join()
+		self.reader.close()
+		del self.fp, self.reader, self.thread
+
+	def relay(self):
+		for line in self.reader:
+			item = None
+			if line.startswith(PACKAGE_TAG.encode()) and PACKAGE_TAG_END.encode() in line:
+				item, line = line[1:].split(PACKAGE_TAG_END.encode(), 1)
+				item = item.decode("utf8", errors="replace")
+			self.handle(item, line if line.endswith(b"\n") else line + b"\n")
+
+	@abstractmethod
+	def handle(self, item, line):
+		pass
+
+class LogToFile(LogPipe):
+
+	"""
+	Writes the build log of each run into its own directory within the log directory,
+	with the output of each package in separate, compressed file, and the rest of the output
+	in the main build log. Once the run is finished, it's added to the index of all the runs
+	(with the last lines of each log), and the oldest runs are removed according to retention limits.
+	"""
+
+	__slots__ = ("compression", "keep_runs", "log_directory", "max_size", "run", "started", "streams")
+
+	def __init__(self, log_directory, compression="zst", keep_runs=0, max_size=0):
+		self.log_directory = log_directory
+		self.compression = compression
+		self.keep_runs = keep_runs
+		self.max_size = max_size
 
-class LogToStdout:
 	def __enter__(self):
-		return (sys.stdout, "terminal")
+		current_time = datetime.now()
+		self.started = current_time.isoformat(timespec="seconds")
+
+		# Runs started within the same second (like the daemon's job and a manual build) get a suffix
+		name = "build-{0:%Y-%m-%dT%H-%M-%S}".format(current_time)
+		os.makedirs(self.log_directory, exist_ok=True)
+		for attempt in count(1):
+			self.run = name if attempt == 1 else f"{name}-{attempt}"
+			try:
+				os.mkdir(os.path.join(self.log_directory, self.run))
+				break
+			except FileExistsError:
+				pass
+		os.mkdir(os.path.join(self.log_directory, self.run, PACKAGE_LOGS_DIR))
+		self.streams = {}
+
+		fp = super().__enter__()
+		print("BUILD LOG FOR {0:%d %B %Y at %H:%M}\n================================\n".format(current_time), file=fp)
+		return (fp, os.path.join(self.log_directory, self.run))
+
 	def __exit__(self, *args):
-		pass
\ No newline at end of file
+		super().__exit__(*args)
+		files = dict(
+			(item, dict(stream.close(), file=os.path.relpath(stream.path, os.path.join(self.log_directory, self.run))))
+			for item, stream in self.streams.items()
+		)
+		index = get_log_index(self.log_directory)
+		index["runs"].append({
+			"run": self.run,
+			"started": self.started,
+			"finished": datetime.now().isoformat(timespec="seconds"),
+			"failed": args[0] is not None,
+			"files": files
+		})
+		apply_retention(self.log_directory, index, self.keep_runs, self.max_size)
+		save_log_index(self.log_directory, index)
+		del self.streams
+
+	def handle(self, item, line):
+		item = item or MAIN_LOG
+		if item not in self.streams:
+			path = os.path.join(self.log_directory, self.run, f"{PACKAGE_LOGS_DIR}/{item}" if item else MAIN_LOG_FILE)
+			self.streams[item] = LogStream(f"{path}.log", self.compression)
+		self.streams[item].write(line)
+
+class LogToStdout(LogPipe):
+
+	"""
+	Writes the build log to the terminal, with the lines of each package prefixed with its name.
+	"""
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return (super().__enter__(), "terminal")
+
+	def handle(self, item, line):
+		sys.stdout.buffer.write(f"[{item}] ".encode() + line if item else line)
+		sys.stdout.buffer.flush()
+
+class PackageOutput(LogPipe):
+
+	"""
+	Used within the container to capture the output of a single package's build (both its own messages
+	and the output of the processes it runs), tagging every line with the package name, so that
+	the log target on the host can tell the packages being built concurrently apart.
+	"""
+
+	__slots__ = ("item", "output")
+
+	def __init__(self, item, output=None):
+		self.item = item
+		self.output = output or sys.stdout
+
+	def handle(self, item, line):
+		line = line.decode("utf8", errors="replace").rstrip("\n")
+		with OUTPUT_LOCK:
+			self.output.write(f"{PACKAGE_TAG}{self.item}{PACKAGE_TAG_END}{line}\n")
+			self.output.flush()
+
+class HostOutput(LogPipe):
+
+	"""
+	Used on the host to capture the output of a single build host, when the builds are spread across several
+	of them, relaying it into the log target line by line, so that the lines of the hosts running concurrently
+	are never mixed up. Lines tagged with a package are passed on as they are; the rest are prefixed with the host's name.
+	"""
+
+	__slots__ = ("host", "output")
+
+	def __init__(self, host, output):
+		self.host = host
+		self.output = output
+
+	def handle(self, item, line):
+		line = line.decode("utf8", errors="replace").rstrip("\n")
+		with OUTPUT_LOCK:
+			self.output.write(f"{PACKAGE_TAG}{item}{PACKAGE_TAG_END}{line}\n" if item else f"[{self.host}] {line}\n")
+			self.output.flush()
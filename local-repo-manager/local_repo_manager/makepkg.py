@@ -0,0 +1,143 @@
+import os
+import os.path
+
+# Package formats makepkg can produce, mapped to the array in makepkg.conf holding
+# the compression command, and arguments enabling multi-threading and compression level
+# (None for formats where we don't control either)
+PACKAGE_FORMATS = {
+	"zst": ("COMPRESSZST", ["zstd", "-c", "-z", "-q", "--ultra", "-T{threads}", "-{level}", "-"]),
+	"xz": ("COMPRESSXZ", ["xz", "-c", "-z", "-T{threads}", "-{level}", "-"]),
+	"gz": ("COMPRESSGZ", None),
+	"bz2": ("COMPRESSBZ2", None),
+	"lzo": ("COMPRESSLZO", None),
+	"lrz": ("COMPRESSLRZ", None),
+	"lz4": ("COMPRESSLZ4", None),
+	"lz": ("COMPRESSLZ", None)
+}
+
+# Wrapper around the compression command, reporting how long it took to compress the package
+# (which otherwise would be hidden within the packaging step of makepkg)
+COMPRESS_TIMER = """#!/bin/bash
+start=$EPOCHREALTIME
+"$@"
+status=$?
+awk -v start="$start" -v end="$EPOCHREALTIME" -v cmd="$*" 'BEGIN { printf "==> Compression (%s) took %.2fs\\n", cmd, end - start > "/dev/stderr" }'
+exit $status
+"""
+
+# Counters in ccache's statistics log which indicate a cache hit or miss
+CCACHE_HITS = ("direct_cache_hit", "preprocessed_cache_hit")
+CCACHE_MISSES = ("cache_miss",)
+
+def get_ccache_stats(stats_log):
+
+	"""
+	Reads the statistics log written by ccache for the build of a single package
+	(via CCACHE_STATSLOG), returning the number of cache hits and misses.
+	Statistics are collected per build this way, since ccache's own counters are shared
+	by all the builds using the same cache, and these can run concurrently.
+	"""
+
+	hits = misses = 0
+	try:
+		with open(stats_log, mode="rt", encoding="utf8") as fp:
+			for line in fp:
+				line = line.strip()
+				if line in CCACHE_HITS:
+					hits += 1
+				elif line in CCACHE_MISSES:
+					misses += 1
+	except FileNotFoundError:
+		pass
+	return (hits, misses)
+
+def to_bash_array(values):
+	return "({0})".format(" ".join("'{0}'".format(x.replace("'", "'\\''")) for x in values))
+
+class MakepkgConfig:
+
+	"""
+	Helper class used to put together overrides of makepkg configuration for the builds.
+	Overrides are written to configuration file which sources the system-wide makepkg.conf first,
+	and the file is pointed to by MAKEPKG_CONF environment variable; this way, all of the
+	makepkg invocations pick them up, without having to alter configuration of the host system.
+	"""
+
+	__slots__ = ("directory", "env", "lines")
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.env = {}
+		self.lines = [
+			"source /etc/makepkg.conf",
+			'for conf in /etc/makepkg.conf.d/*.conf; do if [[ -f "$conf" ]]; then source "$conf"; fi; done'
+		]
+
+	def set_compression(self, package_format, level=None, threads=None):
+
+		"""
+		Sets the format of built packages (as in PKGEXT, with "zst" resulting in ".pkg.tar.zst" packages),
+		along with level and thread count for the formats that support them (zstd and xz);
+		missing level or thread count leave the compressor defaults in place.
+		"""
+
+		variable, command = PACKAGE_FORMATS[package_format]
+		self.env["PKGEXT"] = f".pkg.tar.{package_format}"
+		self.lines.append(f"PKGEXT='.pkg.tar.{package_format}'")
+
+		if command:
+			command = [
+				x.format(level=level, threads=threads) for x in command
+				if not (("{level}" in x and level is None) or ("{threads}" in x and threads is None))
+			]
+			timer = os.path.join(self.directory, "compress-timer.sh")
+			with open(timer, mode="wt", encoding="utf8") as fp:
+				fp.write(COMPRESS_TIMER)
+			os.chmod(timer, 0o755)
+			self.lines.append(f"{variable}={to_bash_array([timer] + command)}")
+
+	def set_ccache(self, ccache_dir, max_size=None):
+
+		"""
+		Enables compiler cache in given (persistent) directory for all the builds;
+		makepkg puts ccache's compiler wrappers in front of PATH once it's in BUILDENV.
+		If max_size is provided (like "20G"), ccache evicts the oldest entries over that size.
+		"""
+
+		self.env["CCACHE_DIR"] = ccache_dir
+		# Build directories differ between the runs (CCACHE_BASEDIR is set to each build's own one),
+		# so the paths need to be relative to be hashed consistently
+		self.env["CCACHE_NOHASHDIR"] = "true"
+		if max_size:
+			self.env["CCACHE_MAXSIZE"] = max_size
+
+		self.env["PATH"] = "/usr/lib/ccache/bin:" + os.environ.get("PATH", "/usr/bin")
+		self.lines.append('BUILDENV=("${BUILDENV[@]/#!ccache/ccache}")')
+		self.lines.append('[[ " ${BUILDENV[*]} " == *" ccache "* ]] || BUILDENV+=(ccache)')
+
+	def set_makeflags(self, makeflags):
+
+		"""
+		Overrides MAKEFLAGS from the system-wide configuration, so that the parallelism of the builds
+		is managed by the manager (through the jobserver shared by all the builds) rather than each build.
+		"""
+
+		self.lines.append(f"MAKEFLAGS='{makeflags}'")
+
+	def write(self, uid=None):
+
+		"""
+		Writes the configuration file, and returns the environment variables that need to be
+		set for makepkg to use it. If uid is provided, the files are made accessible to that user.
+		"""
+
+		filename = os.path.join(self.directory, "makepkg.conf")
+		with open(filename, mode="wt", encoding="utf8") as fp:
+			fp.write("\n".join(self.lines) + "\n")
+
+		if uid is not None:
+			for entry in os.scandir(self.directory):
+				os.chown(entry.path, uid, uid)
+			os.chown(self.directory, uid, uid)
+
+		return dict(self.env, MAKEPKG_CONF=filename)
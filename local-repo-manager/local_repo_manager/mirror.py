@@ -0,0 +1,92 @@
+import os
+import os.path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from urllib.parse import urlsplit
+
+def get_mirror_path(mirror_dir, repository):
+
+	"""
+	Returns the location of the bare mirror for given upstream repository,
+	laid out by host and path of the repository's address.
+	"""
+
+	address = urlsplit(repository)
+	parts = [x for x in (address.netloc or "local").split("/") + address.path.split("/") if x]
+	if any(x in (".", "..") for x in parts):
+		raise RuntimeError(f"Repository address {repository} cannot be mirrored")
+	path = os.path.join(mirror_dir, *parts)
+	return path if path.endswith(".git") else f"{path}.git"
+
+def update_mirrors(mirror_dir, repositories):
+
+	"""
+	Ensures there's an up-to-date bare mirror of every given repository within the mirror directory;
+	missing ones are cloned, existing ones fetched incrementally. Failure to update a mirror is not fatal,
+	as the builds will fall back on the upstream repository if there's no mirror for it.
+	"""
+
+	git_env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+	for repository in sorted(repositories):
+		path = get_mirror_path(mirror_dir, repository)
+		if os.path.isdir(path):
+			print(f"Updating mirror of {repository}...")
+			args = ["/usr/bin/git", "-C", path, "remote", "update", "--prune"]
+		else:
+			print(f"Creating mirror of {repository}...")
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			args = ["/usr/bin/git", "clone", "--quiet", "--mirror", repository, path]
+
+		result = subprocess.run(args, env=git_env, stdout=sys.stdout, stderr=subprocess.STDOUT)
+		if result.returncode != 0:
+			print(f"Could not update mirror of {repository}, the builds will use upstream repository directly", file=sys.stderr)
+
+def get_mirror_env(mirror_dir, repositories, environ=os.environ):
+
+	"""
+	Returns environment variables which make git transparently use the local mirrors
+	in place of upstream repositories (via url.<base>.insteadOf configuration),
+	without the need to change any of the preparation scripts.
+	Only the repositories which actually have mirrors are redirected.
+	"""
+
+	count = int(environ.get("GIT_CONFIG_COUNT", "0"))
+	git_env = {}
+	for repository in sorted(repositories):
+		path = get_mirror_path(mirror_dir, repository)
+		if os.path.isdir(path):
+			git_env[f"GIT_CONFIG_KEY_{count}"] = f"url.file://{path}.insteadOf"
+			git_env[f"GIT_CONFIG_VALUE_{count}"] = repository
+			# Mirrors are owned by root, while the clones are made by local user
+			git_env[f"GIT_CONFIG_KEY_{count + 1}"] = "safe.directory"
+			git_env[f"GIT_CONFIG_VALUE_{count + 1}"] = path
+			count += 2
+	if git_env:
+		git_env["GIT_CONFIG_COUNT"] = str(count)
+	return git_env
+
+def get_upstream_file(repository, filename, commit=None, mirror_dir=None):
+
+	"""
+	Returns the contents of given file at the HEAD of upstream repository, or None if it couldn't be retrieved.
+	The local mirror is used if it already has the commit HEAD currently points to (if it's known);
+	otherwise only the HEAD itself is fetched (shallowly) into temporary repository.
+	"""
+
+	git_env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+	path = get_mirror_path(mirror_dir, repository) if mirror_dir and commit else None
+	if path and os.path.isdir(path):
+		result = subprocess.run(["/usr/bin/git", "-C", path, "show", f"{commit}:{filename}"], env=git_env, capture_output=True)
+		if result.returncode == 0:
+			return result.stdout.decode("utf8", errors="replace")
+
+	with TemporaryDirectory() as temp_dir:
+		for args in (
+			["/usr/bin/git", "init", "--quiet", "--bare", temp_dir],
+			["/usr/bin/git", "-C", temp_dir, "fetch", "--quiet", "--depth", "1", repository, "HEAD"]
+		):
+			if subprocess.run(args, env=git_env, capture_output=True).returncode != 0:
+				return None
+		result = subprocess.run(["/usr/bin/git", "-C", temp_dir, "show", f"FETCH_HEAD:{filename}"], env=git_env, capture_output=True)
+		return result.stdout.decode("utf8", errors="replace") if result.returncode == 0 else None
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import os.path
+
+from .fingerprint import get_fingerprint
+from .mirror import get_upstream_file
+from .repo import is_newer
+from .srcinfo import get_packages_from_srcinfo, get_pkgbuild_version
+
+def get_current_version(item, repo, fingerprints, srcinfo_cache=None):
+
+	"""
+	Returns the version of given package (named after its directory) currently in the local repository;
+	names of the packages it produces are taken from the last recorded build or the last seen .SRCINFO.
+	"""
+
+	stored = fingerprints.fingerprints.get(item, {})
+	names = set(stored.get("versions", {}).keys())
+	srcinfo = srcinfo_cache.get_latest(item) if srcinfo_cache else None
+	if srcinfo:
+		names.update(get_packages_from_srcinfo(srcinfo).keys())
+	for name in sorted(names, key=len):
+		if name in repo:
+			return repo[name][0]
+	return None
+
+def check_package(item, package_dir, repository, repo, fingerprints, srcinfo_cache=None, mirror_dir=None):
+
+	"""
+	Checks whether given package would be rebuilt by the update, without preparing it:
+	the upstream HEAD and the package's scripts are compared with the ones of its last build,
+	and if upstream has changed, the version declared by upstream PKGBUILD is compared with
+	the one in the local repository. Returns the map with the current and available versions,
+	the status of the package, and whether it's pending an update.
+	"""
+
+	result = {"item": item, "current": get_current_version(item, repo, fingerprints, srcinfo_cache), "available": None}
+	if not repository:
+		return dict(result, status="no repository", pending=False)
+
+	fingerprint = get_fingerprint(package_dir)
+	if fingerprint["upstream"] is None:
+		return dict(result, status="upstream unreachable", pending=True)
+	if fingerprints.is_current(item, fingerprint, repo):
+		return dict(result, available=result["current"], status="up to date", pending=False)
+
+	stored = fingerprints.fingerprints.get(item)
+	pkgbuild = get_upstream_file(repository, "PKGBUILD", commit=fingerprint["upstream"], mirror_dir=mirror_dir)
+	result["available"] = get_pkgbuild_version(pkgbuild) if pkgbuild else None
+
+	if not stored:
+		return dict(result, status="never built", pending=True)
+	if stored.get("scripts") != fingerprint["scripts"]:
+		return dict(result, status="scripts changed", pending=True)
+	if result["current"] is None:
+		return dict(result, status="missing from repository", pending=True)
+
+	# Upstream has changed, but if it still declares the version which isn't newer than ours,
+	# preparing the package would only find out there's nothing to build
+	if result["available"] and not is_newer(result["available"], result["current"]):
+		return dict(result, status="upstream changed, same version", pending=False)
+	return dict(result, status="upstream changed", pending=True)
+
+def check_packages(packages_dir, packages, repo, fingerprints, srcinfo_cache=None, mirror_dir=None, jobs=16):
+
+	"""
+	Checks all the given packages (map of package directory names to their repositories) concurrently,
+	as the checks are dominated by waiting for the upstream repositories. Returns the results
+	in the alphabetical order of the packages.
+	"""
+
+	with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(packages)))) as executor:
+		return list(executor.map(
+			lambda item: check_package(
+				item, os.path.join(packages_dir, item), packages[item], repo, fingerprints, srcinfo_cache, mirror_dir
+			),
+			sorted(packages)
+		))
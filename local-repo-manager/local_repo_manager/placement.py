@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+import math
+import os
+import os.path
+import subprocess
+from threading import Lock
+
+from .jobserver import get_available_memory
+from .util import TempDirectory, bind_unmount, mount_tmpfs
+
+BUILD_PLACEMENTS = ("auto", "disk")
+
+# Tmpfs is sized with some room to spare over the disk use recorded by the package's last build,
+# as new versions tend to grow
+TMPFS_HEADROOM = 1.25
+
+class TmpfsFull(RuntimeError):
+
+	"""
+	Raised when the build placed on tmpfs has failed having run out of space on it,
+	so that it can be built on disk instead.
+	"""
+
+def get_directory_size(*paths):
+
+	"""
+	Returns the disk space (in bytes) taken by all the files within given directories,
+	counting hardlinked files once.
+	"""
+
+	seen = set()
+	total = 0
+	for path in paths:
+		for root, dirs, files in os.walk(path):
+			for name in dirs + files:
+				try:
+					stat = os.lstat(os.path.join(root, name))
+				except OSError:
+					continue
+				if (stat.st_dev, stat.st_ino) not in seen:
+					seen.add((stat.st_dev, stat.st_ino))
+					total += stat.st_blocks * 512
+	return total
+
+def format_size(size):
+	return "{0:.1f} GiB".format(size / (1 << 30)) if size >= 1 << 30 else "{0:.0f} MiB".format(size / (1 << 20))
+
+class Placement:
+
+	"""
+	Where the package is being built; the directory makepkg builds in (as BUILDDIR),
+	whether it's tmpfs or disk, and the size of the tmpfs.
+	"""
+
+	__slots__ = ("location", "size", "work_dir")
+
+	def __init__(self, location, work_dir, size=None):
+		self.location = location
+		self.work_dir = work_dir
+		self.size = size
+
+class BuildPlacement:
+
+	"""
+	Decides where each package is built. Package is built on its own tmpfs, sized after the disk use
+	recorded by its last build, as long as there's enough memory available to hold it (on top of
+	the tmpfs already in use, and leaving `min_free` bytes for the builds themselves), or within
+	the memory reserved for the tmpfs beforehand (see reserve); otherwise, or if its disk use
+	isn't known yet, it's built on disk, within its build directory.
+	Placement and the disk use of every package is collected, so that it can be reported once the builds are done.
+	"""
+
+	__slots__ = ("lock", "min_free", "mode", "mounted", "report", "reserved", "uid")
+
+	def __init__(self, mode="auto", min_free=0, uid=None):
+		self.mode = mode
+		self.min_free = min_free
+		self.uid = uid
+		self.lock = Lock()
+		self.mounted = {}
+		self.report = []
+		self.reserved = None
+
+	def get_size(self, expected_size):
+		return math.ceil(expected_size * TMPFS_HEADROOM / (1 << 20)) << 20
+
+	def reserve(self, expected_sizes, concurrent=1):
+
+		"""
+		Reserves the memory for the tmpfs of the builds running at the same time, given the disk use
+		expected of each of the packages (None if unknown); the largest of them which fit into
+		available memory (leaving `min_free` bytes) are reserved for, up to `concurrent` of them.
+		From then on, the tmpfs in use never take more than that, so that the reserved memory can be
+		left out when sizing the jobs of the builds. Returns the amount of memory reserved.
+		"""
+
+		self.reserved = 0
+		available = get_available_memory()
+		if self.mode != "auto" or available is None:
+			return self.reserved
+		sizes = sorted((self.get_size(x) for x in expected_sizes if x), reverse=True)
+		count = 0
+		for size in sizes:
+			if count == concurrent:
+				break
+			if self.reserved + size + self.min_free <= available:
+				self.reserved += size
+				count += 1
+		return self.reserved
+
+	def mount(self, mount_point, expected_size):
+
+		"""
+		Mounts tmpfs for the build expected to take given size, if there's enough memory for it;
+		returns the size of the tmpfs, or None if the package should be built on disk instead.
+		"""
+
+		if self.mode != "auto" or not expected_size:
+			return None
+		size = self.get_size(expected_size)
+
+		# With memory reserved for tmpfs, the tmpfs in use only have to fit into it (as the jobs of the builds
+		# are using the rest); otherwise, memory taken by tmpfs already in use is reflected in available memory
+		# only as far as they've been filled, so the rest of their size is accounted for separately
+		with self.lock:
+			if self.reserved is not None:
+				if size + sum(self.mounted.values()) > self.reserved:
+					return None
+			else:
+				available = get_available_memory()
+				committed = 0
+				for path, mounted_size in self.mounted.items():
+					stat = os.statvfs(path)
+					committed += max(0, mounted_size - (stat.f_blocks - stat.f_bfree) * stat.f_frsize)
+				if available is None or size + committed + self.min_free > available:
+					return None
+			try:
+				mount_tmpfs(mount_point, size, uid=self.uid)
+			except OSError:
+				return None
+			self.mounted[mount_point] = size
+			return size
+
+	@contextmanager
+	def place(self, item, build_dir, expected_size=None, disk_only=False):
+
+		"""
+		Context manager yielding the placement of given package's build; tmpfs (if used)
+		is unmounted once it exits, after its disk use has been measured.
+		"""
+
+		with TempDirectory() as mount_point:
+			size = None if disk_only else self.mount(mount_point, expected_size)
+			if size is None:
+				placement = Placement("disk", build_dir)
+				try:
+					yield placement
+				finally:
+					used = get_directory_size(*(os.path.join(build_dir, x) for x in ("src", "pkg")))
+					with self.lock:
+						self.report.append((item, placement.location, used, None))
+				return
+
+			placement = Placement("tmpfs", mount_point, size)
+			try:
+				yield placement
+			except Exception as e:
+				if self.is_full(placement):
+					raise TmpfsFull(f"{item} has run out of space on tmpfs ({format_size(size)})") from e
+				raise
+			finally:
+				used = get_directory_size(mount_point)
+				with self.lock:
+					del self.mounted[mount_point]
+					self.report.append((item, placement.location, used, size))
+				bind_unmount(mount_point)
+
+	def is_full(self, placement):
+
+		"""
+		Checks whether the tmpfs the package is built on has (almost) run out of space.
+		"""
+
+		if placement.location != "tmpfs":
+			return False
+		stat = os.statvfs(placement.work_dir)
+		return stat.f_bavail * stat.f_frsize < max(64 << 20, placement.size // 20)
+
+	def preserve(self, placement, pkgbase, build_dir):
+
+		"""
+		Copies the sources extracted on tmpfs into the build directory (preserving their ownership and timestamps),
+		so that they're kept along with it once the tmpfs is gone. Sources of the build which has run out
+		of space aren't copied, as it's going to be started again on disk.
+		"""
+
+		source = os.path.join(placement.work_dir, pkgbase, "src")
+		if placement.location == "tmpfs" and os.path.isdir(source) and not self.is_full(placement):
+			subprocess.run(["/usr/bin/cp", "-a", source, os.path.join(build_dir, "src")], check=True)
+
+	def get_used(self, item):
+		with self.lock:
+			return next((used for other, _, used, _ in reversed(self.report) if other == item), None)
+
+	def print_report(self, output):
+		if not self.report:
+			return
+		print("\nBuild placement:", file=output)
+		for item, location, used, size in sorted(self.report):
+			print("* {0}: {1}, {2} used{3}".format(
+				item, location, format_size(used), f" of {format_size(size)}" if size else ""
+			), file=output)
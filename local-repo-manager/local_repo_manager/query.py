@@ -0,0 +1,98 @@
+import re
+
+# Kinds of dependencies taken into account when looking for the packages depending on another one
+RDEPENDS_KINDS = ("depends", "makedepends", "checkdepends", "optdepends")
+
+MATCH_GLOB_SPECIAL = re.compile(r'([*?\[])')
+
+def escape_glob(value):
+	return MATCH_GLOB_SPECIAL.sub(r'[\1]', value)
+
+def get_depend_name(depend):
+
+	"""
+	Returns the name of the package from the dependency entry (like "foo>=1.0" or "foo: for bar support").
+	"""
+
+	return re.split(r'[<>=:]', depend, 1)[0].strip()
+
+def find_owners(index, path):
+
+	"""
+	Finds the packages shipping given path, or any path ending with it (in whole components;
+	"foo.ko" matches "usr/lib/modules/6.1/foo.ko", but not "barfoo.ko"). Paths of directories
+	match with or without trailing slash. Lookup runs over the reversed paths,
+	so that it's a prefix search on the index rather than a scan of all the files.
+	"""
+
+	suffix = path.strip("/")
+	if not suffix:
+		return []
+	return [
+		{"name": name, "version": version, "filename": filename, "path": full_path}
+		for name, version, filename, full_path in index.execute(
+			"SELECT packages.name, packages.version, packages.filename, files.path FROM files"
+			" JOIN packages ON packages.entry = files.entry"
+			" WHERE files.reversed GLOB ? AND (files.reversed = ? OR substr(files.reversed, ?, 1) = '/')"
+			" ORDER BY packages.name, files.path",
+			(escape_glob(suffix[::-1]) + "*", suffix[::-1], len(suffix) + 1)
+		)
+	]
+
+def search_files(index, pattern):
+
+	"""
+	Finds the files matching given glob pattern; patterns containing slash are matched against
+	the whole path (relative to the root, like "usr/lib/modules/*/foo.ko*"), others against the file names.
+	"""
+
+	column = "files.path" if "/" in pattern else "files.basename"
+	return [
+		{"name": name, "version": version, "filename": filename, "path": path}
+		for name, version, filename, path in index.execute(
+			"SELECT packages.name, packages.version, packages.filename, files.path FROM files"
+			f" JOIN packages ON packages.entry = files.entry WHERE {column} GLOB ?"
+			" ORDER BY packages.name, files.path",
+			(pattern.lstrip("/") if "/" in pattern else pattern,)
+		)
+	]
+
+def list_files(index, name):
+	return [
+		{"name": name, "version": version, "filename": filename, "path": path}
+		for version, filename, path in index.execute(
+			"SELECT packages.version, packages.filename, files.path FROM files"
+			" JOIN packages ON packages.entry = files.entry WHERE packages.name = ?"
+			" ORDER BY files.path",
+			(name,)
+		)
+	]
+
+def find_dependents(index, name):
+
+	"""
+	Finds the packages depending on given one, either on its name or on anything it provides,
+	along with the kind of the dependency (like "depends" or "optdepends") and the dependency entry itself.
+	"""
+
+	targets = {name}
+	for (provides,) in index.execute(
+		"SELECT depends.depend FROM depends JOIN packages ON packages.entry = depends.entry"
+		" WHERE packages.name = ? AND depends.kind = 'provides'",
+		(name,)
+	):
+		targets.add(get_depend_name(provides))
+
+	results = []
+	for target in sorted(targets):
+		for dependent, version, kind, depend in index.execute(
+			"SELECT packages.name, packages.version, depends.kind, depends.depend FROM depends"
+			" JOIN packages ON packages.entry = depends.entry"
+			" WHERE (depends.depend = ? OR depends.depend GLOB ?) AND depends.kind IN ({0})".format(
+				", ".join("?" * len(RDEPENDS_KINDS))
+			),
+			(target, escape_glob(target) + "[<>=:]*") + RDEPENDS_KINDS
+		):
+			if get_depend_name(depend) == target:
+				results.append({"name": dependent, "version": version, "kind": kind, "depend": depend})
+	return sorted(results, key=lambda x: (x["name"], x["kind"], x["depend"]))
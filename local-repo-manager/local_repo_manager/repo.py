@@ -1,12 +1,128 @@
 #!/usr/bin/env python3
 
 from collections import defaultdict
-from functools import cmp_to_key
-from subprocess import run
-import tarfile
+from functools import cmp_to_key, lru_cache
 
+from .index import RepoIndex
+
+DIGITS = frozenset(b"0123456789")
+LETTERS = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+ALNUM = DIGITS | LETTERS
+
+@lru_cache(maxsize=4096)
+def parse_evr(version):
+
+	"""
+	Splits the full pacman version string into epoch, version and release parts,
+	the same way libalpm's parseEVR does it (epoch defaults to "0", release can be
+	missing altogether). Parts are returned as bytes, as the comparison works on
+	the raw C string semantics (ASCII-only character classes).
+	"""
+
+	evr = version.encode("utf8")
+	position = 0
+	while position < len(evr) and evr[position] in DIGITS:
+		position += 1
+
+	if evr[position:position + 1] == b":":
+		epoch = evr[:position] or b"0"
+		start = position + 1
+	else:
+		epoch = b"0"
+		start = 0
+
+	separator = evr.rfind(b"-", position)
+	if separator >= 0:
+		return (epoch, evr[start:separator], evr[separator + 1:])
+	return (epoch, evr[start:], None)
+
+def rpm_ver_compare(one, two):
+
+	"""
+	Straight port of libalpm's rpmvercmp, comparing single version parts.
+	Alternating runs of digits and letters are compared as separate segments,
+	with numeric segments always newer than alphabetic ones, and the length
+	of separators between segments taken into account.
+	"""
+
+	if one == two:
+		return 0
+
+	one_pos = one_prev = 0
+	two_pos = two_prev = 0
+	one_len = len(one)
+	two_len = len(two)
+
+	while one_pos < one_len and two_pos < two_len:
+
+		while one_pos < one_len and one[one_pos] not in ALNUM:
+			one_pos += 1
+		while two_pos < two_len and two[two_pos] not in ALNUM:
+			two_pos += 1
+		if one_pos == one_len or two_pos == two_len:
+			break
+
+		# Differing length of separators decides the comparison outright
+		if one_pos - one_prev != two_pos - two_prev:
+			return -1 if one_pos - one_prev < two_pos - two_prev else 1
+
+		one_prev = one_pos
+		two_prev = two_pos
+		segment_class = DIGITS if one[one_prev] in DIGITS else LETTERS
+		while one_prev < one_len and one[one_prev] in segment_class:
+			one_prev += 1
+		while two_prev < two_len and two[two_prev] in segment_class:
+			two_prev += 1
+
+		one_segment = one[one_pos:one_prev]
+		two_segment = two[two_pos:two_prev]
+
+		# Segments of different types; numeric one is always considered newer
+		if not two_segment:
+			return 1 if segment_class is DIGITS else -1
+
+		if segment_class is DIGITS:
+			one_segment = one_segment.lstrip(b"0")
+			two_segment = two_segment.lstrip(b"0")
+			if len(one_segment) != len(two_segment):
+				return 1 if len(one_segment) > len(two_segment) else -1
+
+		if one_segment != two_segment:
+			return -1 if one_segment < two_segment else 1
+
+		one_pos = one_prev
+		two_pos = two_prev
+
+	one_rest = one[one_pos:one_pos + 1]
+	two_rest = two[two_pos:two_pos + 1]
+	if not one_rest and not two_rest:
+		return 0
+	elif (not one_rest and two_rest[0] not in LETTERS) or (one_rest and one_rest[0] in LETTERS):
+		return -1
+	else:
+		return 1
+
+@lru_cache(maxsize=4096)
 def pacman_ver_compare(versionOne, versionTwo):
-	return int(run(["/usr/bin/vercmp", versionOne, versionTwo], capture_output=True).stdout)
+
+	"""
+	In-process equivalent of `/usr/bin/vercmp` (libalpm's alpm_pkg_vercmp);
+	returns -1, 0 or 1 depending on whether the first version is older,
+	the same or newer than the second one.
+	"""
+
+	if versionOne == versionTwo:
+		return 0
+
+	epoch_one, version_one, release_one = parse_evr(versionOne)
+	epoch_two, version_two, release_two = parse_evr(versionTwo)
+
+	result = rpm_ver_compare(epoch_one, epoch_two)
+	if result == 0:
+		result = rpm_ver_compare(version_one, version_two)
+		if result == 0 and release_one is not None and release_two is not None:
+			result = rpm_ver_compare(release_one, release_two)
+	return result
 
 @cmp_to_key
 def pacman_newest_first(a, b):
@@ -22,33 +138,14 @@ def get_repo(repository_file):
 	along with the versions, going from most recent to oldest.
 	Used to compare the version of the package being built, and determining whether
 	it needs to be rebuilt.
+	The contents are read from persistent index kept next to the repository file,
+	which is only refreshed when the repository database itself changes.
 	"""
 
 	versions = defaultdict(list)
 
-	try:
-		with tarfile.open(repository_file, mode="r:xz") as tf:
-			for item in tf:
-				if item.isfile() and item.name.endswith("desc"):
-					with tf.extractfile(item) as fp:
-						desc_file = fp.read().decode("utf8")
-					name = None
-					version = None
-					for line in desc_file.splitlines():
-						if line == r"%NAME%":
-							name = False
-						elif line == r"%VERSION%":
-							version = False
-						elif name == False:
-							name = line
-						elif version == False:
-							version = line
-						if name and version:
-							break
-					versions[name].append(version)
-					if len(versions[name]) > 1:
-						versions[name].sort(pacman_newest_first)
-	except FileNotFoundError:
-		versions = {}
-
-	return dict((name, tuple(versions)) for name, versions in sorted(versions.items()))
\ No newline at end of file
+	with RepoIndex(repository_file) as index:
+		for name, version in index.execute("SELECT name, version FROM packages WHERE name IS NOT NULL"):
+			versions[name].append(version)
+
+	return dict((name, tuple(sorted(versions, key=pacman_newest_first))) for name, versions in sorted(versions.items()))
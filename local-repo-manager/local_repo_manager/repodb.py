@@ -0,0 +1,281 @@
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import mmap
+import os
+import os.path
+import re
+import subprocess
+import tarfile
+import time
+
+from .archive import open_archive
+from .index import FilesIndex, RepoIndex, parse_desc
+
+MATCH_DB_FILE = re.compile(r'\.db(\.tar(?:\.\w+)?)$')
+MATCH_DB_SUFFIX = re.compile(r'\.(?:db|files)(\.tar(?:\.\w+)?)$')
+
+# Compressors used for writing the repository databases (by their extension);
+# external multi-threaded ones are used, as Python's own modules are single-threaded
+DB_COMPRESSORS = {
+	".tar": None,
+	".tar.gz": ["gzip", "-c", "-n"],
+	".tar.bz2": ["bzip2", "-c"],
+	".tar.xz": ["xz", "-c", "-z", "-T0"],
+	".tar.zst": ["zstd", "-c", "-q", "-T0"]
+}
+
+# Order of the fields in desc file, along with the .PKGINFO keys they come from
+# (mirroring the entries written by repo-add)
+DESC_FIELDS = (
+	("FILENAME", None),
+	("NAME", "pkgname"),
+	("BASE", "pkgbase"),
+	("VERSION", "pkgver"),
+	("DESC", "pkgdesc"),
+	("GROUPS", "group"),
+	("CSIZE", None),
+	("ISIZE", "size"),
+	("MD5SUM", None),
+	("SHA256SUM", None),
+	("PGPSIG", None),
+	("URL", "url"),
+	("LICENSE", "license"),
+	("ARCH", "arch"),
+	("BUILDDATE", "builddate"),
+	("PACKAGER", "packager"),
+	("REPLACES", "replaces"),
+	("CONFLICTS", "conflict"),
+	("PROVIDES", "provides"),
+	("DEPENDS", "depend"),
+	("OPTDEPENDS", "optdepend"),
+	("MAKEDEPENDS", "makedepend"),
+	("CHECKDEPENDS", "checkdepend")
+)
+
+def get_files_db(repository_file):
+
+	"""
+	Returns the location of the files database accompanying given repository database
+	(like repo.files.tar.xz for repo.db.tar.xz).
+	"""
+
+	directory, filename = os.path.split(repository_file)
+	if not MATCH_DB_FILE.search(filename):
+		raise RuntimeError(f"Repository file {repository_file} does not have expected .db.tar* extension")
+	return os.path.join(directory, MATCH_DB_FILE.sub(r'.files\1', filename))
+
+def read_package(filename):
+
+	"""
+	Reads the metadata (.PKGINFO) and the list of files of given package archive.
+	The list of files is in the same form as the one produced by repo-add (sorted,
+	without package metadata files, with trailing slashes for directories).
+	"""
+
+	pkginfo = {}
+	files = set()
+	with open_archive(filename) as tf:
+		for item in tf:
+			if item.name == ".PKGINFO":
+				with tf.extractfile(item) as fp:
+					for line in fp.read().decode("utf8").splitlines():
+						if line.startswith("#") or " = " not in line:
+							continue
+						key, value = line.split(" = ", 1)
+						pkginfo.setdefault(key, []).append(value)
+			elif not item.name.startswith("."):
+				files.add(item.name + "/" if item.isdir() else item.name)
+
+	if "pkgname" not in pkginfo or "pkgver" not in pkginfo:
+		raise RuntimeError(f"Package {filename} does not have valid .PKGINFO")
+	return (pkginfo, sorted(files, key=lambda x: x.encode("utf8")))
+
+def checksum_package(filename):
+
+	"""
+	Computes the size and checksums of the package file; the file is memory-mapped,
+	so that hashing (which releases the GIL) can run in parallel for multiple packages.
+	"""
+
+	md5 = hashlib.md5()
+	sha256 = hashlib.sha256()
+	with open(filename, mode="rb") as fp:
+		size = os.fstat(fp.fileno()).st_size
+		if size:
+			with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				md5.update(data)
+				sha256.update(data)
+	return (size, md5.hexdigest(), sha256.hexdigest())
+
+def describe_package(filename):
+
+	"""
+	Produces the desc and files entries for the repository databases for given package file.
+	Returns the entry name (name-version), package name, and contents of both files.
+	"""
+
+	pkginfo, files = read_package(filename)
+	size, md5, sha256 = checksum_package(filename)
+
+	values = dict(pkginfo)
+	values["FILENAME"] = [os.path.basename(filename)]
+	values["CSIZE"] = [str(size)]
+	values["MD5SUM"] = [md5]
+	values["SHA256SUM"] = [sha256]
+	if os.path.isfile(filename + ".sig"):
+		with open(filename + ".sig", mode="rb") as fp:
+			values["PGPSIG"] = [b64encode(fp.read()).decode("ascii")]
+
+	desc = io.StringIO()
+	for field, key in DESC_FIELDS:
+		entries = [x for x in values.get(key or field, ()) if x]
+		if entries:
+			desc.write("%{0}%\n{1}\n\n".format(field, "\n".join(entries)))
+
+	name = pkginfo["pkgname"][0]
+	entry = "{0}-{1}".format(name, pkginfo["pkgver"][0])
+	files_list = "%FILES%\n" + "".join(x + "\n" for x in files)
+	return (entry, name, desc.getvalue().encode("utf8"), files_list.encode("utf8"))
+
+def read_db(db_file):
+
+	"""
+	Reads all the entries of the repository database, returning the map of entry names
+	to their modification time and the map of their file names (like "desc" or "files") to contents.
+	Modification times are carried over when the database is rewritten, so that the repository
+	index only needs to re-read the entries that have actually changed.
+	"""
+
+	entries = {}
+	try:
+		with open_archive(db_file) as tf:
+			for item in tf:
+				if item.isfile():
+					entry, filename = os.path.split(item.name)
+					with tf.extractfile(item) as fp:
+						entries.setdefault(entry, (int(item.mtime), {}))[1][filename] = fp.read()
+	except FileNotFoundError:
+		pass
+	return entries
+
+def get_entry_name(entry_files):
+	desc = parse_desc(entry_files.get("desc", b"").decode("utf8").splitlines())
+	return desc["NAME"][0] if desc.get("NAME") else None
+
+def write_db(db_file, entries):
+
+	"""
+	Writes the repository database with given entries, compressed according to its extension.
+	The database is written into temporary file first, then atomically moved in place,
+	so that pacman never sees partially written database. The symlink without compression
+	extension (like repo.db pointing to repo.db.tar.xz) is created as well, as repo-add does.
+	"""
+
+	match = MATCH_DB_SUFFIX.search(os.path.basename(db_file))
+	if not match or match.group(1) not in DB_COMPRESSORS:
+		raise RuntimeError(f"Unsupported compression of repository file {db_file}")
+	suffix = match.group(1)
+	command = DB_COMPRESSORS[suffix]
+
+	temp_file = f"{db_file}.tmp{os.getpid()}"
+	try:
+		with open(temp_file, mode="wb") as output:
+			process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output) if command else None
+			with tarfile.open(fileobj=process.stdin if process else output, mode="w|", format=tarfile.PAX_FORMAT) as tf:
+				for entry in sorted(entries):
+					mtime, entry_files = entries[entry]
+					info = tarfile.TarInfo(entry)
+					info.type = tarfile.DIRTYPE
+					info.mode = 0o755
+					info.mtime = mtime
+					tf.addfile(info)
+					for filename, contents in sorted(entry_files.items()):
+						info = tarfile.TarInfo(f"{entry}/{filename}")
+						info.size = len(contents)
+						info.mode = 0o644
+						info.mtime = mtime
+						tf.addfile(info, io.BytesIO(contents))
+			if process:
+				process.stdin.close()
+				if process.wait() != 0:
+					raise RuntimeError(f"Could not compress repository file {db_file}")
+		os.replace(temp_file, db_file)
+	finally:
+		if os.path.exists(temp_file):
+			os.unlink(temp_file)
+
+	link = db_file[:-len(suffix)]
+	if not os.path.lexists(link):
+		os.symlink(os.path.basename(db_file), link)
+
+def add_packages(repository_file, package_files, only_new=True):
+
+	"""
+	Native replacement for `repo-add`; adds given packages to both the repository database
+	and the files database. Packages are read and checksummed in parallel, existing entries
+	for the same package names are replaced, and the rest of the entries are carried over
+	as they are. With only_new set, packages whose exact versions are already in the repository
+	are skipped (like `repo-add --new`).
+	Returns the list of entries that were added.
+	"""
+
+	files_db = get_files_db(repository_file)
+	db_entries = read_db(repository_file)
+	files_entries = read_db(files_db)
+
+	with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+		described = list(executor.map(describe_package, package_files))
+
+	names = dict((get_entry_name(entry_files), entry) for entry, (_, entry_files) in db_entries.items())
+	mtime = int(time.time())
+	added = []
+	for entry, name, desc, files in described:
+		if only_new and entry in db_entries:
+			print(f"An entry for '{name}' already existed, skipping")
+			continue
+		if name in names:
+			print(f"Removing existing entry '{names[name]}'...")
+			db_entries.pop(names[name], None)
+			files_entries.pop(names[name], None)
+		print(f"Adding package entry '{entry}'...")
+		db_entries[entry] = (mtime, {"desc": desc})
+		files_entries[entry] = (mtime, {"desc": desc, "files": files})
+		names[name] = entry
+		added.append(entry)
+
+	if added:
+		print("Writing repository databases...")
+		with ThreadPoolExecutor(max_workers=2) as executor:
+			for future in [executor.submit(write_db, repository_file, db_entries), executor.submit(write_db, files_db, files_entries)]:
+				future.result()
+	return added
+
+def remove_entries(repository_file, entries):
+
+	"""
+	Removes given entries (by their names, like name-version) from both the repository database
+	and the files database, rewriting only the databases which actually had any of them.
+	"""
+
+	for db_file in (repository_file, get_files_db(repository_file)):
+		db_entries = read_db(db_file)
+		if any(entry in db_entries for entry in entries):
+			print(f"Removing {len(entries)} entries from {os.path.basename(db_file)}...")
+			write_db(db_file, dict((entry, value) for entry, value in db_entries.items() if entry not in entries))
+
+def refresh_indexes(repository_file):
+
+	"""
+	Brings the indexes of the repository database and of the files database (if it has one) up to date
+	right after they've been changed, so that the entries which have changed are read while they're
+	still fresh, rather than by the first query coming after.
+	"""
+
+	indexes = [RepoIndex(repository_file)]
+	if MATCH_DB_FILE.search(os.path.basename(repository_file)):
+		indexes.append(FilesIndex(get_files_db(repository_file)))
+	for index in indexes:
+		with index:
+			pass
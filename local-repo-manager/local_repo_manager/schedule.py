@@ -0,0 +1,224 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import ExitStack
+import os.path
+import sys
+
+from .build import install_packages, prepare_package, build_package, is_package_newer
+from .fingerprint import get_fingerprint
+from .ingest import read_marker, write_marker
+from .log import PackageOutput
+from .placement import BuildPlacement, TmpfsFull, format_size
+from .srcinfo import get_packages_from_srcinfo, get_dependencies_from_srcinfo
+from .state import discard_artifacts
+from .util import TempDirectory
+
+def get_dependency_graph(srcinfos):
+
+	"""
+	Given the map of package directory names to their parsed .SRCINFO,
+	returns the map of each package directory to the set of other package directories
+	producing something it depends on (either by package name or what it provides).
+	"""
+
+	producers = {}
+	for item, srcinfo in srcinfos.items():
+		_, provides = get_dependencies_from_srcinfo(srcinfo)
+		for name in set(get_packages_from_srcinfo(srcinfo).keys()) | provides:
+			producers[name] = item
+
+	graph = {}
+	for item, srcinfo in srcinfos.items():
+		dependencies, _ = get_dependencies_from_srcinfo(srcinfo)
+		graph[item] = set(producers[x] for x in dependencies if x in producers) - {item}
+	return graph
+
+def get_build_order(graph):
+
+	"""
+	Returns the deterministic topological order of the given dependency graph;
+	out of the packages that can be built at any point, the alphabetically first one goes first.
+	Raises an error if there are circular dependencies between the packages.
+	"""
+
+	remaining = dict((item, set(dependencies)) for item, dependencies in graph.items())
+	order = []
+	while remaining:
+		ready = sorted(item for item, dependencies in remaining.items() if not dependencies)
+		if not ready:
+			raise RuntimeError("Circular dependency between packages: {0}".format(", ".join(sorted(remaining))))
+		item = ready[0]
+		order.append(item)
+		del remaining[item]
+		for dependencies in remaining.values():
+			dependencies.discard(item)
+	return order
+
+def build_packages(
+	repo, packages_dir, packages, destination_dir, fingerprints, build_env=None, srcinfo_cache=None, parallel_builds=1, force=False,
+	resumable=None, trees=None, placement=None, source_cache=None
+):
+
+	"""
+	Builds all of the given packages (named after their directories in packages directory),
+	each one in separate build directory. All the packages are prepared first, to learn their
+	versions and dependencies from .SRCINFO, then the ones newer than what's in the local repository
+	are built, with up to `parallel_builds` independent packages being built concurrently.
+	A package is only started once all the packages it depends on have been built and installed.
+	Packages which haven't changed since their last build (according to the fingerprint store)
+	are skipped without being prepared, unless `force` is set.
+	Any variables in `build_env` are added to the environment of preparation scripts and makepkg.
+	Parsed .SRCINFO of each package is taken from `srcinfo_cache` if provided and up-to-date.
+	Output of each package is tagged with its name, so that it can be split into separate logs.
+	Packages built by the previous, unfinished attempt (`resumable`, as returned by get_resumable)
+	are not built again, as long as they haven't changed since; their artifacts are kept instead.
+	If `trees` (BuildTrees) are provided, packages are built in the build directories kept between the runs.
+	Where each package is built (tmpfs or disk) is decided by `placement` (BuildPlacement); by default, on disk.
+	Sources are kept in `source_cache` (SourceCache) between the runs, if it's provided.
+	"""
+
+	resumable = resumable or {}
+	placement = placement or BuildPlacement("disk")
+	with ExitStack() as stack, ThreadPoolExecutor(max_workers=parallel_builds) as executor:
+
+		build_dirs = dict((item, stack.enter_context(TempDirectory())) for item in packages) if trees is None else {}
+		pending = {}
+		resumed = set(x for x in resumable if x not in packages)
+		reused = set()
+		reprepared = set()
+
+		def prepare(item):
+			with PackageOutput(item) as output:
+				package_dir = os.path.join(packages_dir, item)
+				fingerprint = get_fingerprint(package_dir)
+				if item in resumable:
+					stored = resumable[item]
+					if None not in fingerprint.values() and all(stored.get(key) == value for key, value in fingerprint.items()):
+						print(f"{item} has already been built by the previous attempt, skipping...", file=output)
+						resumed.add(item)
+						return None
+					print(f"{item} has changed since the previous attempt, discarding its artifacts...", file=output)
+					discard_artifacts(destination_dir, item)
+
+				if not force and fingerprints.is_current(item, fingerprint, repo):
+					print(f"{item} has not changed since its last build, skipping...", file=output)
+					return None
+
+				saved = None
+				if trees is not None:
+					build_dirs[item], saved = trees.open(item, fingerprint)
+				srcinfo = prepare_package(package_dir, build_dirs[item], destination_dir, build_env, srcinfo_cache, log_output=output)
+				if saved:
+					reprepare = trees.restore(item, saved, fingerprint, srcinfo)
+					if reprepare is None:
+						print(f"Sources of {item} have changed since its previous build, they will be extracted again", file=output)
+					elif reprepare:
+						reused.add(item)
+						reprepared.add(item)
+						print(f"{item} has changed since its previous build, its sources will be prepared again and reused", file=output)
+					else:
+						reused.add(item)
+						print(f"Sources extracted by the previous build of {item} will be reused", file=output)
+				package_versions = get_packages_from_srcinfo(srcinfo)
+				dependencies, _ = get_dependencies_from_srcinfo(srcinfo)
+				if not is_package_newer(repo, package_versions):
+					print(f"None of the build artifacts for {item} are newer than contents of the local repository, skipping...", file=output)
+					fingerprints.record(item, fingerprint, package_versions, dependencies)
+					return None
+
+				pending[item] = (fingerprint, package_versions, dependencies)
+				return srcinfo
+
+		def build(item):
+			print(f"\nBUILD FOR {item} STARTED")
+			success = False
+			try:
+				# Reused sources are already within the build directory, so they have to be built there
+				with PackageOutput(item) as output:
+					try:
+						artifacts = build_placed(item, disk_only=item in reused, output=output)
+					except TmpfsFull as e:
+						print(f"{e}, building on disk instead...", file=output)
+						artifacts = build_placed(item, disk_only=True, output=output)
+				success = True
+			finally:
+				if trees is not None:
+					trees.close(item, pending[item][0], srcinfos[item], success=success)
+			fingerprints.record(item, *pending[item], build_size=placement.get_used(item))
+			write_marker(destination_dir, item, artifacts)
+			print(f"BUILD FOR {item} COMPLETE")
+			return item
+
+		def build_placed(item, disk_only, output):
+			success = False
+			with placement.place(item, build_dirs[item], fingerprints.get_build_size(item), disk_only=disk_only) as place:
+				print(f"Building on {place.location}" + (f" ({format_size(place.size)})" if place.size else ""), file=output)
+				try:
+					artifacts = build_package(
+						srcinfos[item], os.path.join(packages_dir, item), build_dirs[item], destination_dir, build_env,
+						noextract=item in reused, reprepare=item in reprepared,
+						manifest=trees.get_manifest(item) if trees is not None else None,
+						work_dir=place.work_dir, source_cache=source_cache, log_output=output
+					)
+					success = True
+					return artifacts
+				finally:
+					# Sources built on tmpfs are copied over to the build directory, if it's going to be kept
+					if trees is not None and trees.keeps(success):
+						placement.preserve(place, srcinfos[item]["pkgbase"], build_dirs[item])
+
+		print("\nPreparing packages...")
+		srcinfos = dict(zip(packages, executor.map(prepare, packages)))
+		srcinfos = dict((item, srcinfo) for item, srcinfo in srcinfos.items() if srcinfo is not None)
+
+		# Fingerprints of the packages built by the previous attempt are carried over, so that they're
+		# recorded along with their artifacts; the ones the packages being built depend on are installed,
+		# just like they would be right after their build
+		needed = set(x for srcinfo in srcinfos.values() for x in get_dependencies_from_srcinfo(srcinfo)[0])
+		to_install = []
+		for item in sorted(resumed):
+			stored = resumable[item]
+			fingerprints.record(
+				item, {"upstream": stored["upstream"], "scripts": stored["scripts"]}, stored["versions"],
+				stored.get("dependencies", ()), build_size=stored.get("build_size")
+			)
+			if needed & set(stored["versions"]):
+				to_install.extend(read_marker(destination_dir, item))
+		if to_install:
+			print("\nInstalling the packages built by the previous attempt within the container...")
+			install_packages(to_install)
+
+		graph = get_dependency_graph(srcinfos)
+		order = get_build_order(graph)
+		if not order:
+			print("\nNo packages need to be built")
+			return []
+
+		print("\nPackages will be built in following order:")
+		for item in order:
+			print("* {0}{1}".format(item, " (after {0})".format(", ".join(sorted(graph[item]))) if graph[item] else ""))
+
+		# Packages are submitted in the build order as soon as their dependencies are complete;
+		# if any build fails, we don't start any new ones, but let the ones in progress finish
+		completed = []
+		running = set()
+		failure = None
+		while order or running:
+			if failure is None:
+				for item in tuple(order):
+					if graph[item].issubset(completed) and len(running) < parallel_builds:
+						order.remove(item)
+						running.add(executor.submit(build, item))
+			if not running:
+				break
+
+			done, running = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				if future.exception() is not None:
+					failure = failure or future.exception()
+				else:
+					completed.append(future.result())
+
+		placement.print_report(sys.stdout)
+		if failure is not None:
+			raise failure
+		return completed
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import os.path
+from shutil import rmtree
+import sys
+from threading import Lock
+import time
+
+from .placement import format_size, get_directory_size
+from .srcinfo import get_sources_from_srcinfo
+
+# Files kept by the cache itself within its directory; the index of the entries,
+# and the destination of source packages (SRCPKGDEST)
+INDEX_FILE = ".index.json"
+SRCPKGDEST_DIR = ".srcpkg"
+
+# Protocols of sources makepkg checks out into (bare) repositories, rather than downloading as files
+VCS_PROTOCOLS = ("bzr", "fossil", "git", "hg", "svn")
+
+def get_source_filename(source):
+
+	"""
+	Returns the name under which makepkg keeps given source entry (like "name::https://...")
+	within SRCDEST, following the same rules as makepkg's own get_filename.
+	Returns None for local files, which are never downloaded.
+	"""
+
+	name, _, url = source.rpartition("::")
+	if "://" not in url:
+		return None
+	protocol = url.split("://", 1)[0].split("+", 1)[0]
+	if name:
+		return name
+	if protocol in VCS_PROTOCOLS:
+		url = url.split("#", 1)[0].split("?", 1)[0].rstrip("/")
+		filename = url.rsplit("/", 1)[-1]
+		return filename.split(".git", 1)[0] if protocol == "git" else filename
+	return url.rsplit("/", 1)[-1]
+
+def hash_file(path, algorithms):
+	digests = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+	with open(path, mode="rb") as fp:
+		for block in iter(lambda: fp.read(1 << 20), b""):
+			for digest in digests.values():
+				digest.update(block)
+	return dict((algorithm, digest.hexdigest()) for algorithm, digest in digests.items())
+
+class SourceCache:
+
+	"""
+	Persistent directory the sources of the packages are downloaded into (as makepkg's SRCDEST),
+	so that they're only downloaded once rather than on every build. Before each build,
+	the sources already in the cache are verified against the checksums from the PKGBUILD,
+	with the ones that don't match removed, so that makepkg downloads them again.
+	Checksums verified for each file are remembered (for as long as its size and modification time
+	stay the same), so that large sources don't need to be hashed again for every build.
+	Once the builds are done, least recently used entries are evicted until the cache fits
+	within `max_size` bytes (with 0 meaning no limit); the ones used by this run are always kept.
+	"""
+
+	__slots__ = ("directory", "entries", "lock", "max_size", "stats", "used")
+
+	def __init__(self, directory, max_size=0, uid=None):
+		self.directory = directory
+		self.max_size = max_size
+		self.lock = Lock()
+		self.used = set()
+		self.stats = {"hits": 0, "misses": 0, "invalid": 0, "saved": 0}
+		try:
+			with open(os.path.join(directory, INDEX_FILE), mode="rt", encoding="utf8") as fp:
+				self.entries = json.load(fp)
+		except (FileNotFoundError, ValueError):
+			self.entries = {}
+
+		os.makedirs(os.path.join(directory, SRCPKGDEST_DIR), exist_ok=True)
+		if uid is not None:
+			os.chown(os.path.join(directory, SRCPKGDEST_DIR), uid, uid)
+
+	def get_env(self):
+		return {"SRCDEST": self.directory, "SRCPKGDEST": os.path.join(self.directory, SRCPKGDEST_DIR)}
+
+	def verify(self, filename, checksums):
+
+		"""
+		Checks whether the cached file matches all of given checksums (as returned by get_sources_from_srcinfo);
+		files without any checksums to verify against are assumed to be valid, just like makepkg does.
+		"""
+
+		path = os.path.join(self.directory, filename)
+		stat = os.stat(path)
+		with self.lock:
+			entry = self.entries.get(filename, {})
+		verified = entry.get("verified", {}) if (entry.get("size"), entry.get("mtime")) == (stat.st_size, stat.st_mtime_ns) else {}
+
+		unverified = [algorithm for algorithm, value in checksums.items() if verified.get(algorithm) != value]
+		if unverified:
+			actual = hash_file(path, unverified)
+			if any(actual[algorithm] != checksums[algorithm] for algorithm in unverified):
+				return False
+			verified = dict(verified, **actual)
+
+		with self.lock:
+			self.entries[filename] = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns, verified=verified)
+		return True
+
+	def check(self, srcinfo, log_output=None):
+
+		"""
+		Verifies the cached sources of the package about to be built, removing the ones that fail verification,
+		and reports how many of them makepkg won't need to download (and how many bytes it saves).
+		"""
+
+		output = log_output or sys.stdout
+		hits = misses = invalid = saved = 0
+		for source, checksums in get_sources_from_srcinfo(srcinfo, os.uname().machine):
+			filename = get_source_filename(source)
+			if filename is None:
+				continue
+			with self.lock:
+				self.used.add(filename)
+
+			path = os.path.join(self.directory, filename)
+			if os.path.isdir(path):
+				hits += 1
+				with self.lock:
+					saved += self.entries.get(filename, {}).get("size", 0)
+			elif not os.path.isfile(path):
+				misses += 1
+			elif self.verify(filename, checksums):
+				hits += 1
+				saved += os.path.getsize(path)
+			else:
+				print(f"Cached source {filename} does not match its checksums, it will be downloaded again", file=output)
+				os.unlink(path)
+				misses += 1
+				invalid += 1
+
+		total = hits + misses
+		print("Source cache: {0} hits, {1} misses ({2:.1f}% hit rate), {3} not downloaded".format(
+			hits, misses, 100 * hits / total if total else 0, format_size(saved)
+		), file=output)
+		with self.lock:
+			for key, value in (("hits", hits), ("misses", misses), ("invalid", invalid), ("saved", saved)):
+				self.stats[key] += value
+
+	def close(self, output=None):
+
+		"""
+		Records the use of all the entries used by this run, evicts the least recently used ones
+		over the size limit and saves the index; prints out the statistics of the whole run.
+		"""
+
+		output = output or sys.stdout
+		now = time.time()
+		entries = {}
+		for dir_entry in os.scandir(self.directory):
+			if dir_entry.name.startswith("."):
+				continue
+			entry = self.entries.get(dir_entry.name, {})
+			if dir_entry.name in self.used:
+				entry["last_used"] = now
+			if dir_entry.is_dir(follow_symlinks=False):
+				# Sizes of repositories are only measured once they've been used, as it takes walking all of them
+				if dir_entry.name in self.used or "size" not in entry:
+					entry["size"] = get_directory_size(dir_entry.path)
+			else:
+				stat = dir_entry.stat(follow_symlinks=False)
+				if (entry.get("size"), entry.get("mtime")) != (stat.st_size, stat.st_mtime_ns):
+					entry.pop("verified", None)
+				entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+			entry.setdefault("last_used", dir_entry.stat(follow_symlinks=False).st_mtime)
+			entries[dir_entry.name] = entry
+
+		total = sum(entry["size"] for entry in entries.values())
+		evicted = reclaimed = 0
+		if self.max_size:
+			for name, entry in sorted(entries.items(), key=lambda x: x[1]["last_used"]):
+				if total <= self.max_size:
+					break
+				if name in self.used:
+					continue
+				path = os.path.join(self.directory, name)
+				if os.path.isdir(path) and not os.path.islink(path):
+					rmtree(path)
+				else:
+					os.unlink(path)
+				del entries[name]
+				total -= entry["size"]
+				evicted += 1
+				reclaimed += entry["size"]
+
+		path = os.path.join(self.directory, INDEX_FILE)
+		with open(f"{path}.tmp", mode="wt", encoding="utf8") as fp:
+			json.dump(entries, fp, separators=(",", ":"))
+		os.replace(f"{path}.tmp", path)
+		self.entries = entries
+
+		total_used = self.stats["hits"] + self.stats["misses"]
+		print("\nSource cache: {0} hits, {1} misses ({2:.1f}% hit rate, {3} failed verification), {4} not downloaded".format(
+			self.stats["hits"], self.stats["misses"], 100 * self.stats["hits"] / total_used if total_used else 0,
+			self.stats["invalid"], format_size(self.stats["saved"])
+		), file=output)
+		print("Source cache holds {0} in {1} entries{2}".format(
+			format_size(total), len(entries), f", evicted {evicted} ({format_size(reclaimed)})" if evicted else ""
+		), file=output)
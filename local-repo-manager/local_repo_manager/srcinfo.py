@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import os.path
+import re
+from threading import get_ident
+
+MATCH_SRCINFO_LINE = re.compile(r'^\s*(\w+) = ?(.*)$')
+MATCH_SOURCED_FILE = re.compile(r'''^\s*(?:source|\.)\s+["']?([^"'\s;]+)''')
+MATCH_VERSION_CONSTRAINT = re.compile(r'[<>=].*$')
+MATCH_PKGBUILD_ASSIGNMENT = re.compile(r'''^([A-Za-z_]\w*)=(?:"([^"`]*)"|'([^']*)'|([^\s"'`;#()]*))\s*(?:#.*)?$''')
+MATCH_VARIABLE = re.compile(r'\$(?:\{([A-Za-z_]\w*)\}|([A-Za-z_]\w*))')
+
+# Checksum arrays of PKGBUILD mapped to the matching hash algorithms (as in hashlib)
+CHECKSUM_ARRAYS = {
+	"md5sums": "md5",
+	"sha1sums": "sha1",
+	"sha224sums": "sha224",
+	"sha256sums": "sha256",
+	"sha384sums": "sha384",
+	"sha512sums": "sha512",
+	"b2sums": "blake2b"
+}
+
+def parse_srcinfo(srcinfo):
+
+	"""
+	Parses the output of `makepkg --printsrcinfo` into a compact structure:
+	the name of package base, the fields of the package base (each as list of values),
+	and the fields overridden by each of the (possibly split) packages.
+	Architecture-specific fields are kept under their full names (like depends_x86_64).
+	"""
+
+	parsed = {"pkgbase": None, "fields": {}, "packages": {}}
+	section = None
+	for line in srcinfo.splitlines():
+		match = MATCH_SRCINFO_LINE.match(line)
+		if not match:
+			continue
+		key, value = match.groups()
+		if key == "pkgbase":
+			parsed["pkgbase"] = value
+			section = parsed["fields"]
+		elif key == "pkgname":
+			section = parsed["packages"].setdefault(value, {})
+		elif section is not None:
+			values = section.setdefault(key, [])
+			if value:
+				values.append(value)
+	return parsed
+
+def get_package_fields(srcinfo, name):
+
+	"""
+	Returns all the fields of given package, with the ones it overrides replacing
+	those of the package base.
+	"""
+
+	return dict(srcinfo["fields"], **srcinfo["packages"][name])
+
+def get_packages_from_srcinfo(srcinfo):
+
+	"""
+	Returns the map of all the packages produced by the parsed .SRCINFO
+	to their full versions (including epoch and pkgrel).
+	"""
+
+	fields = srcinfo["fields"]
+	final_version = fields["pkgver"][0]
+	if fields.get("pkgrel"):
+		final_version += "-" + fields["pkgrel"][0]
+	if fields.get("epoch"):
+		final_version = fields["epoch"][0] + ":" + final_version
+
+	return dict((name, final_version) for name in srcinfo["packages"])
+
+def get_field_values(srcinfo, field):
+
+	"""
+	Returns the union of all the values of given field (and its architecture-specific variants)
+	across the package base and all the packages, with version constraints removed.
+	"""
+
+	values = set()
+	for section in [srcinfo["fields"]] + list(srcinfo["packages"].values()):
+		for key, entries in section.items():
+			if key == field or key.startswith(field + "_"):
+				values.update(MATCH_VERSION_CONSTRAINT.sub("", x) for x in entries)
+	return values
+
+def get_dependencies_from_srcinfo(srcinfo):
+
+	"""
+	Returns the names (without version constraints) of all the packages
+	the given .SRCINFO depends on, both for building and at runtime,
+	along with the names it provides (besides its own package names).
+	"""
+
+	return (
+		get_field_values(srcinfo, "depends") | get_field_values(srcinfo, "makedepends"),
+		get_field_values(srcinfo, "provides")
+	)
+
+def get_pkgbuild_version(pkgbuild):
+
+	"""
+	Returns the full version (including epoch and pkgrel) declared by the contents of PKGBUILD,
+	without sourcing it; only the plain top-level assignments are taken into account,
+	with references to other such variables expanded. Returns None if the version
+	can't be determined this way (like when it's computed by a command).
+	"""
+
+	variables = {}
+	for line in pkgbuild.splitlines():
+		match = MATCH_PKGBUILD_ASSIGNMENT.match(line)
+		if not match:
+			continue
+		name, double_quoted, single_quoted, bare = match.groups()
+		if single_quoted is not None:
+			variables[name] = single_quoted
+			continue
+		value = double_quoted if double_quoted is not None else bare
+		if "$(" in value:
+			variables[name] = None
+			continue
+		references = [x or y for x, y in MATCH_VARIABLE.findall(value)]
+		if any(variables.get(x) is None for x in references):
+			variables[name] = None
+			continue
+		variables[name] = MATCH_VARIABLE.sub(lambda x: variables[x.group(1) or x.group(2)], value)
+
+	if not variables.get("pkgver"):
+		return None
+	final_version = variables["pkgver"]
+	if variables.get("pkgrel"):
+		final_version += "-" + variables["pkgrel"]
+	if variables.get("epoch"):
+		final_version = variables["epoch"] + ":" + final_version
+	return final_version
+
+def get_sources_from_srcinfo(srcinfo, arch):
+
+	"""
+	Returns the sources of the package (common ones and the ones for given architecture),
+	each as the source entry along with the map of hash algorithms (as in hashlib)
+	to its checksums; the ones to be skipped (SKIP) are left out.
+	"""
+
+	fields = srcinfo["fields"]
+	sources = []
+	for suffix in ("", f"_{arch}"):
+		checksums = dict((algorithm, fields.get(key + suffix, [])) for key, algorithm in CHECKSUM_ARRAYS.items())
+		for index, source in enumerate(fields.get("source" + suffix, [])):
+			sources.append((source, dict(
+				(algorithm, values[index].lower()) for algorithm, values in checksums.items()
+				if index < len(values) and values[index] != "SKIP"
+			)))
+	return sources
+
+def get_srcinfo_key(build_dir):
+
+	"""
+	Returns the hash of the prepared PKGBUILD, along with all the (existing, regular) files it sources,
+	which is all that determines the contents of its .SRCINFO.
+	"""
+
+	digest = hashlib.sha256()
+	pkgbuild = os.path.join(build_dir, "PKGBUILD")
+	with open(pkgbuild, mode="rb") as fp:
+		contents = fp.read()
+	digest.update(contents)
+
+	for line in contents.decode("utf8", errors="replace").splitlines():
+		match = MATCH_SOURCED_FILE.match(line)
+		if match:
+			path = os.path.join(build_dir, match.group(1))
+			if os.path.isfile(path):
+				with open(path, mode="rb") as fp:
+					digest.update(b"\0" + match.group(1).encode("utf8") + b"\0" + fp.read())
+	return digest.hexdigest()
+
+class SrcinfoCache:
+
+	"""
+	Cache of parsed .SRCINFO contents, keyed by the hash of PKGBUILD (and files it sources),
+	to avoid sourcing the PKGBUILD via makepkg when it hasn't changed.
+	Each package directory also keeps the reference to its most recent entry,
+	so that the last known versions can be looked up without preparing the package.
+	"""
+
+	__slots__ = ("directory",)
+
+	def __init__(self, directory):
+		self.directory = directory
+
+	def read(self, filename):
+		try:
+			with open(os.path.join(self.directory, filename), mode="rt", encoding="utf8") as fp:
+				return json.load(fp)
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def write(self, filename, data):
+		path = os.path.join(self.directory, filename)
+		temp_path = f"{path}.tmp{os.getpid()}-{get_ident()}"
+		with open(temp_path, mode="wt", encoding="utf8") as fp:
+			json.dump(data, fp, separators=(",", ":"))
+		os.replace(temp_path, path)
+
+	def get(self, key):
+		return self.read(f"{key}.json")
+
+	def put(self, key, srcinfo):
+		self.write(f"{key}.json", srcinfo)
+
+	def set_latest(self, item, key):
+		self.write(f"latest-{item}.json", {"key": key})
+
+	def get_latest(self, item):
+		latest = self.read(f"latest-{item}.json")
+		return self.get(latest["key"]) if latest else None
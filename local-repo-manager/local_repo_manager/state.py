@@ -0,0 +1,181 @@
+import json
+import os
+import os.path
+from shutil import rmtree
+
+from .fingerprint import FINGERPRINTS_FILE
+from .ingest import MARKER_EXTENSION, read_marker
+from .sources import get_source_filename
+from .srcinfo import get_sources_from_srcinfo
+
+# Subdirectories of the state directory; package destination of the update,
+# and the build directories of the packages
+PKGDEST_DIR = "pkgdest"
+TREES_DIR = "trees"
+
+# Policies for keeping the build directories once the package is done with
+KEEP_BUILD_TREES = ("no", "failed", "all")
+
+def get_resumable(pkgdest):
+
+	"""
+	Returns the map of packages built by the previous, unfinished attempt at the update
+	(with their artifacts still in the persistent package destination) to the fingerprints
+	that attempt has recorded for them.
+	"""
+
+	try:
+		with open(os.path.join(pkgdest, FINGERPRINTS_FILE), mode="rt", encoding="utf8") as fp:
+			pending = json.load(fp)
+	except (FileNotFoundError, ValueError):
+		return {}
+	return dict((item, stored) for item, stored in pending.items() if read_marker(pkgdest, item) is not None)
+
+def get_extracted_sources(srcinfo):
+
+	"""
+	Returns the remote sources of the package (each as the source entry along with its checksums),
+	which is what the sources extracted into its build directory are made from; local files
+	(like patches) are left out, as they're only used by its prepare() function.
+	"""
+
+	return sorted(
+		([source, checksums] for source, checksums in get_sources_from_srcinfo(srcinfo, os.uname().machine) if get_source_filename(source)),
+		key=lambda x: x[0]
+	)
+
+def discard_artifacts(pkgdest, item):
+
+	"""
+	Removes the artifacts of given package (along with their signatures and the marker) from the package destination.
+	"""
+
+	for path in read_marker(pkgdest, item) or ():
+		for filename in (path, f"{path}.sig"):
+			if os.path.isfile(filename):
+				os.unlink(filename)
+	os.unlink(os.path.join(pkgdest, item + MARKER_EXTENSION))
+
+class RunDirectory:
+
+	"""
+	Persistent package destination of the update, kept within the state directory.
+	Unlike the temporary one, it's kept in place if the update fails, so that the packages
+	already built (along with their fingerprints) can be picked up by the next attempt;
+	it's only emptied once the update succeeds. With `fresh` set, whatever the previous attempt
+	has left behind (including the build directories) is discarded first.
+	"""
+
+	__slots__ = ("directory", "fresh", "state_dir")
+
+	def __init__(self, state_dir, fresh=False):
+		self.state_dir = state_dir
+		self.directory = os.path.join(state_dir, PKGDEST_DIR)
+		self.fresh = fresh
+
+	def __enter__(self):
+		if self.fresh:
+			for name in (PKGDEST_DIR, TREES_DIR):
+				rmtree(os.path.join(self.state_dir, name), ignore_errors=True)
+		os.makedirs(self.directory, exist_ok=True)
+		os.makedirs(os.path.join(self.state_dir, TREES_DIR), exist_ok=True)
+		return self.directory
+
+	def __exit__(self, *args):
+		if args[0] is None:
+			rmtree(self.directory)
+
+class BuildTrees:
+
+	"""
+	Build directories of the packages kept between the runs (instead of temporary ones), so that
+	the build which has failed can continue from the sources already extracted and partially built,
+	with `makepkg --noextract`, rather than starting from scratch. The tree is reused if it was made
+	from the same upstream commit and the same remote sources; if the package's scripts (like patches
+	applied by prepare()) have changed since, the sources are prepared again and brought into the tree
+	before the build (see build_package), so that only what's affected by the changes is built again.
+	The state of each tree is kept next to it, along with the list of the files prepared within it
+	(before anything was built), which is what tells them apart from the files produced by the build.
+	Once the package is done, its tree is kept according to `keep` policy.
+	"""
+
+	__slots__ = ("directory", "keep")
+
+	def __init__(self, directory, keep="failed"):
+		self.directory = directory
+		self.keep = keep
+
+	def get_manifest(self, item):
+		return os.path.join(self.directory, f"{item}.prepared")
+
+	def get_state(self, item):
+		try:
+			with open(os.path.join(self.directory, f"{item}.json"), mode="rt", encoding="utf8") as fp:
+				return json.load(fp)
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def open(self, item, fingerprint):
+
+		"""
+		Empties the build directory of given package for its preparation scripts (which expect an empty one),
+		setting aside the sources extracted by its previous build if they can be reused.
+		Returns the build directory, along with the location of the set-aside sources (or None).
+		"""
+
+		path = os.path.join(self.directory, item)
+		saved = os.path.join(self.directory, f".{item}-src")
+		state = self.get_state(item)
+		reusable = (
+			state is not None and os.path.isdir(os.path.join(path, "src")) and os.path.isfile(self.get_manifest(item))
+			and fingerprint["upstream"] is not None and state["upstream"] == fingerprint["upstream"]
+		)
+
+		rmtree(saved, ignore_errors=True)
+		if reusable:
+			os.rename(os.path.join(path, "src"), saved)
+		elif os.path.isfile(self.get_manifest(item)):
+			os.unlink(self.get_manifest(item))
+		rmtree(path, ignore_errors=True)
+		os.makedirs(path)
+		return (path, saved if reusable else None)
+
+	def restore(self, item, saved, fingerprint, srcinfo):
+
+		"""
+		Puts the set-aside sources back into the build directory, if they were extracted from the same
+		remote sources as the ones of the prepared package; otherwise, they're discarded. Returns None
+		if they were discarded, or whether they have to be prepared again (as the scripts have changed).
+		"""
+
+		state = self.get_state(item)
+		if state.get("sources") != get_extracted_sources(srcinfo):
+			rmtree(saved)
+			os.unlink(self.get_manifest(item))
+			return None
+		os.rename(saved, os.path.join(self.directory, item, "src"))
+		return state["scripts"] != fingerprint["scripts"]
+
+	def keeps(self, success):
+		return self.keep == "all" or (self.keep == "failed" and not success)
+
+	def close(self, item, fingerprint, srcinfo, success):
+
+		"""
+		Records the state of the tree once the package's build is done, or removes the tree altogether
+		if it's not supposed to be kept.
+		"""
+
+		state_file = os.path.join(self.directory, f"{item}.json")
+		if not self.keeps(success):
+			rmtree(os.path.join(self.directory, item), ignore_errors=True)
+			for filename in (state_file, self.get_manifest(item)):
+				if os.path.isfile(filename):
+					os.unlink(filename)
+			return
+
+		with open(f"{state_file}.tmp", mode="wt", encoding="utf8") as fp:
+			json.dump(dict(
+				fingerprint, sources=get_extracted_sources(srcinfo), status="built" if success else "failed"
+			), fp, indent="\t")
+		os.replace(f"{state_file}.tmp", state_file)
@@ -0,0 +1,132 @@
+from contextlib import contextmanager
+import json
+import os
+import resource
+import subprocess
+from threading import Lock, local
+import time
+
+TIMINGS_FILE = "timings.json"
+
+def get_cpu_time():
+
+	"""
+	Returns CPU time (user and system) used so far by the current thread; CPU time of the child processes
+	is taken from each of them as it's reaped, since the process-wide counter of all the waited-for children
+	would include the ones of the other threads (like the packages built concurrently).
+	"""
+
+	thread = resource.getrusage(resource.RUSAGE_THREAD)
+	return thread.ru_utime + thread.ru_stime
+
+class MeasuredPopen(subprocess.Popen):
+
+	"""
+	Popen reaping the process with wait4, so that the CPU time and peak memory of the process (along with
+	the descendants it has waited for) are recorded into the phases the calling thread is in.
+	The kernel counts the memory of the forked manager before the command is executed as well,
+	so the peak is never lower than the manager's own memory at the time.
+	"""
+
+	def wait(self, timeout=None):
+		if self.returncode is not None or timeout is not None:
+			return super().wait(timeout)
+		_, status, usage = os.wait4(self.pid, 0)
+		self.returncode = os.waitstatus_to_exitcode(status)
+		TIMINGS.record_usage(usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024)
+		return self.returncode
+
+def run_measured(args, check=False, input=None, capture_output=False, **kwargs):
+
+	"""
+	Equivalent of subprocess.run for the commands run within the phases, recording their CPU time and peak memory.
+	"""
+
+	if capture_output:
+		kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+	if input is not None:
+		kwargs["stdin"] = subprocess.PIPE
+	with MeasuredPopen(args, **kwargs) as process:
+		try:
+			stdout, stderr = process.communicate(input)
+		except BaseException:
+			process.kill()
+			raise
+	result = subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+	if check:
+		result.check_returncode()
+	return result
+
+class PhaseTimings:
+
+	"""
+	Collects wall time, CPU time and peak memory of the phases of the update (like preparing
+	or building the package), either for the whole run or for specific package.
+	CPU time is the one of the thread the phase is in, along with the child processes it has run
+	within the phase (with run_measured); peak memory is the largest resident set size of those
+	processes, left unknown (None) for the phases which haven't run any, as the manager's own peak
+	memory is only known for its whole lifetime.
+	Timings collected within the container are saved next to the build artifacts,
+	and merged with the ones collected on the host once the container is done.
+	"""
+
+	__slots__ = ("active", "lock", "phases", "started")
+
+	def __init__(self):
+		self.lock = Lock()
+		self.active = local()
+		self.phases = []
+		self.started = time.time()
+
+	@contextmanager
+	def phase(self, name, package=""):
+		start = time.monotonic()
+		start_cpu = get_cpu_time()
+		usage = {"cpu": 0.0, "max_rss": None}
+		if not hasattr(self.active, "phases"):
+			self.active.phases = []
+		self.active.phases.append(usage)
+		try:
+			yield
+		finally:
+			self.active.phases.pop()
+			self.add(name, package, time.monotonic() - start, get_cpu_time() - start_cpu + usage["cpu"], usage["max_rss"])
+
+	def record_usage(self, cpu, max_rss):
+		for usage in getattr(self.active, "phases", ()):
+			usage["cpu"] += cpu
+			usage["max_rss"] = max(usage["max_rss"] or 0, max_rss)
+
+	def reset(self):
+		with self.lock:
+			self.phases = []
+			self.started = time.time()
+
+	def add(self, name, package, wall, cpu, max_rss):
+		with self.lock:
+			self.phases.append({"package": package, "phase": name, "wall": wall, "cpu": cpu, "max_rss": max_rss})
+
+	def save(self, filename):
+		with self.lock:
+			with open(filename, mode="wt", encoding="utf8") as fp:
+				json.dump({"started": self.started, "phases": self.phases}, fp, indent="\t")
+
+	def merge(self, filename):
+
+		"""
+		Adds the timings saved (by the container) into given file, if there are any;
+		returns the time the saved timings were started at, or None if there were none.
+		"""
+
+		try:
+			with open(filename, mode="rt", encoding="utf8") as fp:
+				saved = json.load(fp)
+		except FileNotFoundError:
+			return None
+		with self.lock:
+			self.phases.extend(saved["phases"])
+		return saved["started"]
+
+# Timings of the current process, collected by both the update action (on the host)
+# and the build action (within the container)
+TIMINGS = PhaseTimings()
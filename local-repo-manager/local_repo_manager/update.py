@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+import os
+import os.path
+import sys
+import traceback
+
+from .build import LOCAL_USER_UID, get_packages, get_build_artifacts
+from .cleanup import collect_garbage, get_installed_packages
+from .executor import LOCAL_HOST, get_build_costs, get_executors, get_local_executor, get_remote_fingerprints_file, place_packages
+from .fingerprint import FINGERPRINTS_FILE, FingerprintStore
+from .history import RecordRun
+from .ingest import ArtifactIngest, add_to_repository, move_artifact
+from .log import HostOutput, LogToFile, LogToStdout
+from .mirror import update_mirrors
+from .state import RunDirectory, get_resumable
+from .timing import TIMINGS, TIMINGS_FILE
+from .util import TempDirectory
+
+def prepare_host(config, packages=None, packages_dir=None):
+
+	"""
+	Prepares this host for building given packages (all of them, if None) from given packages directory
+	(the configured one by default). Mirrors of upstream repositories are updated on the host, since the container
+	only gets read-only access to them, and the cache directories are handed over to the local user building in it.
+	"""
+
+	if config["mirror_dir"]:
+		print("Updating mirrors of upstream repositories...")
+		with TIMINGS.phase("mirrors"):
+			update_mirrors(config["mirror_dir"], set(
+				repository for item, repository in get_packages(packages_dir or config["packages_dir"]).items()
+				if repository and (packages is None or item in packages)
+			))
+
+	# Compiler cache and source cache directories are written to by the local user within the container
+	for temp in ("ccache_dir", "source_cache_dir"):
+		if config[temp]:
+			os.chown(config[temp], LOCAL_USER_UID, LOCAL_USER_UID)
+
+def get_placement(config, executors, packages=None, resumable=None):
+
+	"""
+	Decides which of the build hosts builds which packages (all of them, if None); with this host being the only one,
+	it builds everything, the same as ever. Otherwise, the capacity of every host is determined first, with the hosts
+	that can't be reached left out, and the packages are spread across the rest. Returns the map of the executors
+	to the packages they build.
+	"""
+
+	if len(executors) == 1:
+		return {executors[0]: packages}
+
+	available = []
+	for executor in executors:
+		try:
+			if executor.get_capacity():
+				available.append(executor)
+		except RuntimeError as e:
+			print(f"{e}, it will not build anything")
+	if not available:
+		raise RuntimeError("None of the build hosts are available")
+
+	if packages is None:
+		packages = set(item for item, repository in get_packages(config["packages_dir"]).items() if repository)
+	placement = place_packages(
+		available, packages, FingerprintStore(os.path.join(config["repository_dir"], FINGERPRINTS_FILE)).fingerprints,
+		get_build_costs(config["history_file"], packages), pinned=resumable if available[0].name == LOCAL_HOST else ()
+	)
+	print("Packages will be built on following hosts:")
+	for executor in available:
+		print("* {0} ({1} slot(s)): {2}".format(executor.name, executor.slots, ", ".join(sorted(placement.get(executor, ()))) or "nothing"))
+	return placement
+
+def run_on_hosts(placement, pkgdest, force=False, log_output=None):
+
+	"""
+	Runs the builds on all the hosts they're placed on. With more than one of them, the hosts build concurrently,
+	each with its own output relayed into the log; once all of them are done, the fingerprints collected by
+	the remote ones are combined with the rest, and the first failure (if any) is raised.
+	"""
+
+	def run_on_host(executor, packages):
+		with HostOutput(executor.name, log_output) as output:
+			try:
+				executor.run(pkgdest, packages, force=force, log_output=output)
+			except Exception as e:
+				print(f"Build on {executor.name} has failed: {e}", file=output)
+				raise
+
+	try:
+		if len(placement) == 1:
+			(executor, packages), = placement.items()
+			executor.run(pkgdest, packages, force=force, log_output=log_output)
+		else:
+			with ThreadPoolExecutor(max_workers=len(placement)) as pool:
+				futures = [pool.submit(run_on_host, executor, packages) for executor, packages in placement.items()]
+			failures = [x.exception() for x in futures if x.exception() is not None]
+			if failures:
+				raise failures[0]
+	finally:
+		remote = [x for x in (get_remote_fingerprints_file(pkgdest, executor.name) for executor in placement) if os.path.isfile(x)]
+		if remote:
+			FingerprintStore.combine(os.path.join(pkgdest, FINGERPRINTS_FILE), *remote)
+
+def run_update(config, packages=None, force=False, logging=True, fresh=False):
+
+	"""
+	Sets up the nspawn container along with temporary directory to bind as target for build artifacts,
+	then runs the manager in that container with `build` action, doing the actual build, and adds
+	whatever has been built to the local repository. Only the given packages (by their directory names)
+	are checked, if any are provided; otherwise all of them are. Used both by the update action
+	and by the jobs of the daemon. Returns the list of artifacts added to the repository.
+	With the state directory configured, the update picks up where the previous, failed one has left off,
+	unless `fresh` is set. With other build hosts configured, the packages are spread
+	across them (and this host, if it's listed), and their artifacts are collected here.
+	"""
+
+	if packages is not None:
+		unknown = packages - get_packages(config["packages_dir"]).keys()
+		if unknown:
+			raise RuntimeError("Unknown package(s): {0}".format(", ".join(sorted(unknown))))
+
+	# Timings of all the phases (both on the host and within the container) are recorded
+	# into the build history once the update is done, whether it succeeds or not
+	with RecordRun(config["history_file"], config["prometheus_textfile"]), ExitStack() as stack:
+		executors = [stack.enter_context(x) for x in get_executors(config)]
+
+		# Package destination is kept within repository directory, so that the artifacts
+		# can be hardlinked rather than copied there; with the state directory, it's kept
+		# in there instead, and persists until the update succeeds
+		print("Setting up container to build new packages in...")
+		run_directory = RunDirectory(config["state_dir"], fresh=fresh) if config["state_dir"] else TempDirectory(parent=config["repository_dir"])
+		with run_directory as pkgdest:
+
+			resumable = get_resumable(pkgdest)
+			if resumable:
+				print("Resuming the previous update, with {0} package(s) already built: {1}".format(
+					len(resumable), ", ".join(sorted(resumable))
+				))
+
+			# Only the packages built on this host need it to be prepared for them
+			placement = get_placement(config, executors, packages, resumable)
+			local = next((x for x in placement if x.name == LOCAL_HOST), None)
+			if local is not None:
+				prepare_host(config, placement[local])
+
+			# Should any issues occur during the build process, we make sure to print
+			# all the exception details into whatever the log target is (terminal or file),
+			# and raise known RuntimeError - this is to prevent spamming systemd journals
+			# when update is executed from the timer.
+			try:
+
+				log_target = LogToFile(
+					config["log_dir"], compression=config["log_compression"],
+					keep_runs=config["log_keep_runs"], max_size=config["log_max_size"]
+				) if logging else LogToStdout()
+				with log_target as (fp, log_dest):
+					print(f"(build process will be logged to {log_dest})\n")
+					try:
+						with ArtifactIngest(pkgdest, config) if config["stream_artifacts"] else nullcontext() as ingest:
+							run_on_hosts(placement, pkgdest, force=force, log_output=fp)
+					except Exception as e:
+						traceback.print_exception(*sys.exc_info(), file=fp)
+						raise e
+
+			except Exception as e:
+				# Whatever has been built and added to repository before the failure stays there,
+				# so we keep track of it for the next run
+				if config["stream_artifacts"]:
+					FingerprintStore.merge(
+						os.path.join(config["repository_dir"], FINGERPRINTS_FILE),
+						os.path.join(pkgdest, FINGERPRINTS_FILE)
+					)
+				exc = RuntimeError("Build process has failed due to unexpected errors\nCheck the build log to investigate the cause of the issue")
+				exc.with_traceback(sys.exc_info()[2])
+				raise exc
+
+			print("\nBuild complete, temporary container terminated")
+
+			# It is possible that we have no new build artifacts even if the build process
+			# was successful, as we only build if the package is newer than what's in local repo.
+			if config["stream_artifacts"]:
+				new_artifacts = ingest.added
+			else:
+				new_artifacts = get_build_artifacts(pkgdest)
+				if len(new_artifacts):
+					print("Moving artifacts to local repository directory...")
+					with TIMINGS.phase("artifacts"):
+						new_artifacts = [move_artifact(x, config["repository_dir"]) for x in new_artifacts]
+					print("Adding artifacts to local repository...\n")
+					with TIMINGS.phase("repository"):
+						add_to_repository(config, new_artifacts)
+
+			if not len(new_artifacts):
+				print("No new packages have been built")
+			else:
+				print("\nNew packages added to the repository")
+				print("Run pacman -Syyu to install them")
+
+			FingerprintStore.merge(
+				os.path.join(config["repository_dir"], FINGERPRINTS_FILE),
+				os.path.join(pkgdest, FINGERPRINTS_FILE)
+			)
+
+		# Old versions of packages are only removed once new ones have been added
+		if config["gc_after_update"] and len(new_artifacts):
+			with TIMINGS.phase("gc"):
+				removed, reclaimed = collect_garbage(
+					config["repository_dir"], config["repository_file"], config["gc_keep_versions"], get_installed_packages()
+				)
+			print("Removed {0} file(s) of old package versions, {1:.1f} MiB reclaimed".format(len(removed), reclaimed / 1048576))
+
+	return new_artifacts
+
+def run_execute(config, pkgdest, packages_dir, packages, force=False):
+
+	"""
+	Builds the packages shipped from another host (running the update) on this one, the same way the update
+	builds them here, but leaves the artifacts in given package destination, for that host to collect,
+	rather than adding them to the repository. Timings of the build are saved along with them.
+	"""
+
+	prepare_host(config, packages, packages_dir)
+	sys.stdout.flush()
+	try:
+		get_local_executor(config).run(
+			pkgdest, packages, force=force, packages_dir=packages_dir, log_output=sys.stdout
+		)
+	finally:
+		TIMINGS.save(os.path.join(pkgdest, TIMINGS_FILE))
@@ -2,13 +2,32 @@ import ctypes
 import ctypes.util
 import os
 import os.path
+import select
 from shutil import rmtree
+import struct
 import sys
 from tempfile import mkdtemp
 
 _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 _libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
 _libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_ulong)
+_libc.inotify_init1.argtypes = (ctypes.c_int,)
+_libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+# Flags and event masks of inotify (from sys/inotify.h)
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
 
 def bind_mount(source, target):
 
@@ -23,6 +42,21 @@ def bind_mount(source, target):
         errno = ctypes.get_errno()
         raise OSError(errno, f"Error bind mounting {source} on {target}: {os.strerror(errno)}")
 
+def mount_tmpfs(target, size, uid=None):
+
+    """
+    Helper method used to mount tmpfs of given size (in bytes) on target directory,
+    owned by given user (if provided). Used for building packages in memory.
+    """
+
+    options = f"size={size},mode=0755"
+    if uid is not None:
+        options += f",uid={uid},gid={uid}"
+    ret = _libc.mount(b"tmpfs", target.encode(), b"tmpfs", 0, options.encode())
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"Error mounting tmpfs on {target}: {os.strerror(errno)}")
+
 def bind_unmount(target):
 
     """
@@ -43,15 +77,16 @@ class TempDirectory:
     as well as bound destination for depositing built packages into.
     """
 
-    __slots__ = ("mount", "tempdir")
+    __slots__ = ("mount", "parent", "tempdir")
 
-    def __init__(self, mount=None):
+    def __init__(self, mount=None, parent=None):
         if mount and not os.path.isdir(mount):
             raise RuntimeError(f"{mount} is not a valid bind mount source")
         self.mount = mount
+        self.parent = parent
 
     def __enter__(self, mount=None):
-        self.tempdir = mkdtemp()
+        self.tempdir = mkdtemp(prefix=".tmp" if self.parent else "tmp", dir=self.parent)
         if self.mount:
             bind_mount(self.mount, self.tempdir)
         return self.tempdir
@@ -62,6 +97,84 @@ class TempDirectory:
         rmtree(self.tempdir)
         del self.tempdir
 
+def format_duration(seconds):
+
+    """
+    Formats the duration in seconds as hours, minutes and seconds (like 1h 02m 03s),
+    leaving out the parts which are zero at the front.
+    """
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {seconds:02d}s"
+    elif minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+class Inotify:
+
+    """
+    Minimal wrapper around Linux inotify API, used to watch directories for changes.
+    Watches are added per directory (inotify isn't recursive), and the events are returned
+    as tuples of the watched directory, event mask and the name of the affected entry.
+    """
+
+    __slots__ = ("fd", "watches")
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Error initialising inotify: {os.strerror(errno)}")
+        self.watches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_watch(self, path, mask):
+        wd = _libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Error watching {path}: {os.strerror(errno)}")
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout=None):
+
+        """
+        Waits up to `timeout` seconds (indefinitely if None) for the events,
+        and returns all of the ones available (or empty list if there were none).
+        """
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf8", errors="replace")
+            offset += length
+            if mask & IN_IGNORED:
+                path = self.watches.pop(wd, None)
+            else:
+                path = self.watches.get(wd)
+            if path is not None:
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
 _original_excepthook = sys.excepthook
 def custom_exception_handler(exctype, value, tb):
 
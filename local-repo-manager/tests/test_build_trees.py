@@ -0,0 +1,123 @@
+"""
+Tests of the build directories kept between the runs; which of them are reused (as they are,
+or prepared again), and how the sources prepared again are brought into the kept ones.
+"""
+
+import os
+import os.path
+
+import pytest
+
+from local_repo_manager.build import get_prepared_files, read_manifest, sync_prepared, write_manifest
+from local_repo_manager.state import BuildTrees
+
+FINGERPRINT = {"upstream": "1" * 40, "scripts": "a" * 64}
+
+def get_srcinfo(tarball="https://example.com/linux-6.1.tar.xz", patches=("fix.patch",)):
+	return {
+		"pkgbase": "linux",
+		"packages": {"linux": {}},
+		"fields": {
+			"pkgver": ["6.1"],
+			"source": [tarball] + list(patches),
+			"sha256sums": ["f" * 64] + ["SKIP"] * len(patches)
+		}
+	}
+
+def write_file(path, contents=""):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, mode="wt", encoding="utf8") as fp:
+		fp.write(contents)
+
+def read_file(path):
+	with open(path, mode="rt", encoding="utf8") as fp:
+		return fp.read()
+
+@pytest.fixture
+def trees(tmp_path):
+
+	"""
+	Returns the build trees with the tree of `linux` package kept by its failed build,
+	made from the sources and the scripts of get_srcinfo and FINGERPRINT.
+	"""
+
+	trees = BuildTrees(str(tmp_path / "trees"), keep="failed")
+	path, saved = trees.open("linux", FINGERPRINT)
+	assert saved is None
+	write_file(os.path.join(path, "src", "linux-6.1", "Makefile"), "all:\n")
+	write_manifest(trees.get_manifest("linux"), ["linux-6.1/Makefile"])
+	trees.close("linux", FINGERPRINT, get_srcinfo(), success=False)
+	return trees
+
+def test_unchanged_tree_is_reused_as_is(trees):
+	path, saved = trees.open("linux", FINGERPRINT)
+	assert saved is not None
+	assert trees.restore("linux", saved, FINGERPRINT, get_srcinfo()) is False
+	assert os.path.isfile(os.path.join(path, "src", "linux-6.1", "Makefile"))
+
+def test_tree_with_changed_patches_is_prepared_again(trees):
+	fingerprint = dict(FINGERPRINT, scripts="b" * 64)
+	path, saved = trees.open("linux", fingerprint)
+	assert saved is not None
+	assert trees.restore("linux", saved, fingerprint, get_srcinfo(patches=("fix.patch", "new.patch"))) is True
+	assert os.path.isfile(os.path.join(path, "src", "linux-6.1", "Makefile"))
+
+def test_tree_with_changed_sources_is_discarded(trees):
+	fingerprint = dict(FINGERPRINT, scripts="b" * 64)
+	path, saved = trees.open("linux", fingerprint)
+	assert trees.restore("linux", saved, fingerprint, get_srcinfo(tarball="https://example.com/linux-6.2.tar.xz")) is None
+	assert not os.path.exists(saved)
+	assert not os.path.exists(os.path.join(path, "src"))
+	assert not os.path.exists(trees.get_manifest("linux"))
+
+def test_tree_from_other_upstream_commit_is_discarded(trees):
+	path, saved = trees.open("linux", dict(FINGERPRINT, upstream="2" * 40))
+	assert saved is None
+	assert not os.path.exists(os.path.join(path, "src"))
+	assert not os.path.exists(trees.get_manifest("linux"))
+
+def test_tree_without_manifest_is_discarded(trees):
+
+	# Sources which haven't been prepared completely can't be told apart from the build outputs
+	os.unlink(trees.get_manifest("linux"))
+	_, saved = trees.open("linux", FINGERPRINT)
+	assert saved is None
+
+def test_sync_prepared(tmp_path):
+	kept = str(tmp_path / "kept")
+	fresh = str(tmp_path / "fresh")
+
+	# Previous build applied a patch changing main.c and adding old.c, then built some of it
+	write_file(os.path.join(kept, "main.c"), "patched by old.patch\n")
+	write_file(os.path.join(kept, "util.c"), "unchanged\n")
+	write_file(os.path.join(kept, "old.c"), "added by old.patch\n")
+	write_file(os.path.join(kept, "main.o"), "object\n")
+	os.symlink("main.c", os.path.join(kept, "link.c"))
+	previous = ["link.c", "main.c", "old.c", "util.c"]
+	for name in previous + ["main.o"]:
+		os.utime(os.path.join(kept, name), (1000000000, 1000000000), follow_symlinks=False)
+
+	# Prepared again, the new patch changes main.c and adds a file in new directory instead
+	write_file(os.path.join(fresh, "main.c"), "patched by new.patch\n")
+	write_file(os.path.join(fresh, "util.c"), "unchanged\n")
+	write_file(os.path.join(fresh, "drivers", "new.c"), "added by new.patch\n")
+	os.symlink("main.c", os.path.join(fresh, "link.c"))
+	current = get_prepared_files(fresh)
+	assert current == ["drivers/new.c", "link.c", "main.c", "util.c"]
+
+	assert sync_prepared(fresh, kept, previous, current) == 3
+	assert get_prepared_files(kept) == ["drivers/new.c", "link.c", "main.c", "main.o", "util.c"]
+	assert read_file(os.path.join(kept, "main.c")) == "patched by new.patch\n"
+	assert read_file(os.path.join(kept, "drivers", "new.c")) == "added by new.patch\n"
+
+	# Only the changed files are newer than the build outputs, so only they get built again
+	assert os.path.getmtime(os.path.join(kept, "main.c")) > 1000000000
+	assert os.path.getmtime(os.path.join(kept, "util.c")) == 1000000000
+	assert os.path.getmtime(os.path.join(kept, "main.o")) == 1000000000
+	assert os.lstat(os.path.join(kept, "link.c")).st_mtime == 1000000000
+
+def test_manifest_round_trip(tmp_path):
+	filename = str(tmp_path / "linux.prepared")
+	paths = ["a b/c.c", "d\nnewline", "e.c"]
+	write_manifest(filename, paths)
+	assert read_manifest(filename) == paths
@@ -0,0 +1,86 @@
+"""
+Tests of how the memory is split between the tmpfs the packages are built on and the job slots
+of the builds; memory and CPUs of the machine are simulated, and nothing is actually mounted.
+"""
+
+import pytest
+
+from local_repo_manager import jobserver, placement
+from local_repo_manager.jobserver import get_job_slots
+from local_repo_manager.placement import BuildPlacement
+
+GIB = 1 << 30
+
+@pytest.fixture
+def machine(monkeypatch):
+
+	"""
+	Simulates the machine with given number of CPUs and amount of available memory,
+	returning the list the mounted tmpfs are recorded into.
+	"""
+
+	mounted = []
+	def setup(cpus, memory):
+		monkeypatch.setattr(jobserver, "get_available_cpus", lambda: cpus)
+		monkeypatch.setattr(jobserver, "get_available_memory", lambda: memory)
+		monkeypatch.setattr(placement, "get_available_memory", lambda: memory)
+		monkeypatch.setattr(placement, "mount_tmpfs", lambda mount_point, size, uid=None: mounted.append((mount_point, size)))
+		return mounted
+	return setup
+
+def test_spare_memory_gets_tmpfs(machine):
+	mounted = machine(cpus=8, memory=64 * GIB)
+	build_placement = BuildPlacement("auto", min_free=8 * GIB)
+	reserved = build_placement.reserve([4 * GIB, 2 * GIB, None], concurrent=2)
+	slots, _, _ = get_job_slots(2 * GIB, reserved=reserved)
+
+	assert reserved == 7.5 * GIB
+	assert slots == 8
+	assert build_placement.mount("/first", 4 * GIB) == 5 * GIB
+	assert build_placement.mount("/second", 2 * GIB) == 2.5 * GIB
+	assert len(mounted) == 2
+
+def test_memory_bound_slots_leave_room_for_tmpfs(machine):
+
+	# Memory allows fewer jobs than there are CPUs, so the tmpfs comes out of the job slots
+	mounted = machine(cpus=32, memory=32 * GIB)
+	build_placement = BuildPlacement("auto", min_free=8 * GIB)
+	reserved = build_placement.reserve([8 * GIB], concurrent=2)
+	slots, _, _ = get_job_slots(2 * GIB, reserved=reserved)
+
+	assert reserved == 10 * GIB
+	assert slots == 11
+	assert build_placement.mount("/kernel", 8 * GIB) == 10 * GIB
+	assert mounted == [("/kernel", 10 * GIB)]
+
+def test_tmpfs_stays_within_reservation(machine):
+	mounted = machine(cpus=8, memory=64 * GIB)
+	build_placement = BuildPlacement("auto", min_free=8 * GIB)
+	build_placement.reserve([4 * GIB, 4 * GIB, 4 * GIB], concurrent=2)
+
+	assert build_placement.mount("/first", 4 * GIB) is not None
+	assert build_placement.mount("/second", 4 * GIB) is not None
+	assert build_placement.mount("/third", 4 * GIB) is None
+	assert len(mounted) == 2
+
+	# Once one of the tmpfs is unmounted, its memory can be used by the next build
+	del build_placement.mounted["/first"]
+	assert build_placement.mount("/third", 4 * GIB) is not None
+
+def test_packages_too_large_for_memory_are_not_reserved_for(machine):
+	machine(cpus=8, memory=16 * GIB)
+	build_placement = BuildPlacement("auto", min_free=8 * GIB)
+	reserved = build_placement.reserve([16 * GIB, 2 * GIB], concurrent=2)
+	slots, _, _ = get_job_slots(2 * GIB, reserved=reserved)
+
+	assert reserved == 2.5 * GIB
+	assert slots == 6
+	assert build_placement.mount("/large", 16 * GIB) is None
+
+def test_disk_placement_reserves_nothing(machine):
+	mounted = machine(cpus=8, memory=64 * GIB)
+	build_placement = BuildPlacement("disk", min_free=8 * GIB)
+
+	assert build_placement.reserve([4 * GIB], concurrent=2) == 0
+	assert build_placement.mount("/first", 4 * GIB) is None
+	assert not mounted
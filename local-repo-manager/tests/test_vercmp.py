@@ -0,0 +1,142 @@
+"""
+Tests of the in-process port of pacman's version comparison; checked against the cases
+of pacman's own vercmptest, and (where pacman is installed) differentially against
+`/usr/bin/vercmp` itself, over a large corpus of generated versions.
+"""
+
+import os
+import random
+import subprocess
+
+import pytest
+
+from local_repo_manager.repo import pacman_ver_compare
+
+VERCMP = "/usr/bin/vercmp"
+
+# Number of generated pairs compared against vercmp
+CORPUS_SIZE = 20000
+
+# Cases from pacman's test/util/vercmptest.sh
+UPSTREAM_CASES = (
+	("1.5.0", "1.5.0", 0),
+	("1.5.1", "1.5.0", 1),
+	("1.5.1", "1.5", 1),
+	("1.5.0-1", "1.5.0-1", 0),
+	("1.5.0-1", "1.5.0-2", -1),
+	("1.5.0-1", "1.5.1-1", -1),
+	("1.5.0-2", "1.5.1-1", -1),
+	("1.5-1", "1.5.1-1", -1),
+	("1.5-2", "1.5.1-1", -1),
+	("1.5-2", "1.5.1-2", -1),
+	("1.5", "1.5-1", 0),
+	("1.5-1", "1.5", 0),
+	("1.1-1", "1.1", 0),
+	("1.0-1", "1.1", -1),
+	("1.1-1", "1.0", 1),
+	("1.0-1", "1.0-1.1", -1),
+	("1.5b-1", "1.5-1", -1),
+	("1.5b", "1.5", -1),
+	("1.5b-1", "1.5", -1),
+	("1.5b", "1.5.1", -1),
+	("1.0a", "1.0alpha", -1),
+	("1.0alpha", "1.0b", -1),
+	("1.0b", "1.0beta", -1),
+	("1.0beta", "1.0rc", -1),
+	("1.0rc", "1.0", -1),
+	("1.5.a", "1.5", 1),
+	("1.5.b", "1.5.a", 1),
+	("1.5.1", "1.5.b", 1),
+	("1.5.b-1", "1.5.b", 0),
+	("1.5-1", "1.5.b", -1),
+	("2.0", "2_0", 0),
+	("2.0_a", "2_0.a", 0),
+	("2.0a", "2.0.a", -1),
+	("2___a", "2_a", 1),
+	("0:1.0", "0:1.0", 0),
+	("0:1.0", "0:1.1", -1),
+	("1:1.0", "0:1.0", 1),
+	("1:1.0", "0:1.1", 1),
+	("1:1.0", "2:1.1", -1),
+	("0:1.0", "1.0", 0),
+	("0:1.0", "1.1", -1),
+	("0:1.1", "1.0", 1),
+	("1:1.0", "1.0", 1),
+	("1:1.0", "1.1", 1),
+	("1:1.1", "1.1", 1)
+)
+
+def get_segment(rng):
+	kind = rng.random()
+	if kind < 0.5:
+		return str(rng.choice((0, 1, 2, 9, 10, 11, 99, 100, 2023, rng.randint(0, 100000))))
+	if kind < 0.6:
+		return "0" * rng.randint(1, 3) + str(rng.randint(0, 99))
+	return rng.choice(("a", "b", "alpha", "beta", "pre", "rc", "r", "g", "git", "svn", "z", "A", "RC"))
+
+def get_version(rng):
+
+	"""
+	Generates a random version string; optional epoch, alternating runs of digits and letters
+	(with or without separators of varying length in between), and optional pkgrel.
+	"""
+
+	version = get_segment(rng)
+	for _ in range(rng.randint(0, 5)):
+		separator = rng.choice(("", ".", ".", ".", "_", "+", "~", "..", "__", ".+"))
+		version += separator + get_segment(rng)
+	if rng.random() < 0.05:
+		version += rng.choice((".", "_", "+"))
+	if rng.random() < 0.15:
+		version = "{0}:{1}".format(rng.choice(("0", "1", "2", "10", "")), version)
+	if rng.random() < 0.6:
+		version += "-{0}".format(rng.choice(("1", "2", "10", "1.1", "2.a", str(rng.randint(1, 20)))))
+	return version
+
+def mutate(version, rng):
+
+	"""
+	Derives a version similar to the given one, so that the corpus holds plenty of pairs
+	differing in only one segment, separator, epoch or pkgrel.
+	"""
+
+	choice = rng.random()
+	if choice < 0.2:
+		return version.rsplit("-", 1)[0] if "-" in version else version + "-1"
+	if choice < 0.3:
+		return "1:" + version.split(":", 1)[-1]
+	if choice < 0.5:
+		return version.replace(".", rng.choice(("_", "..", "+", "")), 1)
+	position = rng.randrange(len(version) + 1)
+	return version[:position] + get_segment(rng) + version[position:]
+
+def get_corpus(size, seed=0):
+	rng = random.Random(seed)
+	pairs = []
+	while len(pairs) < size:
+		one = get_version(rng)
+		two = mutate(one, rng) if rng.random() < 0.5 else get_version(rng)
+		pairs.append((one, two))
+	return pairs
+
+@pytest.mark.parametrize("one,two,expected", UPSTREAM_CASES)
+def test_upstream_cases(one, two, expected):
+	assert pacman_ver_compare(one, two) == expected
+	assert pacman_ver_compare(two, one) == -expected
+
+@pytest.mark.skipif(not os.access(VERCMP, os.X_OK), reason="pacman's vercmp is not installed")
+def test_against_vercmp():
+
+	# Pairs are fed through a single shell, as starting vercmp for each of them would take minutes
+	pairs = get_corpus(CORPUS_SIZE)
+	script = "".join(f"{VERCMP} '{one}' '{two}'\n" for one, two in pairs)
+	result = subprocess.run(["/bin/sh"], input=script.encode("utf8"), capture_output=True, check=True)
+	expected = [int(x) for x in result.stdout.decode("utf8").split()]
+	assert len(expected) == len(pairs)
+
+	mismatches = [
+		(one, two, reference, pacman_ver_compare(one, two))
+		for (one, two), reference in zip(pairs, expected)
+		if pacman_ver_compare(one, two) != reference
+	]
+	assert not mismatches, "\n".join(f"{one} vs {two}: vercmp {reference}, port {actual}" for one, two, reference, actual in mismatches[:50])